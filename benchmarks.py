@@ -0,0 +1,468 @@
+# Benchmarks for the Wiktionary webscraper that run on saved pages instead of the live site
+#
+# The built in corpus is two saved Wiktionary pages and two synthetic pages built from one of them (see corpus),
+# not a sample of real pages: add saved pages with --corpus to time the scraper on those.
+#
+# python benchmarks.py suite [--corpus DIR] [--pages NAME ...] [--baseline [FILE]] [--save-baseline FILE]
+#     times each webscraper function on every page of the corpus and fails if it got slower than the baseline,
+#     benchmarks_baseline.json if no file is given
+# python benchmarks.py slicing
+#     compares the legacy section slicing with indexed Section views
+# python benchmarks.py streaming
+#     compares reading whole pages with streaming them up to the end of a section
+# python benchmarks.py backends
+#     compares the startup time and per-page parse time of the Beautiful Soup and lxml backends
+# python benchmarks.py farm [--workers 1 2 4 8]
+#     measures how the parse farm's throughput scales with its number of worker processes
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from urllib.parse import unquote
+from bs4 import BeautifulSoup, Comment
+import parse_farm
+import transport
+import webscraper as ws
+
+TEST_PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_pages")
+# Suite results of the built in corpus with the bs4 backend, that --baseline compares to by default
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks_baseline.json")
+
+
+def synthetic_page(languages, senses=None, path=os.path.join(TEST_PAGES, "bath.html")):
+    """
+    Builds a large multi-language page by repeating the English section of a saved page
+    :param languages: Number of language sections on the page
+    :param senses: Number of definitions in each section, the saved page's own definitions if None
+    :param path: Saved page whose layout and English section are copied
+    :return: html (string) of the page, with sections named "Language 1", "Language 2", ...
+    """
+    with open(path, encoding="utf-8") as f:
+        html = f.read()
+    start = html.index('<h2><span class="mw-headline" id="English">')
+    end = html.index("<hr>", start) + len("<hr>\n")
+    footer = html.index("</div>\n<!-- NewPP")
+    english = html[start:end]
+    if senses is not None:
+        # Repeat the saved definitions, numbering the copies so they aren't removed as duplicates
+        ol_start = english.index("<ol>") + len("<ol>")
+        ol_end = english.index("</ol>")
+        # Every definition starts on a new line, nested lists don't
+        items = english[ol_start:ol_end].strip()[len("<li>"):].split("\n<li>")
+        repeated = []
+        for i in range(senses):
+            repeated.append("<li>(" + str(i) + ") " + items[i % len(items)] + "\n")
+        english = english[:ol_start] + "".join(repeated) + english[ol_end:]
+
+    sections = []
+    for i in range(1, languages + 1):
+        name = "Language " + str(i)
+        sections.append(english.replace('id="English">English<', 'id="' + name.replace(" ", "_") + '">' + name + "<"))
+    return html[:start] + "".join(sections) + html[footer:]
+
+
+def legacy_section_soup(soup, sections, language):
+    """
+    The section slicing return_section_soup used before sections were indexed: every element between the
+    language's h2 and the next one is serialized into a string which is then parsed again.
+    """
+    if language not in sections:
+        return None
+
+    if sections.index(language) == len(sections) - 1:
+        cache_comment = soup.find_all(string=lambda text: isinstance(text, Comment))[1]
+        for section in soup.find_all("span", class_="mw-headline"):
+            if section.parent.name == "h2" and section.text == language:
+                first_section_html = section.parent
+        end = cache_comment
+    else:
+        next_section = sections[sections.index(language) + 1]
+        for section in soup.find_all("span", class_="mw-headline"):
+            if section.parent.name == "h2" and section.text == language:
+                first_section_html = section.parent
+        for section in soup.find_all("span", class_="mw-headline"):
+            if section.parent.name == "h2" and section.text == next_section:
+                end = section.parent
+
+    new_html = ""
+    for line in ws.between(first_section_html.next_sibling, end):
+        new_html += str(line)
+    return BeautifulSoup(new_html, "lxml")
+
+
+def time_call(function, repeat):
+    """
+    :return: The fastest of repeat runs of function, in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def corpus(path=None):
+    """
+    Returns the pages the suite is timed on. The built in corpus has a small page and a Reconstruction: page, both
+    saved from Wiktionary, and a page with many languages and a huge page with thousands of definitions, which are
+    synthetic: they repeat the English section of the small page (see synthetic_page), so they measure how the
+    scraper scales with the number of sections and definitions rather than how it does on real long pages. Pages
+    saved by transport.DirectoryTransport (e.g. by running the tests with WIKTIONARY_PAGES and WIKTIONARY_RECORD)
+    can be added from a directory.
+    :param path: Directory of saved pages to add to the corpus, or None
+    :return: A list of (name, url, html, language) tuples where language is the section the extractors read
+    """
+    def read(name):
+        with open(os.path.join(TEST_PAGES, name), encoding="utf-8") as f:
+            return f.read()
+
+    pages = [
+        ("small", "https://en.wiktionary.org/wiki/bath", read("bath.html"), "English"),
+        ("reconstruction", "https://en.wiktionary.org/wiki/Reconstruction:Proto-Germanic/baþą",
+         read("proto_germanic_batha.html"), "Proto-Germanic"),
+        ("many-languages", "https://en.wiktionary.org/wiki/many", synthetic_page(150), "Language 75"),
+        ("huge", "https://en.wiktionary.org/wiki/huge", synthetic_page(3, senses=2000), "Language 2"),
+    ]
+    if path is not None:
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".html"):
+                with open(os.path.join(path, name), encoding="utf-8") as f:
+                    html = f.read()
+                url = "https://" + unquote(name[:-len(".html")])
+                languages = ws.WiktionaryPage(url, html=html).languages
+                if languages:
+                    pages.append((name[:-len(".html")], url, html, languages[0]))
+    return pages
+
+
+def _remove_inner_tags_calls(url, html, language):
+    # Every definition <li> of the section is one call of remove_inner_tags, which works on Beautiful Soup tags
+    # whichever backend is set
+    section = ws.index_sections(BeautifulSoup(html, "lxml"))[language]
+    items = [li for ol in section.find_all("ol") for li in ol.find_all("li")]
+    return lambda: [ws.remove_inner_tags("<dl>", "</dl>", li) for li in items], len(items)
+
+
+# The functions the suite times. Each takes (url, language) and runs on pages served by a FakeTransport.
+SUITE = {
+    "languages_on_page": lambda url, language: ws.languages_on_page(url),
+    "return_section_soup": ws.return_section_soup,
+    "get_wiki_definition": ws.get_wiki_definition,
+    "get_wiki_pronunciation": ws.get_wiki_pronunciation,
+    "get_wiki_etymology": ws.get_wiki_etymology,
+}
+
+
+def percentile(sorted_values, point):
+    return sorted_values[min(len(sorted_values) - 1, len(sorted_values) * point // 100)]
+
+
+def peak_memory(function):
+    """
+    :return: The most memory in bytes allocated at once while function ran
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_suite(pages, repeat=10, functions=None):
+    """
+    Times the webscraper functions on each page. Every function is run repeat times after a warm up call, and once
+    more under tracemalloc to measure its peak memory.
+    :param pages: A list of (name, url, html, language) tuples, see corpus
+    :param repeat: Timed runs per function and page
+    :param functions: Names of the functions to time, everything in SUITE and remove_inner_tags if None
+    :return: A dictionary keyed by "function/page" of dictionaries with calls_per_second, p50_ms, p99_ms and
+             peak_kb
+    """
+    functions = functions or list(SUITE) + ["remove_inner_tags"]
+    fake = transport.FakeTransport({url: html for name, url, html, language in pages})
+    old_transport = ws.set_transport(fake)
+    results = {}
+    try:
+        for name, url, html, language in pages:
+            for function in functions:
+                if function == "remove_inner_tags":
+                    call, calls = _remove_inner_tags_calls(url, html, language)
+                else:
+                    call, calls = (lambda f=SUITE[function]: f(url, language)), 1
+                if calls == 0:
+                    continue
+
+                call()
+                latencies = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    call()
+                    latencies.append((time.perf_counter() - start) / calls)
+                latencies.sort()
+
+                peak = peak_memory(call)
+
+                results[function + "/" + name] = {
+                    "calls_per_second": len(latencies) / sum(latencies),
+                    "p50_ms": percentile(latencies, 50) * 1000,
+                    "p99_ms": percentile(latencies, 99) * 1000,
+                    "peak_kb": peak / 1024,
+                }
+    finally:
+        ws.set_transport(old_transport)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.25, noise_ms=0.5):
+    """
+    Finds the benchmarks whose median latency regressed against a baseline
+    :param results: Results of run_suite
+    :param baseline: Results of an earlier run_suite, e.g. loaded from a file written with --save-baseline
+    :param tolerance: Fraction a median may grow by before it counts as a regression
+    :param noise_ms: Changes smaller than this many milliseconds are ignored
+    :return: A list of (benchmark, baseline p50_ms, new p50_ms) tuples for the regressions
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old = baseline[key]["p50_ms"]
+        new = result["p50_ms"]
+        if new > old * (1 + tolerance) and new - old > noise_ms:
+            regressions.append((key, old, new))
+    return regressions
+
+
+def print_suite(results):
+    print("%-45s %12s %10s %10s %10s" % ("benchmark", "calls/s", "p50 ms", "p99 ms", "peak kB"))
+    for key, result in results.items():
+        print("%-45s %12.1f %10.3f %10.3f %10.1f" % (key, result["calls_per_second"], result["p50_ms"],
+                                                      result["p99_ms"], result["peak_kb"]))
+
+
+def bench_slicing(language_counts, repeat):
+    """
+    Compares the legacy re-serialize/re-parse slicing with indexed Section views. Both sides look up the
+    first, middle and last language of a parsed page and then search the section for its headlines, which is
+    what every extractor does first.
+    """
+    print("languages  page size   legacy slicing   indexed sections   speedup")
+    for count in language_counts:
+        html = synthetic_page(count)
+        soup = BeautifulSoup(html, "lxml")
+        names = [section.text for section in soup.find_all("span", class_="mw-headline")
+                 if section.parent.name == "h2"]
+        targets = [names[0], names[len(names) // 2], names[-1]]
+
+        def legacy():
+            for target in targets:
+                legacy_section_soup(soup, names, target).find_all("span", class_="mw-headline")
+
+        def indexed():
+            sections = ws.index_sections(soup)
+            for target in targets:
+                sections[target].find_all("span", class_="mw-headline")
+
+        old = time_call(legacy, repeat)
+        new = time_call(indexed, repeat)
+        print("%9d  %8dkB  %14.2fms  %16.2fms  %7.1fx" % (count, len(html) // 1024, old * 1000, new * 1000, old / new))
+
+
+def bench_streaming(repeat):
+    """
+    Compares get_wiki_definition on whole pages with streamed pages, for the first, middle and last language of
+    the many-language and huge pages of the corpus
+    """
+    pages = [page for page in corpus() if page[0] in ("many-languages", "huge")]
+    fake = transport.FakeTransport({url: html for name, url, html, language in pages})
+    old_transport = ws.set_transport(fake)
+    print("page             language        page kB   read kB      whole ms   streamed ms   whole kB   streamed kB")
+    try:
+        for name, url, html, language in pages:
+            languages = ws.WiktionaryPage(url, html=html).languages
+            for language in (languages[0], languages[len(languages) // 2], languages[-1]):
+                results = []
+                for streaming in (False, True):
+                    ws.set_streaming(streaming)
+                    results.append((time_call(lambda: ws.get_wiki_definition(url, language), repeat),
+                                    peak_memory(lambda: ws.get_wiki_definition(url, language))))
+                read, _, _ = ws.read_section(fake.stream(url).chunks, language)
+                print("%-16s %-14s %8d %9d %13.2f %13.2f %10d %13d" % (
+                    name, language, len(html) // 1024, len(read) // 1024, results[0][0] * 1000,
+                    results[1][0] * 1000, results[0][1] // 1024, results[1][1] // 1024))
+    finally:
+        ws.set_streaming(False)
+        ws.set_transport(old_transport)
+
+
+# Run in a new process by startup_times: imports the webscraper, then reads the small page of the corpus
+_STARTUP = """
+import sys, time
+start = time.perf_counter()
+import webscraper as ws
+imported = time.perf_counter()
+ws.set_backend(sys.argv[1])
+with open(sys.argv[2], encoding="utf-8") as f:
+    page = ws.WiktionaryPage("https://en.wiktionary.org/wiki/bath", html=f.read())
+page.definition("English")
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def startup_times(backend, runs=5):
+    """
+    Times new processes importing the webscraper and parsing their first page, which includes importing
+    the parser the backend needs
+    :param backend: "bs4" or "lxml", see webscraper.set_backend
+    :param runs: Number of processes started, the medians are reported
+    :return: A tuple (import seconds, first page seconds, process seconds)
+    """
+    imports, first_pages, processes = [], [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", _STARTUP, backend, os.path.join(TEST_PAGES, "bath.html")],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        processes.append(time.perf_counter() - start)
+        imported, first_page = output.split()
+        imports.append(float(imported))
+        first_pages.append(float(first_page))
+    return statistics.median(imports), statistics.median(first_pages), statistics.median(processes)
+
+
+def bench_backends(repeat, runs):
+    """
+    Compares the two backends: how long a new process takes to import the webscraper and read its first page, and
+    how long parsing each page of the corpus and extracting its definition, pronunciation and etymology takes
+    """
+    print("backend   import ms   first page ms   process ms")
+    for backend in ("bs4", "lxml"):
+        imported, first_page, process = startup_times(backend, runs)
+        print("%-7s %11.1f %15.1f %12.1f" % (backend, imported * 1000, first_page * 1000, process * 1000))
+
+    print("\npage             page kB    bs4 parse ms   lxml parse ms   bs4 extract ms   lxml extract ms")
+    old_backend = ws.get_backend()
+    try:
+        for name, url, html, language in corpus():
+            times = []
+            for backend in ("bs4", "lxml"):
+                ws.set_backend(backend)
+                page = ws.WiktionaryPage(url, html=html)
+                times.append(time_call(lambda: ws.WiktionaryPage(url, html=html), repeat))
+                times.append(time_call(lambda: (page.definition(language), page.pronunciation(language),
+                                                page.etymology(language)), repeat))
+            print("%-16s %7d %15.2f %15.2f %16.2f %17.2f" % (name, len(html) // 1024, times[0] * 1000,
+                                                              times[2] * 1000, times[1] * 1000, times[3] * 1000))
+    finally:
+        ws.set_backend(old_backend)
+
+
+def bench_farm(worker_counts, pages, chunk_size, backend=None, path=None):
+    """
+    Extracts the corpus (repeated up to pages pages) in this process and on parse farms of each size, and reports
+    the throughput, the speedup over this process and the speedup per worker
+    """
+    corpus_pages = [(url, html, [language]) for name, url, html, language in corpus(path) if name != "huge"]
+    items = [corpus_pages[i % len(corpus_pages)] for i in range(pages)]
+    old_backend = ws.get_backend()
+    if backend is not None:
+        ws.set_backend(backend)
+    try:
+        start = time.perf_counter()
+        for url, html, languages in items:
+            parse_farm.extract_page(url, html, languages)
+        serial = time.perf_counter() - start
+    finally:
+        ws.set_backend(old_backend)
+
+    print("Extracting %d pages (%d kB), %d CPUs" % (len(items), sum(len(html) for _, html, _ in items) // 1024,
+                                                   os.cpu_count()))
+    print("workers   seconds    pages/s   speedup   per worker")
+    print("%7s %9.2f %10.1f %9.2f %12s" % ("serial", serial, len(items) / serial, 1, "-"))
+    for workers in worker_counts:
+        with parse_farm.ParseFarm(workers, chunk_size, backend) as farm:
+            # Wait until every worker has started and warmed up
+            list(farm.extract(items[:workers]))
+            start = time.perf_counter()
+            for _ in farm.extract(items):
+                pass
+            elapsed = time.perf_counter() - start
+        print("%7d %9.2f %10.1f %9.2f %12.2f" % (workers, elapsed, len(items) / elapsed, serial / elapsed,
+                                                 serial / elapsed / workers))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the Wiktionary webscraper")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    suite = commands.add_parser("suite", help="time each webscraper function on the page corpus")
+    suite.add_argument("--corpus", help="directory of saved pages to add to the built in corpus")
+    suite.add_argument("--repeat", type=int, default=10, help="timed runs of each function on each page")
+    suite.add_argument("--functions", nargs="+", help="only time these functions")
+    suite.add_argument("--pages", nargs="+", help="only time on these pages of the corpus, e.g. small huge")
+    suite.add_argument("--baseline", nargs="?", const=BASELINE, help="fail if a median latency regressed against "
+                       "this saved run (default: " + os.path.basename(BASELINE) + ")")
+    suite.add_argument("--tolerance", type=float, default=0.25, help="allowed growth of a median, as a fraction")
+    suite.add_argument("--save-baseline", help="save this run's results as a baseline")
+    suite.add_argument("--backend", choices=["bs4", "lxml"], help="parse pages with this backend")
+
+    slicing = commands.add_parser("slicing", help="compare legacy section slicing with indexed sections")
+    slicing.add_argument("--languages", type=int, nargs="+", default=[5, 50, 200],
+                         help="numbers of language sections on the synthetic pages")
+    slicing.add_argument("--repeat", type=int, default=5, help="runs of each benchmark, the fastest is reported")
+
+    streaming = commands.add_parser("streaming", help="compare reading whole pages with streaming them")
+    streaming.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, the fastest is reported")
+
+    backends = commands.add_parser("backends", help="compare the startup and parse times of the parser backends")
+    backends.add_argument("--repeat", type=int, default=5, help="runs of each benchmark, the fastest is reported")
+    backends.add_argument("--runs", type=int, default=5, help="processes started to time startup")
+
+    farm = commands.add_parser("farm", help="measure how the parse farm scales with its number of workers")
+    farm.add_argument("--workers", type=int, nargs="+", help="worker counts to measure (default: 1, 2, 4, ... up "
+                      "to the number of CPUs)")
+    farm.add_argument("--pages", type=int, default=200, help="pages extracted by each run")
+    farm.add_argument("--chunk-size", type=int, default=4, help="pages sent to a worker at a time")
+    farm.add_argument("--backend", choices=["bs4", "lxml"], help="parser the workers use")
+    farm.add_argument("--corpus", help="directory of saved pages to add to the built in corpus")
+    args = parser.parse_args()
+
+    if args.command == "slicing":
+        bench_slicing(args.languages, args.repeat)
+    elif args.command == "streaming":
+        bench_streaming(args.repeat)
+    elif args.command == "backends":
+        bench_backends(args.repeat, args.runs)
+    elif args.command == "farm":
+        worker_counts = args.workers
+        if worker_counts is None:
+            worker_counts = [1]
+            while worker_counts[-1] * 2 <= os.cpu_count():
+                worker_counts.append(worker_counts[-1] * 2)
+        bench_farm(worker_counts, args.pages, args.chunk_size, args.backend, args.corpus)
+    else:
+        if args.backend:
+            ws.set_backend(args.backend)
+        pages = corpus(args.corpus)
+        if args.pages:
+            pages = [page for page in pages if page[0] in args.pages]
+        results = run_suite(pages, args.repeat, args.functions)
+        print_suite(results)
+        if args.save_baseline:
+            with open(args.save_baseline, "w") as f:
+                json.dump(results, f, indent=1)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+            for key, old, new in regressions:
+                print("REGRESSION %s: p50 %.3fms -> %.3fms" % (key, old, new))
+            if regressions:
+                sys.exit(1)
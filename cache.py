@@ -0,0 +1,344 @@
+# On-disk cache for downloaded Wiktionary pages and extracted lookup results
+import hashlib
+import json
+import math
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+from urllib.parse import urlsplit, unquote
+
+
+# A page read back from the cache. fresh is False once the entry is older than the cache's ttl.
+CachedPage = namedtuple("CachedPage", ["status", "html", "etag", "last_modified", "fresh"])
+
+
+class OfflineMiss(LookupError):
+    """
+    Raised when the cache is in offline mode and a url that was never downloaded is requested
+    """
+
+
+def normalize_url(url):
+    """
+    Returns the cache key of a url. The fragment is dropped and percent escapes are decoded so that
+    "https://en.wiktionary.org/wiki/b%C3%A6%C3%BE#Old_English" and "https://en.wiktionary.org/wiki/bæþ" share a key.
+    :param url: A Wiktionary url
+    :return: The normalized url (string)
+    """
+    parts = urlsplit(url)
+    key = parts.scheme.lower() + "://" + parts.netloc.lower() + unquote(parts.path)
+    if parts.query:
+        key += "?" + parts.query
+    return key
+
+
+class BloomFilter:
+    """
+    Set of strings that answers "maybe present" or "definitely absent" from a fixed number of bits. Strings can't
+    be removed, and a string that was never added is reported present with probability error_rate once capacity
+    strings have been added.
+    """
+    _HEADER = struct.Struct("<QQI")
+
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        """
+        :param capacity: Number of strings the filter is sized for
+        :param error_rate: False positive rate at capacity
+        """
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        # Number of strings added
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: position i is h1 + i * h2, from one 128 bit digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def to_bytes(self):
+        """
+        :return: bytes that BloomFilter.from_bytes turns back into the same filter
+        """
+        return self._HEADER.pack(self.size, self.count, self.hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        size, count, hashes = cls._HEADER.unpack_from(data)
+        bloom = cls.__new__(cls)
+        bloom.capacity = int(round(size * math.log(2) / max(hashes, 1)))
+        bloom.size = size
+        bloom.hashes = hashes
+        bloom.bits = bytearray(data[cls._HEADER.size:])
+        bloom.count = count
+        return bloom
+
+
+def _found(result):
+    # Whether a lookup result found its language's section, rather than the page or the section being missing
+    return result["exists"] and result["language"] in result["languages"]
+
+
+class Cache:
+    """
+    SQLite backed cache with two levels. The first stores compressed page html by normalized url along with
+    the ETag and Last-Modified validators needed to revalidate it. The second stores the final lookup results
+    by (word, language) so a hit doesn't need the page at all. Entries expire after ttl seconds and the least
+    recently used ones are evicted once the cache grows past max_bytes. Misses, i.e. error pages and results for
+    pages or languages that don't exist, expire after negative_ttl seconds instead.
+
+    Alongside them a negative cache remembers which pages don't exist and which languages the pages that do
+    exist have, so misses can be answered without the page. Its entries expire after negative_ttl seconds and the
+    oldest are evicted once it holds more than max_known_pages urls, and a bloom filter in front of it keeps lookups
+    of urls it has never seen from querying the database.
+    """
+    def __init__(self, path, ttl=7 * 24 * 60 * 60, max_bytes=256 * 1024 * 1024, offline=False,
+                 negative_ttl=24 * 60 * 60, filter_capacity=1000000, max_known_pages=1000000):
+        """
+        :param path: File the cache is kept in, ":memory:" for a cache that isn't saved
+        :param ttl: Number of seconds an entry stays fresh
+        :param max_bytes: Size the stored entries are evicted down to
+        :param offline: If True pages are only ever served from the cache, stale or not
+        :param negative_ttl: Number of seconds the negative cache's entries, error pages and results of lookups
+                             that found nothing stay fresh
+        :param filter_capacity: Number of urls the negative cache's bloom filter is sized for
+        :param max_known_pages: Most urls the negative cache holds. Expired entries are purged once it is full, and
+                                then the oldest ones until it is a tenth below this.
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.negative_ttl = negative_ttl
+        self.max_known_pages = max_known_pages
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "revalidated": 0, "evictions": 0,
+                      "result_hits": 0, "result_misses": 0, "negative_hits": 0, "filter_skips": 0,
+                      "known_page_evictions": 0}
+        # sqlite3 is imported here so that importing this module (e.g. for normalize_url) doesn't load it
+        import sqlite3
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY, status INTEGER, body BLOB, etag TEXT, last_modified TEXT,
+                stored REAL, accessed REAL, size INTEGER);
+            CREATE TABLE IF NOT EXISTS results (
+                word TEXT, language TEXT, body BLOB, stored REAL, accessed REAL, size INTEGER,
+                PRIMARY KEY (word, language));
+            CREATE TABLE IF NOT EXISTS known_pages (url TEXT PRIMARY KEY, page_exists INTEGER, languages TEXT, stored REAL);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB);
+        """)
+        self._size = self._db.execute(
+            "SELECT (SELECT COALESCE(SUM(size), 0) FROM pages) + (SELECT COALESCE(SUM(size), 0) FROM results)"
+        ).fetchone()[0]
+        self._known_pages = self._db.execute("SELECT COUNT(*) FROM known_pages").fetchone()[0]
+        self._filter = self._load_filter(filter_capacity)
+
+    def get_page(self, url):
+        """
+        Reads a page from the cache
+        :param url: A Wiktionary url
+        :return: A CachedPage, None if the url isn't cached
+        """
+        key = normalize_url(url)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT status, body, etag, last_modified, stored FROM pages WHERE url = ?",
+                                   (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self._db.execute("UPDATE pages SET accessed = ? WHERE url = ?", (now, key))
+            self._db.commit()
+            fresh = now - row[4] < (self.ttl if row[0] < 400 else self.negative_ttl)
+            self.stats["hits" if fresh else "stale"] += 1
+        return CachedPage(row[0], zlib.decompress(row[1]).decode("utf-8"), row[2], row[3], fresh)
+
+    def put_page(self, url, status, html, etag=None, last_modified=None):
+        """
+        Stores a downloaded page
+        :param url: A Wiktionary url
+        :param status: HTTP status code of the response
+        :param html: The page's html
+        :param etag: The response's ETag header, if it had one
+        :param last_modified: The response's Last-Modified header, if it had one
+        """
+        body = zlib.compress(html.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM pages WHERE url = ?", (normalize_url(url),)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (normalize_url(url), status, body, etag, last_modified, now, now, len(body)))
+            self._size += len(body) - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+
+    def revalidated(self, url):
+        """
+        Marks a stale page as fresh again after the server answered a conditional request with 304 Not Modified
+        :param url: A Wiktionary url
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("UPDATE pages SET stored = ?, accessed = ? WHERE url = ?", (now, now, normalize_url(url)))
+            self._db.commit()
+            self.stats["revalidated"] += 1
+
+    def get_result(self, word, language):
+        """
+        Reads the extracted results of a lookup, see webscraper.lookup. Results that found nothing expire after
+        negative_ttl rather than ttl.
+        :return: The result dictionary, None if it isn't cached or has expired
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT body, stored FROM results WHERE word = ? AND language = ?",
+                                   (word, language)).fetchone()
+            result = None
+            if row is not None:
+                result = json.loads(zlib.decompress(row[0]).decode("utf-8"))
+                ttl = self.ttl if _found(result) else self.negative_ttl
+                if now - row[1] >= ttl and not self.offline:
+                    result = None
+            if result is None:
+                self.stats["result_misses"] += 1
+                return None
+            self._db.execute("UPDATE results SET accessed = ? WHERE word = ? AND language = ?", (now, word, language))
+            self._db.commit()
+            self.stats["result_hits"] += 1
+        return result
+
+    def put_result(self, word, language, result):
+        """
+        Stores the extracted results of a lookup
+        :param result: A result dictionary made of strings, lists and booleans
+        """
+        body = zlib.compress(json.dumps(result, ensure_ascii=False).encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM results WHERE word = ? AND language = ?",
+                                   (word, language)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                             (word, language, body, now, now, len(body)))
+            self._size += len(body) - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+
+    def get_known_page(self, url):
+        """
+        Reads what the negative cache knows about a page
+        :param url: A Wiktionary url
+        :return: None if nothing fresh is known, an (exists, languages) tuple otherwise where languages are the
+                 names of the page's language sections
+        """
+        key = normalize_url(url)
+        if key not in self._filter:
+            with self._lock:
+                self.stats["filter_skips"] += 1
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT page_exists, languages, stored FROM known_pages WHERE url = ?",
+                                   (key,)).fetchone()
+            if row is None or (time.time() - row[2] >= self.negative_ttl and not self.offline):
+                return None
+            self.stats["negative_hits"] += 1
+        return bool(row[0]), json.loads(row[1])
+
+    def put_known_page(self, url, exists, languages):
+        """
+        Records whether a page exists and which languages it has
+        :param url: A Wiktionary url
+        :param exists: False if the page doesn't exist
+        :param languages: Names of the page's language sections
+        """
+        key = normalize_url(url)
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM known_pages WHERE url = ?", (key,)).fetchone() is None:
+                self._known_pages += 1
+            self._db.execute("INSERT OR REPLACE INTO known_pages VALUES (?, ?, ?, ?)",
+                             (key, int(exists), json.dumps(languages, ensure_ascii=False), time.time()))
+            if self._known_pages > self.max_known_pages:
+                self._evict_known_pages()
+            self._db.commit()
+            if key not in self._filter:
+                self._filter.add(key)
+
+    def _evict_known_pages(self):
+        # Purges the expired known pages, then the oldest ones until there's room for a tenth of max_known_pages
+        # more. Evicted urls stay in the bloom filter, which only costs their lookups a query. Must be called with
+        # the lock held.
+        if not self.offline:
+            # Offline caches still answer from expired entries, see get_known_page
+            self._db.execute("DELETE FROM known_pages WHERE stored < ?", (time.time() - self.negative_ttl,))
+        excess = self._db.execute("SELECT COUNT(*) FROM known_pages").fetchone()[0] - self.max_known_pages * 9 // 10
+        if excess > 0:
+            self._db.execute("DELETE FROM known_pages WHERE url IN "
+                             "(SELECT url FROM known_pages ORDER BY stored LIMIT ?)", (excess,))
+        known = self._db.execute("SELECT COUNT(*) FROM known_pages").fetchone()[0]
+        self.stats["known_page_evictions"] += self._known_pages - known
+        self._known_pages = known
+
+    def save_filter(self):
+        """
+        Saves the bloom filter so the next run doesn't have to rebuild it. close calls this.
+        """
+        with self._lock:
+            # The filter's own count misses urls that were false positives when they were added, so the table's
+            # row count is saved to tell whether the filter is up to date
+            rows = self._db.execute("SELECT COUNT(*) FROM known_pages").fetchone()[0]
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('known_pages_filter', ?)", (self._filter.to_bytes(),))
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('known_pages_filter_rows', ?)", (rows,))
+            self._db.commit()
+
+    def _load_filter(self, capacity):
+        # The saved filter, or a new one built from the known pages if it wasn't saved after the last changes
+        known = self._db.execute("SELECT COUNT(*) FROM known_pages").fetchone()[0]
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'known_pages_filter'").fetchone()
+        rows = self._db.execute("SELECT value FROM meta WHERE key = 'known_pages_filter_rows'").fetchone()
+        if row is not None and rows is not None and rows[0] == known:
+            return BloomFilter.from_bytes(row[0])
+        bloom = BloomFilter(max(capacity, known))
+        for (url,) in self._db.execute("SELECT url FROM known_pages"):
+            bloom.add(url)
+        return bloom
+
+    def size(self):
+        """
+        :return: Total number of compressed bytes stored in the cache
+        """
+        return self._size
+
+    def close(self):
+        self.save_filter()
+        self._db.close()
+
+    def _evict(self):
+        # Least recently used entries of either level go first. Must be called with the lock held.
+        while self._size > self.max_bytes:
+            victims = self._db.execute(
+                "SELECT 'pages', url, NULL, size, accessed FROM pages "
+                "UNION ALL SELECT 'results', word, language, size, accessed FROM results "
+                "ORDER BY accessed LIMIT 32").fetchall()
+            if not victims:
+                self._size = 0
+                return
+            for table, key, language, size, accessed in victims:
+                if table == "pages":
+                    self._db.execute("DELETE FROM pages WHERE url = ?", (key,))
+                else:
+                    self._db.execute("DELETE FROM results WHERE word = ? AND language = ?", (key, language))
+                self._size -= size
+                self.stats["evictions"] += 1
+                if self._size <= self.max_bytes:
+                    return
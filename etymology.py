@@ -0,0 +1,130 @@
+# Builds etymology graphs by following the links in Wiktionary etymologies and descendant lists
+#
+# Usage: python etymology.py WORD LANGUAGE [--depth N] [--fanout N] [--format json|graphml]
+import argparse
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import cache
+import structures
+import webscraper as ws
+
+
+def node_key(word, language):
+    """
+    Normalizes a word and language into the key of a graph node, so the same word reached through links
+    written differently is only visited once
+    :return: A (word, language) tuple
+    """
+    return " ".join(word.replace("_", " ").split()), " ".join(language.replace("_", " ").split())
+
+
+def page_links(url, ancestors=True, descendants=True):
+    """
+    Fetches and parses a page and keeps only the links the crawl follows, so its parsed tree can be freed
+    :param url: A Wiktionary url
+    :param ancestors: Extract the words each section's etymology derives from
+    :param descendants: Extract the words listed under each section's Descendants heading
+    :return: A dictionary of the page's language names to (etymology links, descendant links) tuples of
+             (word, language, url) tuples, empty if the page doesn't exist
+    """
+    page = ws.WiktionaryPage(url)
+    if not page.exists:
+        return {}
+    return {language: (page.etymology_links(language) if ancestors else [],
+                       page.descendant_links(language) if descendants else [])
+            for language in page.languages}
+
+
+def crawl(word, language, max_depth=3, max_fanout=10, workers=8, ancestors=True, descendants=True):
+    """
+    Builds the ancestry and descendants of a word by crawling Wiktionary. Pages waiting to be fetched are kept in
+    a frontier ordered by depth and fetched in parallel. Every page is fetched at most once, even when several
+    of the words on it are in the graph, and words that were already reached aren't followed again so cycles
+    between etymologies end the crawl instead of looping. Only the links of the fetched pages are kept, not the
+    parsed pages, so memory doesn't grow with the size of their trees.
+    :param word: The word to start from
+    :param language: Name of the word's language
+    :param max_depth: Most links followed away from the word
+    :param max_fanout: Most ancestors and most descendants followed from each word
+    :param workers: Number of pages fetched at the same time
+    :param ancestors: Follow the words each etymology derives from
+    :param descendants: Follow the words listed under each Descendants heading
+    :return: A structures.EtymologyGraph. Nodes have url, depth and red_link attributes, and a found attribute
+             that is True if the word's page and section exist (missing for nodes that weren't fetched).
+    """
+    graph = structures.EtymologyGraph()
+    url = ws.wiki_url(word, language)
+    root_word, root_language, _ = ws.parse_wiki_link(url[len("https://en.wiktionary.org"):], language)
+    root = node_key(root_word, root_language)
+    graph.add_node(root, url=url, depth=0, red_link=False)
+
+    visited = {root}
+    order = itertools.count()
+    frontier = [(0, next(order), root, url, "both")]
+    # Futures of the page_links of every page fetched so far, by normalized url
+    pages = {}
+    in_flight = {}
+
+    def visit(node, link_url, depth, direction):
+        if node in visited:
+            return
+        visited.add(node)
+        red_link = ws.is_red_link(link_url)
+        graph.add_node(node, url=link_url, depth=depth, red_link=red_link)
+        # Red links point to entries that haven't been written, so there's nothing to fetch
+        if not red_link:
+            heapq.heappush(frontier, (depth, next(order), node, link_url, direction))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while frontier or in_flight:
+            while frontier and len(in_flight) < workers:
+                depth, _, node, node_url, direction = heapq.heappop(frontier)
+                page_key = cache.normalize_url(node_url)
+                if page_key not in pages:
+                    pages[page_key] = executor.submit(page_links, node_url, ancestors, descendants)
+                in_flight[node] = (pages[page_key], depth, direction)
+
+            done, _ = wait({future for future, _, _ in in_flight.values()}, return_when=FIRST_COMPLETED)
+            for node in [node for node, (future, _, _) in in_flight.items() if future in done]:
+                future, depth, direction = in_flight.pop(node)
+                try:
+                    links = future.result()
+                except Exception as e:
+                    graph.add_node(node, found=False, error=type(e).__name__ + ": " + str(e))
+                    continue
+
+                found = node[1] in links
+                graph.add_node(node, found=found)
+                if not found or depth >= max_depth:
+                    continue
+
+                etymology_links, descendant_links = links[node[1]]
+                if ancestors and direction in ("both", "ancestors"):
+                    for link_word, link_language, link_url in etymology_links[:max_fanout]:
+                        if link_language is None:
+                            continue
+                        ancestor = node_key(link_word, link_language)
+                        graph.add_edge(node, ancestor)
+                        visit(ancestor, link_url, depth + 1, "ancestors")
+                if descendants and direction in ("both", "descendants"):
+                    for link_word, link_language, link_url in descendant_links[:max_fanout]:
+                        if link_language is None:
+                            continue
+                        descendant = node_key(link_word, link_language)
+                        graph.add_edge(descendant, node)
+                        visit(descendant, link_url, depth + 1, "descendants")
+    return graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the etymology graph of a word from Wiktionary")
+    parser.add_argument("word")
+    parser.add_argument("language")
+    parser.add_argument("--depth", type=int, default=3, help="most links followed away from the word")
+    parser.add_argument("--fanout", type=int, default=10, help="most ancestors and descendants followed per word")
+    parser.add_argument("--workers", type=int, default=8, help="pages fetched at the same time")
+    parser.add_argument("--format", choices=["json", "graphml"], default="json")
+    args = parser.parse_args()
+    result = crawl(args.word, args.language, args.depth, args.fanout, args.workers)
+    print(result.to_json() if args.format == "json" else result.to_graphml())
@@ -0,0 +1,159 @@
+# Fills a local store.Store from a Wiktionary dump so lookups don't need the live site
+#
+# Usage: python ingest.py DUMP STORE [--processes N]
+#
+# The extractors in webscraper.py work on rendered html, so only html dumps are supported: the Wikimedia html
+# dumps (.ndjson/.jsonl) with one JSON object per page, holding "name", "article_body.html" and
+# "version.identifier". The MediaWiki XML exports (pages-articles.xml and the like) hold wikitext, which the
+# extractors can't read; read_xml_dump only reads XML in the export layout whose <text> elements were filled with
+# rendered html, like test_pages/dump.xml. Either can be compressed with bz2 (.bz2) or gzip (.gz).
+import argparse
+import bz2
+import gzip
+import json
+import os
+import sys
+import xml.etree.ElementTree as ET
+import parse_farm
+import store
+
+
+def open_dump(path):
+    """
+    Opens a dump for reading in binary mode, decompressing it on the fly if needed
+    """
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _local_name(tag):
+    # Export files put every element in the MediaWiki namespace, e.g. {http://www.mediawiki.org/xml/export-0.10/}page
+    return tag.rsplit("}", 1)[-1]
+
+
+def read_xml_dump(f):
+    """
+    Streams the pages of an XML dump in the MediaWiki export layout whose <text> elements hold rendered html (see
+    the top of this file). Each page's elements are freed once it has been read so memory use doesn't grow with
+    the size of the dump.
+    :param f: A binary file object
+    :return: A generator of (title, html, revision) tuples
+    """
+    root = None
+    title = revision = text = None
+    for event, elem in ET.iterparse(f, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event != "end":
+            continue
+        name = _local_name(elem.tag)
+        if name == "title":
+            title = elem.text
+        elif name == "revision":
+            for child in elem:
+                if _local_name(child.tag) == "id":
+                    revision = child.text
+                elif _local_name(child.tag) == "text":
+                    text = child.text
+        elif name == "page":
+            yield title, text or "", revision
+            title = revision = text = None
+            root.clear()
+
+
+def read_ndjson_dump(f):
+    """
+    Streams the pages of a Wikimedia html dump with one JSON object per line
+    :param f: A binary file object
+    :return: A generator of (title, html, revision) tuples
+    """
+    for line in f:
+        if not line.strip():
+            continue
+        page = json.loads(line)
+        revision = page.get("version", {}).get("identifier")
+        yield page["name"], page.get("article_body", {}).get("html", ""), None if revision is None else str(revision)
+
+
+def read_dump(path):
+    """
+    Streams the pages of a dump, choosing the reader from the file name
+    :param path: Path of an XML or NDJSON dump, optionally ending in .bz2 or .gz
+    :return: A generator of (title, html, revision) tuples
+    """
+    name = path[:-4] if path.endswith(".bz2") else path[:-3] if path.endswith(".gz") else path
+    with open_dump(path) as f:
+        if name.endswith(".ndjson") or name.endswith(".jsonl"):
+            yield from read_ndjson_dump(f)
+        else:
+            yield from read_xml_dump(f)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def ingest(dump_path, local_store, processes=None, batch_size=256, failures=None):
+    """
+    Extracts every page of a dump into a store. Progress is checkpointed in the store after every batch, so
+    running it again on the same dump resumes after the last batch that was saved.
+    :param dump_path: Path of the dump, see read_dump
+    :param local_store: A store.Store
+    :param processes: Number of worker processes, the number of CPUs if None
+    :param batch_size: Pages extracted between checkpoints. Only one batch is held in memory at a time.
+    :param failures: A list that a (title, error) tuple is appended to for every page the extractors raised an
+                     error on. Those pages are skipped, and aren't tried again when the run is resumed.
+    :return: Number of pages extracted by this run
+    """
+    checkpoint_name = "ingest:" + os.path.abspath(dump_path)
+    done = int(local_store.get_checkpoint(checkpoint_name) or 0)
+    extracted = 0
+
+    pages = read_dump(dump_path)
+    # Skip the pages a previous run already saved
+    for _ in range(done):
+        if next(pages, None) is None:
+            return 0
+
+    processes = processes or os.cpu_count()
+    # The pages are handed to the workers through shared memory rather than pickled, see parse_farm.py
+    with parse_farm.ParseFarm(processes, chunk_size=max(1, batch_size // (processes * 4))) as farm:
+        for batch in _batches(pages, batch_size):
+            titles = [title.replace(" ", "_") for title, html, revision in batch]
+            extracted_pages = farm.extract(("https://en.wiktionary.org/wiki/" + title, html, None)
+                                           for title, (_, html, _) in zip(titles, batch))
+            results = []
+            for title, (_, _, revision), (url, languages, entries, error) in zip(titles, batch, extracted_pages):
+                if error is not None:
+                    if failures is not None:
+                        failures.append((title, error))
+                    continue
+                results.append((title, revision, languages, entries))
+            done += len(batch)
+            extracted += len(results)
+            local_store.put_pages(results, checkpoint=(checkpoint_name, done))
+    return extracted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill a local store from a Wiktionary dump")
+    parser.add_argument("dump", help="XML or NDJSON dump of rendered pages, optionally .bz2 or .gz compressed")
+    parser.add_argument("store", help="SQLite file to store the extracted entries in")
+    parser.add_argument("--processes", type=int, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--batch-size", type=int, default=256, help="pages extracted between checkpoints")
+    args = parser.parse_args()
+    failures = []
+    count = ingest(args.dump, store.Store(args.store), args.processes, args.batch_size, failures)
+    for title, error in failures:
+        print("Couldn't extract " + title + ": " + error, file=sys.stderr)
+    print("Extracted", count, "pages into", args.store + ",", len(failures), "failed")
@@ -0,0 +1,265 @@
+# Timers, counters and trace spans for the webscraper pipeline
+#
+# Instrumentation is off until enable is called. While it's off, span returns one shared context manager that does
+# nothing and count returns straight away, so the instrumented code only pays for a function call.
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+
+
+class Span:
+    """
+    One timed stage of a lookup. Spans opened while another span is open become its children, so every lookup
+    is recorded as a tree of the stages it went through.
+    """
+    __slots__ = ("name", "attrs", "start", "duration", "children")
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.duration = None
+        self.children = []
+
+    def walk(self, depth=0):
+        """
+        :return: A generator of (depth, span) tuples of the span and everything under it, depth first
+        """
+        yield depth, self
+        for child in self.children:
+            yield from child.walk(depth + 1)
+
+    def format(self):
+        """
+        :return: The span tree as indented lines of stage names and milliseconds
+        """
+        lines = []
+        for depth, span in self.walk():
+            attrs = "".join(" " + key + "=" + str(value) for key, value in span.attrs.items())
+            lines.append("%s%-*s %9.2fms%s" % ("  " * depth, 30 - 2 * depth, span.name, span.duration * 1000, attrs))
+        return "\n".join(lines)
+
+
+class Recorder:
+    """
+    Collects the spans and counters of everything instrumented while it's enabled
+    """
+    def __init__(self, sinks=(), keep=100):
+        """
+        :param sinks: Sinks told about every lookup's span tree, see LogSink, PrometheusSink and ProfileSink
+        :param keep: Number of finished span trees kept in traces
+        """
+        self.sinks = list(sinks)
+        # Counter name to total
+        self.counters = {}
+        # Span name to [number of spans, total seconds]
+        self.timers = {}
+        # The most recently finished top level spans
+        self.traces = deque(maxlen=keep)
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def _started(self, span):
+        for sink in self.sinks:
+            sink.start(span)
+
+    def _finished(self, span, top_level):
+        with self._lock:
+            timer = self.timers.setdefault(span.name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += span.duration
+            if top_level:
+                self.traces.append(span)
+        if top_level:
+            for sink in self.sinks:
+                sink.finish(span, self)
+
+    def prometheus(self, prefix="webscraper"):
+        """
+        :return: The counters and stage timers in the Prometheus text exposition format
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        lines = []
+        for name, value in counters:
+            lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+            lines.append("%s_%s_total %s" % (prefix, name, value))
+        if timers:
+            lines.append("# TYPE %s_stage_seconds_total counter" % prefix)
+            lines.extend('%s_stage_seconds_total{stage="%s"} %.6f' % (prefix, name, seconds)
+                         for name, (calls, seconds) in timers)
+            lines.append("# TYPE %s_stage_calls_total counter" % prefix)
+            lines.extend('%s_stage_calls_total{stage="%s"} %d' % (prefix, name, calls)
+                         for name, (calls, seconds) in timers)
+        return "\n".join(lines) + "\n"
+
+
+class _NullSpan:
+    # Returned by span while instrumentation is off
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+# The Recorder that spans and counters go to, None while instrumentation is off
+_recorder = None
+
+# The innermost open span of the current thread or asyncio task
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class _ActiveSpan:
+    __slots__ = ("recorder", "span", "parent", "token")
+
+    def __init__(self, recorder, name, attrs):
+        self.recorder = recorder
+        self.span = Span(name, attrs)
+
+    def __enter__(self):
+        self.parent = _current.get()
+        self.token = _current.set(self.span)
+        if self.parent is None:
+            self.recorder._started(self.span)
+        self.span.start = time.perf_counter()
+        return self.span
+
+    def __exit__(self, *exc_info):
+        self.span.duration = time.perf_counter() - self.span.start
+        _current.reset(self.token)
+        if self.parent is not None:
+            self.parent.children.append(self.span)
+        self.recorder._finished(self.span, self.parent is None)
+        return False
+
+
+def enable(sinks=(), recorder=None):
+    """
+    Turns instrumentation on
+    :param sinks: Sinks for a new Recorder
+    :param recorder: A Recorder to use instead of a new one
+    :return: The Recorder spans and counters are collected in
+    """
+    global _recorder
+    _recorder = recorder or Recorder(sinks)
+    return _recorder
+
+
+def disable():
+    """
+    Turns instrumentation off
+    :return: The Recorder that was being used, or None
+    """
+    global _recorder
+    recorder = _recorder
+    _recorder = None
+    return recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+def span(name, **attrs):
+    """
+    Times a stage: with span("parse"): ...
+    :param name: Name of the stage
+    :param attrs: Values recorded with the span, e.g. the word being looked up
+    :return: A context manager that gives the Span, or None while instrumentation is off
+    """
+    if _recorder is None:
+        return _NULL_SPAN
+    return _ActiveSpan(_recorder, name, attrs)
+
+
+def count(name, amount=1):
+    """
+    Adds to a counter, e.g. count("bytes_fetched", len(html))
+    """
+    if _recorder is not None:
+        _recorder.count(name, amount)
+
+
+class Sink:
+    """
+    Interface of the sinks. start and finish are called for top level spans only, finish once the whole tree
+    is recorded.
+    """
+    def start(self, span):
+        pass
+
+    def finish(self, span, recorder):
+        pass
+
+
+class LogSink(Sink):
+    """
+    Logs the span tree of every lookup
+    """
+    def __init__(self, logger=None, level=None):
+        """
+        :param logger: A logging.Logger, the "webscraper" logger if None
+        :param level: Level the spans are logged at, logging.INFO if None
+        """
+        import logging
+        self.logger = logger or logging.getLogger("webscraper")
+        self.level = logging.INFO if level is None else level
+
+    def finish(self, span, recorder):
+        self.logger.log(self.level, "%s", span.format())
+
+
+class PrometheusSink(Sink):
+    """
+    Rewrites a file with Recorder.prometheus after every lookup, for Prometheus' node exporter textfile collector
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def finish(self, span, recorder):
+        with open(self.path + ".tmp", "w") as f:
+            f.write(recorder.prometheus())
+        # Renaming keeps the collector from reading a half written file
+        os.replace(self.path + ".tmp", self.path)
+
+
+class ProfileSink(Sink):
+    """
+    Runs cProfile during every top level span and saves the combined statistics, which can be read with pstats.
+    cProfile profiles the thread it was enabled on, so only the thread the span was opened on is profiled.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: File the pstats data is saved to after every span, None to only keep it in profile
+        """
+        import cProfile
+        self.path = path
+        self.profile = cProfile.Profile()
+        self._lock = threading.Lock()
+        self._owner = None
+
+    def start(self, span):
+        # Only one profiler can run at a time, spans started on other threads meanwhile aren't profiled
+        with self._lock:
+            if self._owner is not None:
+                return
+            self._owner = span
+        self.profile.enable()
+
+    def finish(self, span, recorder):
+        if self._owner is not span:
+            return
+        self.profile.disable()
+        if self.path is not None:
+            self.profile.dump_stats(self.path)
+        with self._lock:
+            self._owner = None
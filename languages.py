@@ -0,0 +1,108 @@
+# Wiktionary language names, codes and aliases, and the rules for which pages a language's words are on
+#
+# The table is read from languages.tsv the first time it's needed and kept as one dictionary from every folded
+# name, alias and code to the language, so resolving a name is a single lookup.
+import os
+import re
+import threading
+from collections import namedtuple
+
+Language = namedtuple("Language", ["code", "name", "reconstructed"])
+
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "languages.tsv")
+
+_table = None
+_table_lock = threading.Lock()
+
+# Characters that can't be in a page title
+_INVALID_TITLE = re.compile(r"[#<>\[\]{}|]")
+
+
+def fold(name):
+    """
+    Folds a language name so that case, underscores, hyphens and extra spaces don't matter,
+    e.g. "proto_indo european" and "Proto-Indo-European" both become "proto indo european"
+    """
+    return " ".join(name.replace("_", " ").replace("-", " ").split()).casefold()
+
+
+def _load():
+    global _table
+    with _table_lock:
+        if _table is None:
+            table = {}
+            with open(TABLE_PATH, encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("#") or not line.strip():
+                        continue
+                    code, name, kind, aliases = line.rstrip("\n").split("\t")
+                    language = Language(code, name, kind == "reconstructed")
+                    for key in [name, code] + [alias for alias in aliases.split(",") if alias]:
+                        table.setdefault(fold(key), language)
+            _table = table
+    return _table
+
+
+def resolve(name):
+    """
+    Finds a language by its name, one of its aliases or its Wiktionary code, ignoring case, underscores and hyphens
+    :param name: E.g. "old english", "Anglo-Saxon" or "ang"
+    :return: A Language, None if the name isn't in the table
+    """
+    return _load().get(fold(name))
+
+
+def canonical_name(name):
+    """
+    :return: The name Wiktionary uses for a language's sections, or name itself if it isn't in the table
+    """
+    language = resolve(name)
+    return name if language is None else language.name
+
+
+def is_reconstructed(name):
+    """
+    :return: True if the language's words are only on Reconstruction: pages. Languages that aren't in the table
+             are reconstructed if their name starts with "Proto-".
+    """
+    language = resolve(name)
+    if language is None:
+        return name.startswith("Proto-")
+    return language.reconstructed
+
+
+def is_possible(word, language):
+    """
+    Checks whether a Wiktionary entry could exist for a word in a language, so impossible lookups can be answered
+    without a request
+    :return: False if the word is empty, too long or has characters page titles can't have, or if the language
+             isn't in the table and can't be a language name
+    """
+    title = word[1:] if word.startswith("*") else word
+    if not title.strip() or _INVALID_TITLE.search(title) or len(title.encode("utf-8")) > 255:
+        return False
+    if resolve(language) is not None:
+        return True
+    # Language names are letters with spaces, hyphens, apostrophes and parentheses between them
+    return any(c.isalpha() for c in language) and all(c.isalpha() or c in " -'()" for c in language)
+
+
+def entry_url(word, language):
+    """
+    Builds the Wiktionary url of a word in a language without checking that it exists
+    :param word: The word. Reconstructed words can start with "*".
+    :param language: A language name, alias or code, see resolve
+    :return: url (string) of the page, with the language's section as its fragment for words that aren't
+             reconstructed
+    """
+    language = canonical_name(language)
+    language_url = language.replace(" ", "_")
+    word = word.replace(" ", "_")
+
+    # Reconstructed words start with '*' or belong to a reconstructed language
+    if word.startswith("*"):
+        return "https://en.wiktionary.org/wiki/Reconstruction:" + language_url + "/" + word[1:]
+    elif is_reconstructed(language):
+        return "https://en.wiktionary.org/wiki/Reconstruction:" + language_url + "/" + word
+    else:
+        return "https://en.wiktionary.org/wiki/" + word + "#" + language_url
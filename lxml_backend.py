@@ -0,0 +1,318 @@
+# Extraction backend that reads pages with lxml and XPath instead of Beautiful Soup, see webscraper.set_backend
+#
+# Every function here mirrors the Beautiful Soup function of the same name in webscraper.py and gives the same
+# output. lxml keeps text between tags in the .text and .tail of elements rather than in nodes of their own, so
+# the walks skip whitespace nodes and build a lot fewer Python objects than Beautiful Soup's.
+from lxml import etree
+import instrumentation
+import normalize
+import webscraper as ws
+
+# Language headings are <h2><span class="mw-headline">Language</span></h2>
+_LANGUAGE_HEADLINES = etree.XPath(
+    "//h2/span[contains(concat(' ', normalize-space(@class), ' '), ' mw-headline ')]")
+# The headlines of the h3/h4/... headings inside a node, or the node itself
+_HEADLINES = etree.XPath(
+    "descendant-or-self::span[contains(concat(' ', normalize-space(@class), ' '), ' mw-headline ')]")
+
+
+def parse(html):
+    """
+    :param html: A whole page's html
+    :return: The root element of the parsed page, None if html is empty
+    """
+    return etree.fromstring(html, etree.HTMLParser())
+
+
+def text(element):
+    """
+    :return: The text of an element and everything inside it, without comments, like Beautiful Soup's get_text
+    """
+    return "".join(element.itertext())
+
+
+def is_element(node):
+    # Comments and processing instructions are nodes too, but their tag isn't a string
+    return isinstance(node.tag, str)
+
+
+class Section:
+    """
+    A view of one language's section on a page parsed by parse, see webscraper.Section
+    """
+    def __init__(self, language, heading, end=None):
+        """
+        :param language: Name of the section's language
+        :param heading: The section's h2 element
+        :param end: The first sibling after the section, None if the section runs to the end of its parent
+        """
+        self.language = language
+        self.heading = heading
+        self.end = end
+
+    def nodes(self):
+        """
+        :return: A generator of the section's top level elements and comments, in order
+        """
+        node = self.heading.getnext()
+        traversed = 0
+        try:
+            while node is not None and node is not self.end:
+                # Every wiktionary page follows its last language section with a cache usage comment
+                if self.end is None and node.tag is etree.Comment:
+                    return
+                traversed += 1
+                yield node
+                node = node.getnext()
+        finally:
+            instrumentation.count("nodes", traversed)
+
+    def find_all(self, name, class_=None):
+        """
+        Finds the elements in the section with the given name (and class)
+        :param name: Tag name
+        :param class_: A class the elements must have, or None
+        :return: A list of the matching elements in document order
+        """
+        found = []
+        for node in self.nodes():
+            if is_element(node):
+                found.extend(element for element in node.iter(name)
+                             if class_ is None or class_ in (element.get("class") or "").split())
+        return found
+
+    def headlines(self):
+        """
+        :return: The mw-headline spans of the section's headings, in order
+        """
+        found = []
+        for node in self.nodes():
+            if is_element(node):
+                found.extend(_HEADLINES(node))
+        return found
+
+    def get_text(self):
+        pieces = [self.heading.tail or ""]
+        for node in self.nodes():
+            if is_element(node):
+                pieces.append(text(node))
+            pieces.append(node.tail or "")
+        return "".join(pieces)
+
+    def __str__(self):
+        return (self.heading.tail or "") + "".join(etree.tostring(node, encoding="unicode", method="html")
+                                                   for node in self.nodes())
+
+
+def index_sections(root):
+    """
+    Finds every language section of a parsed page with one XPath query
+    :param root: A page parsed by parse, or None
+    :return: A dictionary of language names to Section views, in the order they appear on the page
+    """
+    if root is None:
+        return {}
+    headings = [(text(headline), headline.getparent()) for headline in _LANGUAGE_HEADLINES(root)]
+
+    sections = {}
+    for i, (language, heading) in enumerate(headings):
+        end = None
+        if i + 1 < len(headings):
+            # The next heading might be nested inside one of this heading's siblings
+            end = headings[i + 1][1]
+            while end is not None and end.getparent() is not heading.getparent():
+                end = end.getparent()
+        if language not in sections:
+            sections[language] = Section(language, heading, end)
+    return sections
+
+
+def is_plain_tag(node, name):
+    """
+    :return: True if node is an element with the given name and no attributes, see webscraper.is_plain_tag
+    """
+    return node.tag == name and not node.attrib
+
+
+def _heading(section, names):
+    # The heading whose headline is one of names, None if the section has none
+    for headline in section.headlines():
+        if text(headline) in names:
+            return headline.getparent()
+    return None
+
+
+# Tags of the headings that start language sections and their subsections
+_HEADINGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+
+
+def _next_plain(section, node, name):
+    # The first plain <name> tag among the siblings after node, None if there isn't one before the end of the
+    # section or the next heading, see webscraper._next_plain
+    last = section.end is None
+    node = node.getnext()
+    while node is not None and node is not section.end:
+        if is_plain_tag(node, name):
+            return node
+        if node.tag in _HEADINGS:
+            return None
+        if last and node.tag is etree.Comment and node.getparent() is section.heading.getparent():
+            return None
+        node = node.getnext()
+    return None
+
+
+def pronunciation_from_section(section):
+    """
+    :param section: A Section, or None
+    :return: Pronunciation of the section if it exists, "Not found." otherwise
+    """
+    if section is None:
+        return "Not found."
+    heading = _heading(section, ("Pronunciation",))
+    if heading is None:
+        return "Not found."
+    ul = _next_plain(section, heading, "ul")
+    if ul is None:
+        return "Not found."
+    return normalize.normalize_pronunciation([text(li) for li in ul.iter("li")])
+
+
+def etymology_paragraph(section):
+    """
+    :param section: A Section, or None
+    :return: The <p> element under the section's (first) etymology heading, None if there isn't one
+    """
+    if section is None:
+        return None
+    heading = _heading(section, ("Etymology", "Etymology 1"))
+    if heading is None:
+        return None
+    return _next_plain(section, heading, "p")
+
+
+def etymology_from_section(section):
+    """
+    :param section: A Section, or None
+    :return: Etymology of the section if it exists, "Not found." otherwise
+    """
+    p = etymology_paragraph(section)
+    if p is None:
+        return "Not found."
+    return text(p).rstrip()
+
+
+# Headings that a definition entry can be under
+_DEFINITION_HEADINGS = ("Noun", "Verb", "Adjective", "Determiner", "Pronoun", "Conjunction", "Suffix", "Prefix",
+                        "Adverb", "Numeral")
+
+
+def definition_from_section(section, prune=None):
+    """
+    :param section: A Section, or None
+    :param prune: Rules for the nodes left out of each definition, webscraper.DEFINITION_PRUNE if None
+    :return: Definition entry of the section if it exists, "Not found." otherwise
+    """
+    if prune is None:
+        prune = ws.DEFINITION_PRUNE
+    if section is None:
+        return "Not found."
+    heading = _heading(section, _DEFINITION_HEADINGS)
+    if heading is None:
+        return "Not found."
+
+    p = _next_plain(section, heading, "p")
+    ol = None if p is None else _next_plain(section, p, "ol")
+    if ol is None:
+        return "Not found."
+    texts = [pruned_text(li, prune) for li in ol.iter("li") if li.getparent().tag == "ol"]
+    return normalize.normalize_definition(text(p), texts)
+
+
+def matches_rule(element, rule):
+    """
+    Checks an element against a pruning rule, see webscraper.DEFINITION_PRUNE
+    """
+    name, attrs = rule
+    if element.tag != name:
+        return False
+    for key, value in attrs.items():
+        if key == "class":
+            if value not in (element.get("class") or "").split():
+                return False
+        elif element.get(key) != value:
+            return False
+    return True
+
+
+def pruned_text(element, prune):
+    """
+    Returns the text of an element without the contents of any element matching one of the pruning rules,
+    see webscraper.pruned_text
+    """
+    pieces = []
+    # Elements still to be walked, and the tails that follow them
+    stack = [element]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            pieces.append(node)
+            continue
+        if node is not element and (not is_element(node) or any(matches_rule(node, rule) for rule in prune)):
+            continue
+        if node.text:
+            pieces.append(node.text)
+        for child in reversed(node):
+            if child.tail:
+                stack.append(child.tail)
+            stack.append(child)
+    return "".join(pieces)
+
+
+def _mention_links(element, default_language=None):
+    # Words are mentioned inside a tag with a lang attribute, unlike the links to language names around them
+    links = []
+    for a in element.iterdescendants("a"):
+        if a.get("href") is not None and a.getparent().get("lang") is not None:
+            link = ws.parse_wiki_link(a.get("href"), default_language)
+            if link is not None:
+                links.append(link)
+    return links
+
+
+def etymology_links_from_section(section):
+    """
+    :return: The (word, language, url) tuples the section's etymology mentions, see webscraper.parse_wiki_link
+    """
+    p = etymology_paragraph(section)
+    if p is None:
+        return []
+    return _mention_links(p)
+
+
+def descendant_links_from_section(section):
+    """
+    :return: The (word, language, url) tuples of the section's direct descendants, see webscraper.parse_wiki_link
+    """
+    if section is None:
+        return []
+    heading = _heading(section, ("Descendants",))
+    if heading is None:
+        return []
+    ul = _next_plain(section, heading, "ul")
+    if ul is None:
+        return []
+
+    links = []
+    for li in ul:
+        if li.tag != "li":
+            continue
+        # Entries are written "Language: word", deeper descendants are in nested lists
+        language = text(li).split(":", 1)[0].strip()
+        for child in li:
+            if is_element(child) and child.tag != "ul":
+                child_links = _mention_links(child, language)
+                if child_links:
+                    links.append(child_links[0])
+                    break
+    return links
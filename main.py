@@ -1,37 +1,292 @@
 # In-console IO loop for the Wiktionary webscraper\
+#
+# python main.py            asks for words and looks them up through the lookup service at --server, or in this
+#                           process if no service is running or options that only apply to this process (--cache,
+#                           --offline, --store, --negative-ttl, --backend, --timings, --prometheus, --profile) are
+#                           given
+# python main.py --serve    runs the lookup service (see server.py)
+# python main.py --batch words.csv
+#                           looks up every (word, language) record of a CSV or JSONL file, or of stdin, and writes
+#                           the results to stdout as JSON lines in the same order
 
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import cache
+import instrumentation
+import languages
+import search
+import server
+import store
 import webscraper as ws
 
 
-print("Wiktionary Webscraper\nTo exit the program at any point type exit()\n")
+def print_result(word, language, result, suggestions=()):
+    if not result["exists"]:
+        print("\nA Wiktionary URL doesn't exist for", "'" + word + "'","(in any language).")
+        if suggestions:
+            print("Did you mean: " + ", ".join(w.spelling + " (" + w.language + ")" for w in suggestions))
+    elif language not in result["languages"]:
+        print("\nA Wiktionary URL exists for", "'" + word + "'", "but not in " + language + ".")
+        print("The languages for this word on Wiktionary are: ")
+        print("    " + ", ".join(result["languages"]))
+    else:
+        print("\nDefinition:\n" + result["definition"] + "\n")
+        print("Pronunciation:\n" + result["pronunciation"] + "\n")
+        print("Etymology:\n" + result["etymology"])
 
-while True:
-    word = input("----------------------------------------------------------------------------\nEnter a word: ")
-    while word == "":
-        print("No word entered.")
-        word = input("Enter a word: ")
-    if word == "exit()":
-        break
 
-    language = input("Enter the language the word belongs to: ")
-    while language == "":
-        print("No language entered.")
-        language = input("Enter the langauge the word belongs to: ")
-    if language == "exit()":
-        break
+def interactive(lookup, timings=False, index=None):
+    """
+    Asks for words until exit() is entered
+    :param lookup: Function that looks up (word, language), see webscraper.lookup
+    :param timings: Print how long each stage of a lookup took after its result. Needs instrumentation enabled.
+    :param index: A search.SearchIndex that found words are added to and that suggests words for the ones that
+                  aren't found, or None
+    """
+    print("Wiktionary Webscraper\nTo exit the program at any point type exit()\n")
 
-    # Fix formatting for language
-    language = language.title()
+    while True:
+        word = input("----------------------------------------------------------------------------\nEnter a word: ")
+        while word == "":
+            print("No word entered.")
+            word = input("Enter a word: ")
+        if word == "exit()":
+            break
 
-    url_tuple = ws.get_wiki_url(word, language)
-    if url_tuple is None:
-        print("\nA Wiktionary URL doesn't exist for", "'" + word + "'","(in any language).")
-    elif url_tuple[1] is False:
-        print("\nA Wiktionary URL exists for", "'" + word + "'", "but not in " + language + ".")
-        print("The languages for this word on Wiktionary are: ")
-        print("    " + ", ".join(ws.languages_on_page(url_tuple[0])))
+        language = input("Enter the language the word belongs to: ")
+        while language == "":
+            print("No language entered.")
+            language = input("Enter the langauge the word belongs to: ")
+        if language == "exit()":
+            break
+
+        # Fix formatting for language: known names, aliases and codes become the name Wiktionary uses
+        resolved = languages.resolve(language)
+        language = language.title() if resolved is None else resolved.name
+
+        # The page is downloaded and parsed once and shared between the extractors
+        try:
+            with instrumentation.span("word", word=word) as trace:
+                result = lookup(word, language)
+        except cache.OfflineMiss:
+            print("\n'" + word + "' isn't in the cache and can't be looked up offline.")
+            continue
+        except server.ServiceError as e:
+            print("\nThe lookup service couldn't look up '" + word + "': " + str(e))
+            continue
+
+        suggestions = ()
+        if index is not None:
+            index.add_result(result)
+            if not result["exists"]:
+                suggestions = index.suggest(word, language)
+        print_result(word, language, result, suggestions)
+        if timings and trace is not None:
+            print("\nTimings:\n" + trace.format())
+
+
+def read_records(f, format="jsonl"):
+    """
+    Streams the (word, language) records of a batch file
+    :param f: A text file object
+    :param format: "jsonl" for one {"word": ..., "language": ...} object per line, or "csv" for rows of a word and
+                   a language. A "word,language" header row is skipped.
+    :return: A generator of (word, language) tuples
+    :raises ValueError: For a line that isn't a record, with its line number
+    """
+    if format == "csv":
+        for number, row in enumerate(csv.reader(f), 1):
+            if not row or (number == 1 and [cell.strip().lower() for cell in row] == ["word", "language"]):
+                continue
+            if len(row) != 2:
+                raise ValueError("row " + str(number) + ": expected a word and a language, got " + str(row))
+            yield row[0].strip(), row[1].strip()
     else:
-        url = url_tuple[0]
-        print("\nDefinition:\n" + ws.get_wiki_definition(url, language) + "\n")
-        print("Pronunciation:\n" + ws.get_wiki_pronunciation(url, language) + "\n")
-        print("Etymology:\n" + ws.get_wiki_etymology(url, language))
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                word, language = record["word"], record["language"]
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError("line " + str(number) + ": not a word and language record (" + str(e) + ")")
+            yield word, language
+
+
+def _save_checkpoint(path, done, offset):
+    with open(path + ".tmp", "w") as f:
+        json.dump({"done": done, "offset": offset}, f)
+    # Renaming keeps a crash from leaving a half written checkpoint
+    os.replace(path + ".tmp", path)
+
+
+def run_batch(records, out, workers=8, checkpoint=None, checkpoint_every=100):
+    """
+    Looks up many records on a pool of threads and writes their results as JSON lines in the order of the
+    records. Only a few lookups are in flight at a time, so memory use doesn't grow with the input.
+    :param records: An iterable of (word, language) tuples, see read_records
+    :param out: Text file object the results are written to
+    :param workers: Number of lookups run at the same time
+    :param checkpoint: File progress is saved in every checkpoint_every results, or None. If it exists, the run
+                       skips the records it says are done and cuts out back to the end of their results. It's
+                       removed once every record is done.
+    :param checkpoint_every: Number of results written between checkpoints
+    :return: Number of records looked up by this run
+    :raises IOError: When resuming from a checkpoint with an output that can't be cut back to it (e.g. stdout, or a
+                     checkpoint saved by a run on stdout), since the results written after it would be written twice
+    """
+    done = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            saved = json.load(f)
+        if saved["offset"] is None or not out.seekable():
+            raise IOError("can't resume from " + checkpoint + " on an output that can't be cut back to it")
+        done = saved["done"]
+        # Results written after the checkpoint was saved are written again
+        out.truncate(saved["offset"])
+        out.seek(saved["offset"])
+
+    written = 0
+    for result in ws.lookup_many(itertools.islice(records, done, None), workers, ordered=True):
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        written += 1
+        if checkpoint is not None and written % checkpoint_every == 0:
+            out.flush()
+            _save_checkpoint(checkpoint, done + written, out.tell() if out.seekable() else None)
+    out.flush()
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return written
+
+
+def local_options(args):
+    """
+    :param args: The parsed command line arguments
+    :return: The options given that configure or measure lookups in this process, which a lookup service wouldn't
+             follow. The service's spans never reach this process, so it can't be timed or profiled from here.
+    """
+    options = [("--cache", args.cache), ("--offline", args.offline), ("--store", args.store),
+               ("--negative-ttl", args.negative_ttl), ("--backend", args.backend), ("--timings", args.timings),
+               ("--prometheus", args.prometheus), ("--profile", args.profile)]
+    return [name for name, value in options if value is not None and value is not False]
+
+
+def batch(args):
+    # Runs --batch: reads the records from a file or stdin and writes the results to --output or stdout
+    record_format = args.format
+    if record_format is None:
+        record_format = "csv" if args.batch.lower().endswith(".csv") else "jsonl"
+    infile = sys.stdin if args.batch == "-" else open(args.batch, encoding="utf-8", newline="")
+    if args.output is None:
+        out = sys.stdout
+    else:
+        # A run that is resumed keeps the results the last one wrote
+        resuming = args.checkpoint is not None and os.path.exists(args.checkpoint)
+        out = open(args.output, "a" if resuming else "w", encoding="utf-8")
+    try:
+        run_batch(read_records(infile, record_format), out, args.workers, args.checkpoint, args.checkpoint_every)
+    except ValueError as e:
+        sys.exit("Bad record in " + args.batch + ": " + str(e))
+    except IOError as e:
+        sys.exit(str(e))
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wiktionary Webscraper")
+    parser.add_argument("--cache", help="file to cache downloaded pages and results in between runs")
+    parser.add_argument("--offline", action="store_true", help="only answer from the cache, never go to Wiktionary")
+    parser.add_argument("--negative-ttl", type=float,
+                        help="hours the cache remembers missing words and the languages pages have (default: 24)")
+    parser.add_argument("--backend", choices=["bs4", "lxml"], help="parse pages with Beautiful Soup or with lxml "
+                        "and XPath, which is faster (default: $WEBSCRAPER_BACKEND or bs4)")
+    parser.add_argument("--store", help="answer from a store filled by ingest.py instead of Wiktionary")
+    parser.add_argument("--server", help="address of the lookup service to use (default: " + server.DEFAULT_ADDRESS +
+                        "), unless options for looking words up in this process are given")
+    parser.add_argument("--serve", action="store_true", help="run the lookup service instead of asking for words")
+    parser.add_argument("--host", default="127.0.0.1", help="address the service listens on")
+    parser.add_argument("--port", type=int, default=8765, help="port the service listens on")
+    parser.add_argument("--index", help="file to keep a search index of the words found in, for suggestions")
+    parser.add_argument("--timings", action="store_true", help="print a timing breakdown after each word")
+    parser.add_argument("--prometheus", help="file to keep Prometheus metrics of the lookups in")
+    parser.add_argument("--profile", help="file to save cProfile statistics of the lookups to")
+    parser.add_argument("--batch", nargs="?", const="-", metavar="FILE",
+                        help="look up the records of a CSV or JSONL file (stdin if no file) and print JSON lines")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="format of the batch records (default: from "
+                        "the file name, jsonl for stdin)")
+    parser.add_argument("--output", help="file to write the batch results to instead of stdout")
+    parser.add_argument("--workers", type=int, default=8, help="number of batch lookups run at the same time")
+    parser.add_argument("--checkpoint", help="file to save batch progress in, so a stopped run can be resumed")
+    parser.add_argument("--checkpoint-every", type=int, default=100, help="batch results written between "
+                        "checkpoints")
+    args = parser.parse_args()
+    if args.checkpoint is not None and args.output is None:
+        # Results written to stdout after the last checkpoint can't be taken back when the run is resumed
+        parser.error("--checkpoint needs an --output file")
+    if args.server is not None and local_options(args):
+        parser.error("the lookup service doesn't use " + ", ".join(local_options(args)) + ", leave out --server "
+                     "to look words up in this process")
+
+    sinks = []
+    if args.prometheus is not None:
+        sinks.append(instrumentation.PrometheusSink(args.prometheus))
+    if args.profile is not None:
+        sinks.append(instrumentation.ProfileSink(args.profile))
+    if args.timings or sinks:
+        instrumentation.enable(sinks)
+
+    if args.backend is not None:
+        ws.set_backend(args.backend)
+    if args.store is not None:
+        ws.set_store(store.Store(args.store))
+    if args.cache is not None:
+        negative_ttl = 24 if args.negative_ttl is None else args.negative_ttl
+        ws.set_cache(cache.Cache(args.cache, offline=args.offline, negative_ttl=negative_ttl * 60 * 60))
+    elif args.offline:
+        parser.error("--offline needs a --cache to read from")
+
+    if args.batch is not None:
+        batch(args)
+        if ws.get_cache() is not None:
+            ws.get_cache().close()
+    elif args.serve:
+        import signal
+        httpd = server.make_server(args.host, args.port)
+        # Stopping the service with SIGTERM goes through the same shutdown as Ctrl+C
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            print("Lookup service listening on http://" + args.host + ":" + str(args.port), flush=True)
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            # Closing the cache saves its bloom filter for the next run
+            if ws.get_cache() is not None:
+                ws.get_cache().close()
+    else:
+        index = None
+        if args.index is not None:
+            index = search.SearchIndex.load(args.index) if os.path.exists(args.index) else search.SearchIndex()
+
+        client = None if local_options(args) else server.Client(args.server or server.DEFAULT_ADDRESS)
+        if client is not None and client.available():
+            interactive(client.lookup, args.timings, index)
+        else:
+            if client is not None:
+                print("No lookup service at " + client.address + ", looking words up in this process.\n")
+            interactive(ws.lookup, args.timings, index)
+
+        if index is not None:
+            index.save(args.index)
+        if ws.get_cache() is not None:
+            ws.get_cache().close()
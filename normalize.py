@@ -0,0 +1,90 @@
+# Text clean-up shared by the definition and pronunciation extractors
+#
+# Every function works on plain strings, so batch jobs (e.g. over a store filled by ingest.py) can normalize many
+# entries in one call with normalize_pronunciations and normalize_definitions.
+import re
+
+# Pronunciation lines that only repeat other lines or aren't pronunciations: enPR/AusPR respellings, audio
+# files, rhymes, homophones and syllabifications. They're kept if they also give an IPA.
+PRONUNCIATION_NOISE = re.compile(r"..PR|Audio|Rhymes|Homophone|Syllabification")
+
+
+def split_lines(text):
+    """
+    Splits text into lines with trailing whitespace removed
+    :param text: A string of lines separated by "\n"
+    :return: A list of the lines. A newline at the end of text doesn't start another line.
+    """
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return [line.rstrip() for line in lines]
+
+
+def dedupe(lines):
+    """
+    :param lines: An iterable of strings
+    :return: A list of the strings without repeats, in the order they first appear
+    """
+    return list(dict.fromkeys(lines))
+
+
+def first_sentence(s):
+    """
+    :return: s up to and including its first period, all of s if it has none
+    """
+    end = s.find(".")
+    if end == -1:
+        return s
+    return s[:end + 1]
+
+
+def pronunciation_lines(lines):
+    """
+    Removes repeated lines and the lines matching PRONUNCIATION_NOISE that don't give an IPA
+    :param lines: A list of pronunciation lines
+    :return: A list of the lines that are kept, with "(key)" links removed
+    """
+    return [line.replace("(key)", "") for line in dedupe(lines)
+            if "IPA" in line or not PRONUNCIATION_NOISE.match(line)]
+
+
+def normalize_pronunciation(texts):
+    """
+    Formats a pronunciation section with one pronunciation on each line
+    :param texts: Texts of the pronunciation list's items, each of which can hold several lines
+    :return: The pronunciations as a string
+    """
+    # Every item ends a line, so an item ending in a newline leaves an empty line after it
+    lines = split_lines("".join(text + "\n" for text in texts))
+    return "\n".join(pronunciation_lines(lines)).rstrip()
+
+
+def normalize_definition(headword, texts):
+    """
+    Formats a definition entry: the headword line followed by the numbered first sentences of the definitions
+    :param headword: Text of the headword line, e.g. "bath (plural baths)"
+    :param texts: Texts of the definitions
+    :return: The definition entry as a string
+    """
+    lines = dedupe((str(number) + ". " + first_sentence(text.replace("\n", " ").rstrip())).rstrip()
+                   for number, text in enumerate(texts, 1))
+    return headword.rstrip() + "\n" + "\n".join("    " + line for line in lines).rstrip()
+
+
+def normalize_pronunciations(entries):
+    """
+    normalize_pronunciation for many entries
+    :param entries: An iterable of lists of pronunciation item texts
+    :return: A list of pronunciation strings
+    """
+    return [normalize_pronunciation(texts) for texts in entries]
+
+
+def normalize_definitions(entries):
+    """
+    normalize_definition for many entries
+    :param entries: An iterable of (headword, definition texts) tuples
+    :return: A list of definition strings
+    """
+    return [normalize_definition(headword, texts) for headword, texts in entries]
@@ -0,0 +1,172 @@
+# Process pool that parses pages and runs the extractors on them, for when parsing rather than downloading is what
+# takes the time
+#
+# Usage: python parse_farm.py DIR [--workers N] [--language LANGUAGE]
+#     extracts every saved page of a directory of DirectoryTransport files and prints the results as JSON lines
+#
+# Threads don't help with parsing because of the GIL, so the pages are parsed in worker processes. The html isn't
+# pickled to them: each chunk of pages is written to one file in shared memory (/dev/shm where there is one) that
+# the worker maps, and only the file's name and the pages' offsets go through the pool's pipe. The workers send
+# back tuples of the extracted strings.
+import argparse
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import tempfile
+from collections import deque
+from urllib.parse import unquote
+import webscraper as ws
+
+# Small page each worker parses before its first chunk, so its imports and the parser are warm
+_WARM_UP_PAGE = ('<html><body><h2><span class="mw-headline">English</span></h2>'
+                 '<h3><span class="mw-headline">Etymology</span></h3><p>From Old English.</p>'
+                 '<h3><span class="mw-headline">Noun</span></h3><p><b>word</b></p><ol><li>A word.</li></ol>'
+                 '<!-- NewPP limit report --></body></html>')
+
+
+def _warm_up(backend):
+    # Runs once in every worker when it starts
+    ws.set_backend(backend)
+    page = ws.WiktionaryPage("https://en.wiktionary.org/wiki/word", html=_WARM_UP_PAGE)
+    page.definition("English")
+    page.etymology("English")
+
+
+def extract_page(url, html, languages=None):
+    """
+    Parses a page and runs the extractors on its language sections. Runs in the worker processes.
+    :param url: The page's url
+    :param html: The page's html
+    :param languages: Names of the languages to extract, every language on the page if None
+    :return: A tuple (url, page languages, entries, error) where entries is a list of (language, definition,
+             pronunciation, etymology, section hash) tuples for the requested languages on the page (see
+             store.Store.put_pages), and error is None or the description of the exception the page raised
+    """
+    try:
+        page = ws.WiktionaryPage(url, html=html)
+        wanted = page.languages if languages is None else [language for language in languages
+                                                          if language in page.sections]
+        entries = [(language, page.definition(language), page.pronunciation(language), page.etymology(language),
+                    page.section_hash(language)) for language in wanted]
+        return url, page.languages, entries, None
+    except Exception as e:
+        return url, None, [], type(e).__name__ + ": " + str(e)
+
+
+def _extract_chunk(path, items):
+    # Extracts the pages of a chunk file written by ParseFarm._write_chunk. Runs in the worker processes.
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return [extract_page(url, "", languages) for url, offset, length, languages in items]
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return [extract_page(url, data[offset:offset + length].decode("utf-8"), languages)
+                    for url, offset, length, languages in items]
+
+
+class ParseFarm:
+    """
+    A pool of worker processes that parse pages and extract their sections
+    """
+    def __init__(self, workers=None, chunk_size=8, backend=None, directory=None):
+        """
+        :param workers: Number of worker processes, the number of CPUs if None
+        :param chunk_size: Pages sent to a worker at a time. Larger chunks cost less to hand out, smaller ones
+                           keep the workers evenly busy when pages differ a lot in size.
+        :param backend: Backend the workers parse with (see webscraper.set_backend), this process's if None
+        :param directory: Where the chunk files are written, /dev/shm if it exists and the temporary directory
+                          otherwise
+        """
+        self.workers = workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.backend = backend or ws.get_backend()
+        if directory is None and os.path.isdir("/dev/shm"):
+            directory = "/dev/shm"
+        self.directory = directory
+        self._pool = multiprocessing.Pool(self.workers, initializer=_warm_up, initargs=(self.backend,))
+
+    def _write_chunk(self, pages):
+        # Writes the html of a chunk's pages to one file and returns its path and the pages' offsets
+        fd, path = tempfile.mkstemp(prefix="parse-farm-", dir=self.directory)
+        items = []
+        offset = 0
+        with os.fdopen(fd, "wb") as f:
+            for url, html, languages in pages:
+                data = html.encode("utf-8")
+                f.write(data)
+                items.append((url, offset, len(data), languages))
+                offset += len(data)
+        return path, items
+
+    def extract(self, pages):
+        """
+        Extracts many pages on the workers
+        :param pages: An iterable of (url, html, languages) tuples, which is read lazily. languages is a list of the
+                      languages to extract, or None for every language on the page.
+        :return: A generator of extract_page's (url, page languages, entries, error) tuples in the order of pages.
+                 Only a few chunks are written ahead of the one being waited on, so huge inputs aren't held in
+                 memory.
+        """
+        pages = iter(pages)
+        # Chunks in the order they were sent, the oldest is always the next to be returned
+        window = deque()
+        try:
+            while True:
+                while len(window) < self.workers * 2:
+                    chunk = list(itertools.islice(pages, self.chunk_size))
+                    if not chunk:
+                        break
+                    path, items = self._write_chunk(chunk)
+                    window.append((path, self._pool.apply_async(_extract_chunk, (path, items))))
+                if not window:
+                    return
+                path, result = window.popleft()
+                try:
+                    results = result.get()
+                finally:
+                    os.remove(path)
+                yield from results
+        finally:
+            # Workers that are still reading a file keep it open, so it can be removed under them
+            for path, result in window:
+                os.remove(path)
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def read_directory(path, languages=None):
+    """
+    Streams the pages saved in a directory by a DirectoryTransport
+    :param path: The directory
+    :param languages: Languages to extract from every page, None for all of them
+    :return: A generator of (url, html, languages) tuples for ParseFarm.extract
+    """
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".html"):
+            with open(os.path.join(path, name), encoding="utf-8") as f:
+                yield "https://" + unquote(name[:-len(".html")]), f.read(), languages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract saved pages on a pool of worker processes")
+    parser.add_argument("directory", help="directory of pages saved by a DirectoryTransport")
+    parser.add_argument("--workers", type=int, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=8, help="pages sent to a worker at a time")
+    parser.add_argument("--backend", choices=["bs4", "lxml"], help="parser the workers use")
+    parser.add_argument("--language", action="append", help="only extract this language (can be repeated)")
+    args = parser.parse_args()
+    with ParseFarm(args.workers, args.chunk_size, args.backend) as farm:
+        for url, page_languages, entries, error in farm.extract(read_directory(args.directory, args.language)):
+            print(json.dumps({"url": url, "languages": page_languages, "error": error,
+                              "entries": [dict(zip(("language", "definition", "pronunciation", "etymology", "hash"), entry))
+                                          for entry in entries]}, ensure_ascii=False))
@@ -0,0 +1,62 @@
+# Token bucket rate limiting for requests sent to Wiktionary
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average with bursts of up to burst requests. Safe to share between threads.
+    """
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: Number of tokens added per second
+        :param burst: Most tokens the bucket can hold
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token from the bucket, sleeping until one is available
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    """
+    Keeps a separate token bucket for every host so a slow host doesn't hold up requests to the others
+    """
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: Requests per second allowed to each host
+        :param burst: Number of requests a host can receive at once after being idle
+        """
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url):
+        """
+        Waits until a request to the url's host is allowed
+        :param url: The url about to be requested
+        """
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = self._buckets[host] = TokenBucket(self.rate, self.burst)
+        bucket.acquire()
@@ -0,0 +1,246 @@
+# Brings a local store.Store up to date with Wiktionary, redoing only the work for what changed
+#
+# Usage: python refresh.py STORE [--dump DUMP | --conditional] [--batch-size N]
+#
+# The stored pages' revisions are checked a batch at a time, with the MediaWiki revisions API (up to 50 titles a
+# request) or with the revisions of a newer dump. Only pages whose revision changed are parsed, downloaded from
+# Wiktionary or read from the dump in a second pass over it, and only the language sections whose hash differs
+# from the stored one are extracted again, so a refresh costs the revision checks plus work proportional to the
+# number of changed sections. Without a revision source each page is revalidated with a conditional request on its
+# stored ETag instead.
+#
+# Section hashes depend on the backend pages are parsed with (see webscraper.set_backend), so refresh with the
+# backend the store was filled with.
+import argparse
+import json
+import re
+from urllib.parse import urlencode
+import ingest
+import store
+import transport
+import webscraper as ws
+
+API_URL = "https://en.wiktionary.org/w/api.php"
+
+# Rendered pages name the revision they were rendered from in their page config
+_REVISION = re.compile(r'"wgRevisionId":(\d+)')
+
+
+def page_url(title):
+    """
+    :param title: A page title as stored, see store.page_title
+    :return: The page's Wiktionary url
+    """
+    return "https://en.wiktionary.org/wiki/" + title
+
+
+def page_revision(html):
+    """
+    :return: The revision a rendered page's html came from, None if the html doesn't say
+    """
+    match = _REVISION.search(html)
+    return None if match is None else match.group(1)
+
+
+class MediaWikiRevisions:
+    """
+    Looks up the current revisions of pages with the MediaWiki API's revisions query
+    """
+    # Most titles the API takes in one query
+    batch_size = 50
+
+    def __init__(self, api_url=API_URL):
+        self.api_url = api_url
+
+    def query_url(self, titles):
+        """
+        :return: The url of the API query for the revisions of the titles
+        """
+        return self.api_url + "?" + urlencode({
+            "action": "query", "prop": "revisions", "rvprop": "ids", "format": "json", "formatversion": "2",
+            "titles": "|".join(title.replace("_", " ") for title in titles),
+        })
+
+    def revisions(self, titles):
+        """
+        :param titles: Page titles as stored, at most batch_size of them
+        :return: A dictionary of the titles to their current revision (string), or None for pages that don't
+                 exist. Titles the API didn't answer for are left out.
+        """
+        response = ws.download(self.query_url(titles))
+        if response.status >= 400:
+            raise IOError("Revisions query failed with HTTP status " + str(response.status))
+        query = json.loads(response.text)["query"]
+
+        # The API answers with the titles it normalized, e.g. with spaces for underscores
+        asked = {title.replace("_", " "): title for title in titles}
+        for normalized in query.get("normalized", []):
+            if normalized["from"] in asked:
+                asked[normalized["to"]] = asked[normalized["from"]]
+
+        current = {}
+        for page in query.get("pages", []):
+            title = asked.get(page["title"])
+            if title is None:
+                continue
+            if page.get("missing") or not page.get("revisions"):
+                current[title] = None
+            else:
+                current[title] = str(page["revisions"][0]["revid"])
+        return current
+
+
+class StaticRevisions:
+    """
+    Stand-in for the revisions API that answers from a dictionary, e.g. of the revisions in a newer dump
+    """
+    batch_size = 1000
+
+    def __init__(self, revisions, dump_path=None):
+        """
+        :param revisions: A dictionary of page titles (as stored) to their current revision. Pages that aren't in
+                          it are treated as deleted.
+        :param dump_path: The dump the revisions came from, which changed pages are then read from rather than
+                          downloaded, so their html is the revision that was checked
+        """
+        self._revisions = revisions
+        self.dump_path = dump_path
+
+    @classmethod
+    def from_dump(cls, path):
+        """
+        :param path: A dump that ingest.read_dump can read
+        """
+        return cls({title.replace(" ", "_"): revision for title, html, revision in ingest.read_dump(path)}, path)
+
+    def revisions(self, titles):
+        return {title: self._revisions.get(title) for title in titles}
+
+    def pages(self, titles):
+        """
+        Reads pages from the dump in one pass over it
+        :param titles: A set of page titles (as stored)
+        :return: A generator of (title, html, revision) tuples of the pages in titles, in the dump's order
+        """
+        for title, html, revision in ingest.read_dump(self.dump_path):
+            title = title.replace(" ", "_")
+            if title in titles:
+                yield title, html, revision
+
+
+def refresh_page(local_store, title, response, revision=None):
+    """
+    Stores a new version of a page, extracting only the language sections that changed
+    :param local_store: A store.Store
+    :param title: The page's title
+    :param response: The transport.Response the page came in, or one made up for a page read from a dump
+    :param revision: The revision the page was checked at, for html that doesn't name the revision it came from
+    :return: A tuple (sections extracted, sections kept)
+    """
+    page = ws.WiktionaryPage(page_url(title), response.text, response.status)
+    old_hashes = local_store.section_hashes(title)
+    changed = []
+    for language in page.languages:
+        section_hash = page.section_hash(language)
+        if section_hash != old_hashes.get(language):
+            changed.append((language, page.definition(language), page.pronunciation(language),
+                            page.etymology(language), section_hash))
+    local_store.update_page(title, page_revision(response.text) or revision, response.headers.get("ETag"),
+                            page.languages, changed)
+    return len(changed), len(page.languages) - len(changed)
+
+
+def refresh(local_store, revisions=None, batch_size=None):
+    """
+    Brings every page of a store up to date, see the top of this file
+    :param local_store: A store.Store
+    :param revisions: Where current revisions come from, a MediaWikiRevisions or StaticRevisions, or None to
+                      revalidate each page with a conditional request on its ETag. Changed pages are read from a
+                      StaticRevisions' dump if it has one, and downloaded otherwise.
+    :param batch_size: Pages checked at a time, the revision source's batch_size if None
+    :return: A dictionary of counts: pages checked, unchanged, changed, deleted and failed, and sections
+             extracted and kept
+    """
+    stats = dict.fromkeys(["checked", "unchanged", "changed", "deleted", "failed", "sections_extracted",
+                           "sections_kept"], 0)
+    if batch_size is None:
+        batch_size = revisions.batch_size if revisions is not None else 100
+
+    from_dump = getattr(revisions, "dump_path", None) is not None
+    # Changed pages that are read from the dump once every page was checked
+    pending = set()
+    after = None
+    while True:
+        batch = local_store.versions(after, batch_size)
+        if not batch:
+            break
+        after = batch[-1][0]
+        stats["checked"] += len(batch)
+        current = None if revisions is None else revisions.revisions([title for title, _, _ in batch])
+
+        for title, revision, etag in batch:
+            if current is not None:
+                if title not in current or current[title] == revision:
+                    stats["unchanged"] += 1
+                    continue
+                if current[title] is None:
+                    local_store.delete_page(title)
+                    stats["deleted"] += 1
+                    continue
+                if from_dump:
+                    pending.add(title)
+                    continue
+                response = ws.download(page_url(title))
+            else:
+                response = ws.download(page_url(title), {"If-None-Match": etag} if etag else {})
+                if response.status == 304 or (response.status < 400 and revision is not None
+                                              and page_revision(response.text) == revision):
+                    stats["unchanged"] += 1
+                    continue
+
+            if response.status == 404:
+                local_store.delete_page(title)
+                stats["deleted"] += 1
+            elif response.status >= 400:
+                # The stored version is kept and checked again next time
+                stats["failed"] += 1
+            else:
+                _count_update(stats, refresh_page(local_store, title, response,
+                                                  None if current is None else current[title]))
+
+    if pending:
+        for title, html, revision in revisions.pages(pending):
+            _count_update(stats, refresh_page(local_store, title, transport.Response(200, html, {}), revision))
+    return stats
+
+
+def _count_update(stats, sections):
+    stats["changed"] += 1
+    stats["sections_extracted"] += sections[0]
+    stats["sections_kept"] += sections[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-extract the pages of a store that changed on Wiktionary")
+    parser.add_argument("store", help="SQLite file filled by ingest.py")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--dump", help="take the current revisions from a newer dump instead of the MediaWiki API")
+    source.add_argument("--conditional", action="store_true",
+                        help="revalidate each page with a conditional request instead of checking revisions")
+    parser.add_argument("--batch-size", type=int, help="pages checked at a time")
+    parser.add_argument("--rate", type=float, default=5, help="most requests a second to Wiktionary")
+    parser.add_argument("--backend", choices=["bs4", "lxml"], help="parser to use, the one the store was "
+                        "filled with")
+    args = parser.parse_args()
+
+    if args.backend is not None:
+        ws.set_backend(args.backend)
+    ws.set_rate_limit(args.rate)
+    if args.dump is not None:
+        source = StaticRevisions.from_dump(args.dump)
+    elif args.conditional:
+        source = None
+    else:
+        source = MediaWikiRevisions()
+    stats = refresh(store.Store(args.store), source, args.batch_size)
+    print(", ".join(key.replace("_", " ") + ": " + str(value) for key, value in stats.items()))
@@ -0,0 +1,450 @@
+# Local search over words that were already looked up: prefixes, typo-tolerant matches and words in definitions
+# and etymologies, without going to the network
+#
+# Spellings are kept in a sorted array that is walked like a trie: every spelling starting with a prefix is in one
+# contiguous range, and the fuzzy search shares work between neighbouring spellings the way a trie shares prefixes.
+# Definition and etymology words go in an inverted index of words to rows.
+#
+# SearchIndex is the in-memory index that words are added to. save writes it to a file that MappedIndex answers the
+# same queries from through mmap, without reading the file into memory.
+#
+# python search.py INDEX --build STORE      indexes a store filled by ingest.py
+# python search.py INDEX [--prefix | --fuzzy | --search] TEXT [--language LANGUAGE]
+import argparse
+import heapq
+import mmap
+import re
+import struct
+import sys
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+import store
+import structures
+
+# Sorts after every string that starts with the same prefix
+_PREFIX_END = "\U0010ffff"
+
+_TOKEN = re.compile(r"\w+")
+
+
+def normalize_key(text):
+    """
+    Folds a spelling or search term so matches ignore case and accents, e.g. "Déjà_vu" becomes "deja vu"
+    """
+    text = text.replace("_", " ")
+    if text.isascii():
+        return text.casefold().strip()
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold().strip()
+
+
+def tokenize(text):
+    """
+    :return: A list of the folded words in text, see normalize_key
+    """
+    return _TOKEN.findall(normalize_key(text))
+
+
+def _prefix_range(keys, prefix):
+    # The range of indexes of the sorted keys starting with prefix
+    return bisect_left(keys, prefix), bisect_left(keys, prefix + _PREFIX_END)
+
+
+def _fuzzy_rows(keys, query, max_distance):
+    """
+    Finds the keys within an edit distance of query. The sorted keys are walked like a trie: the Levenshtein rows
+    computed for a key's prefix are reused by the keys after it that share the prefix, and when no key with a
+    prefix can be close enough the whole range of keys with that prefix is skipped.
+    :return: A list of (distance, index) tuples
+    """
+    found = []
+    rows = [list(range(len(query) + 1))]
+    previous = ""
+    i = 0
+    while i < len(keys):
+        key = keys[i]
+        common = 0
+        limit = min(len(previous), len(key))
+        while common < limit and previous[common] == key[common]:
+            common += 1
+        del rows[common + 1:]
+
+        skipped = False
+        for depth in range(common, len(key)):
+            above = rows[-1]
+            row = [above[0] + 1]
+            for j in range(1, len(query) + 1):
+                row.append(min(row[j - 1] + 1, above[j] + 1, above[j - 1] + (query[j - 1] != key[depth])))
+            rows.append(row)
+            if min(row) > max_distance:
+                i = bisect_left(keys, key[:depth + 1] + _PREFIX_END, i)
+                skipped = True
+                break
+        previous = key[:len(rows) - 1]
+        if not skipped:
+            if rows[-1][-1] <= max_distance:
+                found.append((rows[-1][-1], i))
+            i += 1
+    return found
+
+
+class _Queries:
+    # The searches shared by SearchIndex and MappedIndex. Subclasses provide _keys (sorted folded spellings),
+    # _key_rows (the row of each key), _postings(token), word(row) and _language(row).
+
+    def _matches(self, rows, language, limit):
+        words = []
+        for row in rows:
+            if language is None or self._language(row) == language:
+                words.append(self.word(row))
+                if len(words) == limit:
+                    break
+        return words
+
+    def prefix(self, text, limit=10, language=None):
+        """
+        Autocompletes a spelling
+        :param text: The start of a spelling
+        :param limit: Most words returned
+        :param language: Only return words of this language, or None for every language
+        :return: A list of structures.Word, shortest spellings first
+        """
+        start, end = _prefix_range(self._keys, normalize_key(text))
+        if language is None:
+            candidates = heapq.nsmallest(limit, range(start, end), key=lambda i: (len(self._keys[i]), self._keys[i]))
+        else:
+            # Words of other languages are skipped, so candidates are popped off a heap until enough matched
+            heap = [(len(self._keys[i]), self._keys[i], i) for i in range(start, end)]
+            heapq.heapify(heap)
+            candidates = (heapq.heappop(heap)[2] for _ in range(len(heap)))
+        return self._matches((self._key_rows[i] for i in candidates), language, limit)
+
+    def fuzzy(self, text, max_distance=2, limit=10, language=None):
+        """
+        Finds spellings within an edit distance of text, so misspelled words still match
+        :param text: A spelling
+        :param max_distance: Most insertions, deletions and substitutions a match may differ by
+        :param limit: Most words returned
+        :param language: Only return words of this language, or None for every language
+        :return: A list of (distance, structures.Word) tuples, closest first
+        """
+        found = sorted(_fuzzy_rows(self._keys, normalize_key(text), max_distance))
+        matches = []
+        for distance, i in found:
+            row = self._key_rows[i]
+            if language is None or self._language(row) == language:
+                matches.append((distance, self.word(row)))
+                if len(matches) == limit:
+                    break
+        return matches
+
+    def search(self, query, limit=10, language=None):
+        """
+        Finds words whose definition or etymology contains every word of query
+        :param query: Words to look for, e.g. "proto germanic bath"
+        :param limit: Most words returned
+        :param language: Only return words of this language, or None for every language
+        :return: A list of structures.Word in the order they were added
+        """
+        postings = [self._postings(token) for token in set(tokenize(query))]
+        if not postings:
+            return []
+        postings.sort(key=len)
+        rows = set(postings[0])
+        for other in postings[1:]:
+            rows.intersection_update(other)
+        return self._matches(sorted(rows), language, limit)
+
+    def suggest(self, text, language=None, limit=5):
+        """
+        Suggests words for a spelling that wasn't found: close spellings in the language first, then close
+        spellings in other languages and spellings the text is the start of
+        :return: A list of structures.Word
+        """
+        suggestions = []
+        for candidates in ([word for _, word in self.fuzzy(text, limit=limit, language=language)],
+                           [word for _, word in self.fuzzy(text, limit=limit)],
+                           self.prefix(text, limit=limit)):
+            for word in candidates:
+                if word not in suggestions:
+                    suggestions.append(word)
+        return suggestions[:limit]
+
+
+class SearchIndex(_Queries):
+    """
+    In-memory search index that words can be added to as they are looked up
+    """
+    def __init__(self, words=()):
+        """
+        :param words: structures.Word objects to start with
+        """
+        self.table = structures.WordTable()
+        self._keys = []
+        self._key_rows = []
+        # Token to the set of rows whose definition or etymology contains it
+        self._index = {}
+        # Tokens of each row, to take a replaced word's old tokens out of the index
+        self._row_tokens = []
+        self.add_many(words)
+
+    def add(self, word):
+        """
+        Adds a word, replacing an earlier word with the same spelling and language
+        :param word: A structures.Word
+        :return: The word's row number
+        """
+        return self._add(word, True)
+
+    def add_many(self, words):
+        """
+        Adds many words, see add. The spellings are sorted once at the end instead of being inserted one by one.
+        """
+        for word in words:
+            self._add(word, False)
+        if len(self._key_rows) < len(self.table):
+            for row in range(len(self._key_rows), len(self.table)):
+                self._keys.append(normalize_key(self.table.spellings[row]))
+                self._key_rows.append(row)
+            order = sorted(range(len(self._keys)), key=self._keys.__getitem__)
+            self._keys = [self._keys[i] for i in order]
+            self._key_rows = [self._key_rows[i] for i in order]
+
+    def _add(self, word, insert_key):
+        # With insert_key False the word's spelling is left for add_many to add to the keys
+        rows = len(self.table)
+        row = self.table.append(word)
+        tokens = set(tokenize(word.meaning + " " + word.etymology))
+        if row == rows:
+            if insert_key:
+                key = normalize_key(word.spelling)
+                position = bisect_right(self._keys, key)
+                self._keys.insert(position, key)
+                self._key_rows.insert(position, row)
+            self._row_tokens.append(tokens)
+        else:
+            for token in self._row_tokens[row] - tokens:
+                self._index[token].discard(row)
+            self._row_tokens[row] = tokens
+        for token in tokens:
+            self._index.setdefault(token, set()).add(row)
+        return row
+
+    def add_result(self, result):
+        """
+        Adds a webscraper.lookup result if the word was found
+        :return: True if the word was added
+        """
+        if not result["exists"] or result["language"] not in result["languages"]:
+            return False
+        self.add(structures.Word.from_result(result))
+        return True
+
+    def word(self, row):
+        return self.table.row(row)
+
+    def _language(self, row):
+        return self.table.language_names[self.table.language_codes[row]]
+
+    def _postings(self, token):
+        return self._index.get(token, ())
+
+    def __len__(self):
+        return len(self.table)
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def save(self, path):
+        """
+        Writes the index to a file for MappedIndex (or SearchIndex.load) to read
+        """
+        tokens = sorted(token for token, rows in self._index.items() if rows)
+        postings = [sorted(self._index[token]) for token in tokens]
+        sections = [
+            _string_table([word.to_bytes() for word in self.table]),
+            _string_table([key.encode("utf-8") for key in self._keys]),
+            _uint_array(self._key_rows),
+            _string_table([token.encode("utf-8") for token in tokens]),
+            _uint_array(_offsets(len(rows) for rows in postings)),
+            _uint_array(row for rows in postings for row in rows),
+        ]
+        offsets = []
+        position = len(_MAGIC) + _HEADER.size
+        for section in sections:
+            offsets.append(position)
+            position += len(section)
+        with open(path, "wb") as f:
+            f.write(_MAGIC + _HEADER.pack(*offsets))
+            for section in sections:
+                f.write(section)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Reads a saved index back into memory so more words can be added to it
+        """
+        with MappedIndex(path) as mapped:
+            return cls(mapped)
+
+
+def index_store(local_store, index=None):
+    """
+    Adds every entry of a store filled by ingest.py to an index
+    :param local_store: A store.Store
+    :param index: The SearchIndex to add to, a new one if None
+    :return: The SearchIndex
+    """
+    index = index or SearchIndex()
+    for title, language, definition, pronunciation, etymology in local_store.entries():
+        spelling = title.replace("_", " ")
+        # Reconstructed words are stored under Reconstruction:Language/word
+        if spelling.startswith("Reconstruction:") and "/" in spelling:
+            spelling = "*" + spelling.split("/", 1)[1]
+        url = "https://en.wiktionary.org/wiki/" + title + "#" + language.replace(" ", "_")
+        index.add(structures.Word(spelling, pronunciation, url, definition, language, etymology))
+    return index
+
+
+# File format: the magic bytes, a header of the offsets of six sections and the sections. All integers are
+# little-endian uint32s and every section is padded to a multiple of 4 bytes.
+#   words       string table of Word.to_bytes records, in row order
+#   keys        string table of the folded spellings, sorted
+#   key rows    the row of each key
+#   tokens      string table of the indexed definition and etymology words, sorted
+#   posting offsets, postings
+#               the rows of token i are postings[offsets[i]:offsets[i + 1]], sorted
+# A string table is a count n, n + 1 offsets into the data that follows, and the data.
+_MAGIC = b"WETYIDX1"
+_HEADER = struct.Struct("<6I")
+
+
+def _pad(data):
+    return data + b"\0" * (-len(data) % 4)
+
+
+def _uint_array(values):
+    values = array("I", values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _offsets(lengths):
+    offsets = [0]
+    for length in lengths:
+        offsets.append(offsets[-1] + length)
+    return offsets
+
+
+def _string_table(items):
+    return _pad(_uint_array([len(items)] + _offsets(len(item) for item in items)) + b"".join(items))
+
+
+class _StringTable:
+    # Reads a string table out of a buffer without copying it
+    def __init__(self, buffer, offset, decode=False):
+        count = struct.unpack_from("<I", buffer, offset)[0]
+        self.offsets = buffer[offset + 4:offset + 8 + 4 * count].cast("I")
+        self.data = offset + 8 + 4 * count
+        self.buffer = buffer
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        item = self.buffer[self.data + self.offsets[i]:self.data + self.offsets[i + 1]]
+        return str(item, "utf-8") if self.decode else item
+
+
+class MappedIndex(_Queries):
+    """
+    Answers the same queries as SearchIndex from a saved index file, which is memory-mapped instead of read so
+    opening it is instant and its pages are shared between processes
+    """
+    def __init__(self, path):
+        if sys.byteorder == "big":
+            raise ValueError("MappedIndex reads little-endian files and can't be used on big-endian machines")
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        if bytes(buffer[:len(_MAGIC)]) != _MAGIC:
+            buffer.release()
+            self._mmap.close()
+            raise ValueError(path + " isn't a search index")
+        words, keys, key_rows, tokens, posting_offsets, postings = _HEADER.unpack_from(buffer, len(_MAGIC))
+        self._words = _StringTable(buffer, words)
+        self._keys = _StringTable(buffer, keys, decode=True)
+        self._key_rows = buffer[key_rows:key_rows + 4 * len(self._keys)].cast("I")
+        self._tokens = _StringTable(buffer, tokens, decode=True)
+        self._posting_offsets = buffer[posting_offsets:posting_offsets + 4 * (len(self._tokens) + 1)].cast("I")
+        self._posting_rows = buffer[postings:postings + 4 * self._posting_offsets[-1]].cast("I")
+        self._buffer = buffer
+
+    def word(self, row):
+        return structures.Word.from_bytes(self._words[row])
+
+    def _language(self, row):
+        return self.word(row).language
+
+    def _postings(self, token):
+        i = bisect_left(self._tokens, token)
+        if i == len(self._tokens) or self._tokens[i] != token:
+            return ()
+        return self._posting_rows[self._posting_offsets[i]:self._posting_offsets[i + 1]]
+
+    def __len__(self):
+        return len(self._words)
+
+    def __iter__(self):
+        for row in range(len(self._words)):
+            yield self.word(row)
+
+    def close(self):
+        # Every view of the map has to be released before it can be closed
+        for view in (self._words.offsets, self._keys.offsets, self._tokens.offsets, self._key_rows,
+                     self._posting_offsets, self._posting_rows, self._buffer):
+            view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search words that were already looked up or ingested")
+    parser.add_argument("index", help="index file")
+    parser.add_argument("text", nargs="?", help="text to search for")
+    parser.add_argument("--build", metavar="STORE", help="index the entries of a store filled by ingest.py")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--prefix", action="store_const", dest="mode", const="prefix", help="autocomplete spellings")
+    mode.add_argument("--fuzzy", action="store_const", dest="mode", const="fuzzy", help="find close spellings")
+    mode.add_argument("--search", action="store_const", dest="mode", const="search",
+                      help="find words in definitions and etymologies")
+    parser.add_argument("--language", help="only show words of this language")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.build is not None:
+        local_store = store.Store(args.build)
+        index_store(local_store).save(args.index)
+        local_store.close()
+    if args.text is not None:
+        with MappedIndex(args.index) as index:
+            if args.mode == "fuzzy":
+                words = [word for _, word in index.fuzzy(args.text, limit=args.limit, language=args.language)]
+            elif args.mode == "search":
+                words = index.search(args.text, args.limit, args.language)
+            else:
+                words = index.prefix(args.text, args.limit, args.language)
+            for word in words:
+                print(word.spelling + " (" + word.language + ")  " + word.url)
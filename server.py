@@ -0,0 +1,222 @@
+# Long-running lookup service that keeps connections, caches and parsed state warm between requests
+#
+# GET /lookup?word=bath&language=English   the webscraper.lookup result as JSON
+# GET /metrics                              request counts and latency percentiles as JSON
+#
+# Start it with: python main.py --serve
+import json
+import threading
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, parse_qs, urlencode
+from urllib.request import urlopen
+import languages
+import webscraper as ws
+
+DEFAULT_ADDRESS = "http://127.0.0.1:8765"
+
+
+class ServiceError(Exception):
+    """
+    Raised by Client when the service couldn't answer a request
+    """
+
+
+class Coalescer:
+    """
+    Wraps a function so concurrent calls with the same arguments share one call. The first caller runs the function
+    and the others wait for its result (or exception).
+    """
+    def __init__(self, function):
+        self.function = function
+        # Number of calls that were answered by another caller's call
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self._lock:
+            future = self._in_flight.get(args)
+            leader = future is None
+            if leader:
+                future = self._in_flight[args] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = self.function(*args)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[args]
+
+
+class LatencyRecorder:
+    """
+    Keeps the latencies of the most recent requests to report percentiles of
+    """
+    def __init__(self, size=10000):
+        self.count = 0
+        self.errors = 0
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds, error=False):
+        with self._lock:
+            self.count += 1
+            if error:
+                self.errors += 1
+            self._latencies.append(seconds)
+
+    def percentiles(self, points=(50, 90, 99)):
+        """
+        :param points: Percentiles to report
+        :return: A dictionary like {"p50": seconds, ...}, with None values if nothing was recorded yet
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return {"p" + str(point): None for point in points}
+        return {"p" + str(point): latencies[min(len(latencies) - 1, len(latencies) * point // 100)]
+                for point in points}
+
+
+def lookup_key(word, language):
+    """
+    Normalizes a lookup so the spellings of the same one share a call: the word is stripped, NFC normalized and
+    written with spaces rather than underscores, as Wiktionary titles are, and the language is given by its name
+    :param word: The word to look up
+    :param language: Name, alias or code of a language, see languages.resolve
+    :return: A tuple (word, language)
+    """
+    return unicodedata.normalize("NFC", word).strip().replace("_", " "), languages.canonical_name(language)
+
+
+class LookupService:
+    """
+    Answers lookups for many clients. Identical (word, language) lookups that arrive while one is being done wait
+    for it instead of fetching the page again.
+    """
+    def __init__(self, lookup=ws.lookup):
+        """
+        :param lookup: Function looking up (word, language), webscraper.lookup by default
+        """
+        self._lookup = Coalescer(lookup)
+        self.latency = LatencyRecorder()
+
+    def lookup(self, word, language):
+        """
+        :return: The same dictionary as webscraper.lookup. Lookups are coalesced by the page they read, so the word is
+                 normalized like Wiktionary titles are and the language is given by its name, see lookup_key.
+        """
+        start = time.perf_counter()
+        error = True
+        try:
+            result = self._lookup(*lookup_key(word, language))
+            error = False
+            return result
+        finally:
+            self.latency.record(time.perf_counter() - start, error)
+
+    def metrics(self):
+        """
+        :return: A dictionary of request counts and lookup latency percentiles in seconds
+        """
+        metrics = {"requests": self.latency.count, "errors": self.latency.errors, "coalesced": self._lookup.coalesced,
+                   "latency_seconds": self.latency.percentiles()}
+        if ws.get_cache() is not None:
+            metrics["cache"] = dict(ws.get_cache().stats)
+        return metrics
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        if parts.path == "/lookup":
+            if "word" not in query or "language" not in query:
+                self._send(400, {"error": "word and language are required"})
+                return
+            try:
+                self._send(200, self.service.lookup(query["word"], query["language"]))
+            except Exception as e:
+                self._send(500, {"error": type(e).__name__ + ": " + str(e)})
+        elif parts.path == "/metrics":
+            self._send(200, self.service.metrics())
+        else:
+            self._send(404, {"error": "unknown path " + parts.path})
+
+    def _send(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Requests aren't logged, /metrics summarizes them
+        pass
+
+
+def make_server(host="127.0.0.1", port=8765, service=None):
+    """
+    Creates the HTTP server, which handles each request on its own thread
+    :param service: The LookupService to answer with, a new one if None
+    :return: A ThreadingHTTPServer, call serve_forever on it to start it
+    """
+    handler = type("Handler", (_Handler,), {"service": service or LookupService()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class Client:
+    """
+    Looks words up through a running service
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=60):
+        """
+        :param address: The service's base url
+        :param timeout: Seconds to wait for an answer
+        """
+        self.address = address.rstrip("/")
+        self.timeout = timeout
+
+    def _get(self, path):
+        try:
+            with urlopen(self.address + path, timeout=self.timeout) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except HTTPError as e:
+            raise ServiceError(json.loads(e.read().decode("utf-8")).get("error", str(e)))
+        except (URLError, OSError) as e:
+            raise ServiceError("lookup service unavailable at " + self.address + ": " + str(e))
+
+    def available(self):
+        """
+        :return: True if the service answers, False otherwise
+        """
+        try:
+            self.metrics()
+            return True
+        except ServiceError:
+            return False
+
+    def lookup(self, word, language):
+        """
+        :return: The same dictionary as webscraper.lookup
+        """
+        return self._get("/lookup?" + urlencode({"word": word, "language": language}))
+
+    def metrics(self):
+        return self._get("/metrics")
@@ -0,0 +1,193 @@
+# Local SQLite store of extracted Wiktionary entries, filled by ingest.py
+import json
+import sqlite3
+import threading
+from urllib.parse import urlsplit, unquote
+
+
+def page_title(url):
+    """
+    Returns the title of the page a Wiktionary url points to, the key pages are stored under
+    :param url: A Wiktionary url, e.g. "https://en.wiktionary.org/wiki/d%C3%A9j%C3%A0_vu#English"
+    :return: The title with spaces written as underscores, e.g. "déjà_vu"
+    """
+    path = unquote(urlsplit(url).path)
+    if path.startswith("/wiki/"):
+        path = path[len("/wiki/"):]
+    return path.replace(" ", "_")
+
+
+class StoredPage:
+    """
+    A page read back from the store. It answers the same questions as webscraper.WiktionaryPage without
+    going to the network.
+    """
+    def __init__(self, url, exists, languages, entries):
+        """
+        :param url: A Wiktionary url
+        :param exists: True if the page was in the dump
+        :param languages: Names of the language sections on the page, in order
+        :param entries: A dictionary of language names to (definition, pronunciation, etymology) tuples
+        """
+        self.url = url
+        self.exists = exists
+        self.languages = languages
+        self._entries = entries
+
+    def section_soup(self, language):
+        """
+        :return: None, the store keeps the entries extracted from each section rather than its html
+        """
+        return None
+
+    def definition(self, language, prune=None):
+        """
+        :param prune: Ignored, definitions are pruned when they are ingested
+        :return: Definition entry of the language's section, "Not found." if there isn't one
+        """
+        return self._entries.get(language, ("Not found.",) * 3)[0]
+
+    def pronunciation(self, language):
+        """
+        :return: Pronunciation of the language's section, "Not found." if there isn't one
+        """
+        return self._entries.get(language, ("Not found.",) * 3)[1]
+
+    def etymology(self, language):
+        """
+        :return: Etymology of the language's section, "Not found." if there isn't one
+        """
+        return self._entries.get(language, ("Not found.",) * 3)[2]
+
+
+class Store:
+    """
+    Extracted definitions, pronunciations and etymologies indexed by (page title, language). Each page also keeps
+    the revision and ETag it was extracted from, and each entry a hash of its section's html, so refresh.py can
+    tell what changed since.
+    """
+    def __init__(self, path):
+        """
+        :param path: File the store is kept in, ":memory:" for a store that isn't saved
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, revision TEXT, languages TEXT);
+            CREATE TABLE IF NOT EXISTS entries (
+                title TEXT, language TEXT, definition TEXT, pronunciation TEXT, etymology TEXT,
+                PRIMARY KEY (title, language));
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        # Stores made before pages had ETags and entries had section hashes
+        for table, column in (("pages", "etag"), ("entries", "hash")):
+            if column not in [row[1] for row in self._db.execute("PRAGMA table_info(" + table + ")")]:
+                self._db.execute("ALTER TABLE " + table + " ADD COLUMN " + column + " TEXT")
+        self._db.commit()
+
+    def put_pages(self, pages, checkpoint=None):
+        """
+        Stores a batch of extracted pages in one transaction
+        :param pages: A list of (title, revision, languages, entries) tuples where entries is a list of
+                      (language, definition, pronunciation, etymology) tuples, optionally followed by the section's
+                      hash (see webscraper.WiktionaryPage.section_hash)
+        :param checkpoint: An optional (name, value) pair saved in the same transaction, see get_checkpoint
+        """
+        with self._lock, self._db:
+            for title, revision, languages, entries in pages:
+                self._db.execute("DELETE FROM entries WHERE title = ?", (title,))
+                self._db.execute("INSERT OR REPLACE INTO pages (title, revision, languages) VALUES (?, ?, ?)",
+                                 (title, revision, json.dumps(languages, ensure_ascii=False)))
+                self._put_entries(title, entries)
+            if checkpoint is not None:
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (checkpoint[0], str(checkpoint[1])))
+
+    def _put_entries(self, title, entries):
+        self._db.executemany("INSERT OR REPLACE INTO entries (title, language, definition, pronunciation, etymology, "
+                             "hash) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(title,) + tuple(entry) + (None,) * (5 - len(entry)) for entry in entries])
+
+    def update_page(self, title, revision, etag, languages, changed_entries):
+        """
+        Stores a new version of a page of which only some sections changed. Entries of languages that are no
+        longer on the page are removed and the other entries are kept.
+        :param title: The page's title, see page_title
+        :param revision: Revision the new version was extracted from, or None
+        :param etag: ETag of the response the new version came in, or None
+        :param languages: Names of the language sections on the new version, in order
+        :param changed_entries: A list of (language, definition, pronunciation, etymology, hash) tuples of the
+                                sections that changed
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO pages (title, revision, languages, etag) VALUES (?, ?, ?, ?)",
+                             (title, revision, json.dumps(languages, ensure_ascii=False), etag))
+            self._db.execute("DELETE FROM entries WHERE title = ? AND language NOT IN (SELECT value FROM json_each(?))",
+                             (title, json.dumps(languages)))
+            self._put_entries(title, changed_entries)
+
+    def delete_page(self, title):
+        """
+        Removes a page and its entries, e.g. once it was deleted from Wiktionary
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM entries WHERE title = ?", (title,))
+            self._db.execute("DELETE FROM pages WHERE title = ?", (title,))
+
+    def versions(self, after=None, limit=1000):
+        """
+        Lists the stored pages a batch at a time, in title order
+        :param after: Title the batch starts after, None for the first batch
+        :param limit: Most pages returned
+        :return: A list of (title, revision, etag) tuples, empty after the last page
+        """
+        with self._lock:
+            return self._db.execute("SELECT title, revision, etag FROM pages WHERE title > ? ORDER BY title LIMIT ?",
+                                    ("" if after is None else after, limit)).fetchall()
+
+    def section_hashes(self, title):
+        """
+        :return: A dictionary of the page's languages to the hashes of the sections their entries were extracted
+                 from, None for entries stored without one
+        """
+        with self._lock:
+            return dict(self._db.execute("SELECT language, hash FROM entries WHERE title = ?", (title,)))
+
+    def get_checkpoint(self, name):
+        """
+        :param name: Name the checkpoint was saved under
+        :return: The checkpoint's value (string), None if it was never saved
+        """
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def page(self, url):
+        """
+        Reads a page from the store
+        :param url: A Wiktionary url
+        :return: A StoredPage, whose exists is False if the page isn't in the store
+        """
+        title = page_title(url)
+        with self._lock:
+            row = self._db.execute("SELECT languages FROM pages WHERE title = ?", (title,)).fetchone()
+            if row is None:
+                return StoredPage(url, False, [], {})
+            entries = {language: (definition, pronunciation, etymology) for language, definition, pronunciation, etymology
+                       in self._db.execute("SELECT language, definition, pronunciation, etymology FROM entries "
+                                           "WHERE title = ?", (title,))}
+        return StoredPage(url, True, json.loads(row[0]), entries)
+
+    def entries(self):
+        """
+        :return: A list of every stored (title, language, definition, pronunciation, etymology) tuple
+        """
+        with self._lock:
+            return self._db.execute("SELECT title, language, definition, pronunciation, etymology FROM entries "
+                                    "ORDER BY title, language").fetchall()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    def close(self):
+        self._db.close()
@@ -1,15 +1,236 @@
+import json
+import struct
+import sys
+import xml.etree.ElementTree as ET
+from array import array
+
+
 # Data structure to store word information
 class Word:
-    def __init__(self, spelling, ipa, url, meaning):
+    __slots__ = ("spelling", "ipa", "url", "meaning", "language", "etymology")
+
+    # Fields in the order they are written by to_bytes
+    _FIELDS = ("spelling", "ipa", "url", "meaning", "language", "etymology")
+    _HEADER = struct.Struct("<6I")
+
+    def __init__(self, spelling, ipa, url, meaning, language="", etymology=""):
         self.spelling = spelling
         self.ipa = ipa
         self.url = url
         self.meaning = meaning
+        self.language = language
+        self.etymology = etymology
+
+    # The IPA is the word's pronunciation
+    @property
+    def pronunciation(self):
+        return self.ipa
+
+    @pronunciation.setter
+    def pronunciation(self, value):
+        self.ipa = value
+
+    @classmethod
+    def from_result(cls, result):
+        """
+        Makes a word from a webscraper.lookup result
+        """
+        return cls(result["word"], result["pronunciation"], result["url"], result["definition"], result["language"],
+                   result["etymology"])
+
+    def to_bytes(self):
+        """
+        Serializes the word as a header of six field lengths followed by the UTF-8 encoded fields
+        :return: bytes that Word.from_bytes turns back into an equal word
+        """
+        encoded = [getattr(self, field).encode("utf-8") for field in self._FIELDS]
+        return self._HEADER.pack(*[len(e) for e in encoded]) + b"".join(encoded)
+
+    @classmethod
+    def from_bytes(cls, data, offset=0):
+        """
+        Reads a word written by to_bytes
+        :param data: bytes (or any buffer) holding the word
+        :param offset: Index in data the word starts at
+        :return: The Word
+        """
+        lengths = cls._HEADER.unpack_from(data, offset)
+        offset += cls._HEADER.size
+        fields = []
+        for length in lengths:
+            fields.append(bytes(data[offset:offset + length]).decode("utf-8"))
+            offset += length
+        return cls(*fields)
+
+    def __eq__(self, other):
+        if not isinstance(other, Word):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self._FIELDS)
+
+    # Equal words hash the same, so don't change a word while it's in a set or a dictionary key
+    def __hash__(self):
+        return hash(tuple(getattr(self, field) for field in self._FIELDS))
+
+    def __repr__(self):
+        return "Word(" + ", ".join(repr(getattr(self, field)) for field in self._FIELDS) + ")"
 
     def __str__(self):
         return self.spelling + " " + self.ipa + "\nDefinition: " + self.meaning + "\nWiktionary link: " + self.url
 
 
+class WordTable:
+    """
+    Stores many words column by column instead of as one object each. Language names repeat across most
+    entries, so each one is kept once and rows refer to it by number, and spellings shared between languages
+    are interned. Rows can be found by (spelling, language) in constant time.
+    """
+    def __init__(self, words=()):
+        self.spellings = []
+        self.ipas = []
+        self.urls = []
+        self.meanings = []
+        self.etymologies = []
+        # Rows hold the index of their language in language_names
+        self.language_codes = array("I")
+        self.language_names = []
+        self._language_index = {}
+        self._rows = {}
+        for word in words:
+            self.append(word)
+
+    def append(self, word):
+        """
+        Adds a word to the table, replacing the row of an earlier word with the same spelling and language
+        :param word: A Word
+        :return: The word's row number
+        """
+        code = self._language_index.get(word.language)
+        if code is None:
+            code = self._language_index[word.language] = len(self.language_names)
+            self.language_names.append(word.language)
+
+        key = (word.spelling, code)
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = len(self.spellings)
+            self.spellings.append(sys.intern(word.spelling))
+            self.ipas.append(word.ipa)
+            self.urls.append(word.url)
+            self.meanings.append(word.meaning)
+            self.etymologies.append(word.etymology)
+            self.language_codes.append(code)
+        else:
+            self.ipas[row] = word.ipa
+            self.urls[row] = word.url
+            self.meanings[row] = word.meaning
+            self.etymologies[row] = word.etymology
+        return row
+
+    def row(self, row):
+        """
+        :return: The Word stored in a row
+        """
+        return Word(self.spellings[row], self.ipas[row], self.urls[row], self.meanings[row],
+                    self.language_names[self.language_codes[row]], self.etymologies[row])
+
+    def get(self, spelling, language):
+        """
+        :return: The Word with the spelling and language, None if it isn't in the table
+        """
+        code = self._language_index.get(language)
+        if code is None:
+            return None
+        row = self._rows.get((spelling, code))
+        return None if row is None else self.row(row)
+
+    def __contains__(self, key):
+        spelling, language = key
+        return self.get(spelling, language) is not None
+
+    def __len__(self):
+        return len(self.spellings)
+
+    def __iter__(self):
+        for row in range(len(self.spellings)):
+            yield self.row(row)
+
+
+class EtymologyGraph:
+    """
+    Directed graph of words stored as adjacency lists. Nodes are (word, language) tuples, and an edge goes from a
+    word to an ancestor it derives from.
+    """
+    def __init__(self):
+        # Node attributes such as url, depth and red_link, keyed by (word, language)
+        self.nodes = {}
+        self.ancestors = {}
+        self.descendants = {}
+
+    def add_node(self, node, **attributes):
+        """
+        Adds a node, or updates the attributes of one that is already in the graph
+        :param node: A (word, language) tuple
+        """
+        if node not in self.nodes:
+            self.nodes[node] = {}
+            self.ancestors[node] = []
+            self.descendants[node] = []
+        self.nodes[node].update(attributes)
+
+    def add_edge(self, node, ancestor):
+        """
+        Records that node derives from ancestor, adding either node if needed
+        """
+        self.add_node(node)
+        self.add_node(ancestor)
+        if ancestor not in self.ancestors[node]:
+            self.ancestors[node].append(ancestor)
+            self.descendants[ancestor].append(node)
+
+    def edges(self):
+        """
+        :return: A list of (node, ancestor) tuples
+        """
+        return [(node, ancestor) for node, ancestors in self.ancestors.items() for ancestor in ancestors]
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def to_json(self):
+        """
+        :return: A JSON string with a "nodes" list of objects holding each word, language and its attributes, and an
+                 "edges" list of [node index, ancestor index] pairs
+        """
+        index = {node: i for i, node in enumerate(self.nodes)}
+        nodes = [dict(attributes, word=node[0], language=node[1]) for node, attributes in self.nodes.items()]
+        edges = [[index[node], index[ancestor]] for node, ancestor in self.edges()]
+        return json.dumps({"nodes": nodes, "edges": edges}, ensure_ascii=False)
+
+    def to_graphml(self):
+        """
+        :return: The graph as a GraphML document (string). Node attributes are written as GraphML data keys.
+        """
+        root = ET.Element("graphml", xmlns="http://graphml.graphdrawing.org/xmlns")
+        keys = ["word", "language"]
+        for attributes in self.nodes.values():
+            keys.extend(key for key in attributes if key not in keys)
+        for key in keys:
+            ET.SubElement(root, "key", {"id": key, "for": "node", "attr.name": key, "attr.type": "string"})
+
+        graph = ET.SubElement(root, "graph", id="etymology", edgedefault="directed")
+        index = {node: "n" + str(i) for i, node in enumerate(self.nodes)}
+        for node, attributes in self.nodes.items():
+            element = ET.SubElement(graph, "node", id=index[node])
+            for key, value in [("word", node[0]), ("language", node[1])] + list(attributes.items()):
+                ET.SubElement(element, "data", key=key).text = str(value)
+        for node, ancestor in self.edges():
+            ET.SubElement(graph, "edge", source=index[node], target=index[ancestor])
+        return ET.tostring(root, encoding="unicode")
+
+
 # Linked list
 class Node:
     def __init__(self, val, next_val=None):
@@ -22,4 +243,3 @@ class Node:
 class LinkedList:
     def __init__(self, head=None):
         self.head = head
-
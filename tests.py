@@ -1,13 +1,83 @@
+import asyncio
+import bz2
+import io
+import json
+import os
+import pstats
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
+import xml.etree.ElementTree as ET
+import benchmarks
+import cache
+import etymology
+import ingest
+import instrumentation
+import languages
+import main
+import normalize
+import parse_farm
+import ratelimit
+import refresh
+import search
+import server
+import store
 import structures as struct
+import transport
 import webscraper as ws
 
+TEST_PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_pages")
+# Pages TestWebscraper reads, saved by transport.DirectoryTransport
+RECORDED_PAGES = os.path.join(TEST_PAGES, "recorded")
+
+
+def read_test_page(name):
+    """
+    Returns the html of a saved page in the test_pages directory
+    """
+    with open(os.path.join(TEST_PAGES, name), encoding="utf-8") as f:
+        return f.read()
+
 class TestStructures(unittest.TestCase):
     def test_word(self):
         result = struct.Word("red", "/ɹɛd/", "https://en.wiktionary.org/wiki/red", "Having red as its color.")
         self.assertEqual(str(result), "red /ɹɛd/\nDefinition: Having red as its color.\nWiktionary link: "
                                       "https://en.wiktionary.org/wiki/red")
 
+    def test_word_fields(self):
+        word = struct.Word("bath", "/baːθ/", "https://en.wiktionary.org/wiki/bath#Welsh", "coin, money", "Welsh",
+                           "Probably from Proto-Celtic *batto-.")
+        self.assertEqual(word.pronunciation, "/baːθ/")
+        self.assertFalse(hasattr(word, "__dict__"))
+        with self.assertRaises(AttributeError):
+            word.colour = "red"
+        self.assertEqual(struct.Word.from_bytes(word.to_bytes()), word)
+        data = b"xx" + word.to_bytes()
+        self.assertEqual(struct.Word.from_bytes(memoryview(data), 2), word)
+        self.assertEqual(len({word, struct.Word.from_bytes(word.to_bytes())}), 1)
+
+    def test_word_table(self):
+        words = [struct.Word("bath", "/bɑːθ/", "u1", "A tub.", "English"),
+                 struct.Word("bath", "/baːθ/", "u2", "coin", "Welsh"),
+                 struct.Word("land", "/lænd/", "u3", "Ground.", "English")]
+        table = struct.WordTable(words)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.language_names, ["English", "Welsh"])
+        self.assertEqual(list(table.language_codes), [0, 1, 0])
+        self.assertEqual(table.get("bath", "Welsh"), words[1])
+        self.assertIsNone(table.get("bath", "German"))
+        self.assertIn(("land", "English"), table)
+        self.assertEqual(list(table), words)
+        # Adding the same (spelling, language) again replaces the row
+        self.assertEqual(table.append(struct.Word("land", "/lɛnd/", "u3", "Ground.", "English")), 2)
+        self.assertEqual(table.get("land", "English").ipa, "/lɛnd/")
+        self.assertEqual(len(table), 3)
+
     # Tests the Node class too
     def test_linkedlist(self):
         list1 = struct.LinkedList()
@@ -32,6 +102,22 @@ class TestStructures(unittest.TestCase):
 
 
 class TestWebscraper(unittest.TestCase):
+    # These tests replay the pages saved in test_pages/recorded, simplified copies of the Wiktionary pages, or in
+    # WIKTIONARY_PAGES if it is set. Setting WIKTIONARY_RECORD=1 downloads the pages that are missing from the
+    # directory and saves them, and setting WIKTIONARY_LIVE=1 checks the live site instead.
+    @classmethod
+    def setUpClass(cls):
+        cls.old_transport = None
+        if not os.environ.get("WIKTIONARY_LIVE"):
+            record_from = transport.PooledTransport() if os.environ.get("WIKTIONARY_RECORD") else None
+            pages = os.environ.get("WIKTIONARY_PAGES") or RECORDED_PAGES
+            cls.old_transport = ws.set_transport(transport.DirectoryTransport(pages, record_from))
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.old_transport is not None:
+            ws.set_transport(cls.old_transport)
+
     def test_get_wiki_url(self):
         # Test non-reconstructed word urls
         inputs_and_expected = {
@@ -128,5 +214,1124 @@ class TestWebscraper(unittest.TestCase):
             self.assertEqual(expected, ws.get_wiki_definition(inputs[0], inputs[1]))
 
 
+class TestWiktionaryPage(unittest.TestCase):
+    url = "https://en.wiktionary.org/wiki/bath"
+
+    def setUp(self):
+        self.old_transport = ws.set_transport(transport.FakeTransport({self.url: read_test_page("bath.html")}))
+        ws.reset_page_stats()
+
+    def tearDown(self):
+        ws.set_transport(self.old_transport)
+
+    def test_single_fetch_and_parse(self):
+        page = ws.WiktionaryPage(self.url)
+        self.assertEqual(page.languages, ["English", "Welsh"])
+        for language in page.languages:
+            page.definition(language)
+            page.pronunciation(language)
+            page.etymology(language)
+        self.assertEqual(ws.page_stats, {"fetches": 1, "parses": 1})
+
+    def test_extractors(self):
+        page = ws.WiktionaryPage(self.url)
+        self.assertEqual(page.definition("English"),
+                         "bath (plural baths)\n"
+                         "    1. A tub or pool which is used for bathing.\n"
+                         "    2. The act of bathing.\n"
+                         "    3. A building or area where bathing occurs.\n"
+                         "    4. The act of bathing.")
+        self.assertEqual(page.pronunciation("English"), "enPR: bäth, IPA: /bɑːθ/\nenPR: băth, IPA: /bæθ/")
+        self.assertEqual(page.etymology("English"),
+                         "From Middle English bath, from Old English bæþ (“bath”), from Proto-Germanic *baþą (“bath”).")
+        self.assertEqual(page.definition("Welsh"), "bath m (plural bathau)\n    1. coin, money\n    2. stamp, impression")
+        self.assertEqual(page.pronunciation("Welsh"), "IPA: /baːθ/")
+        self.assertEqual(page.etymology("Welsh"), "Probably from Proto-Celtic *batto-.[1]")
+        for extractor in (page.definition, page.pronunciation, page.etymology):
+            self.assertEqual(extractor("qwerty"), "Not found.")
+
+    def test_module_functions(self):
+        self.assertEqual(ws.get_wiki_url("bath", "Welsh"), ["https://en.wiktionary.org/wiki/bath#Welsh", True])
+        self.assertEqual(ws.get_wiki_url("bath", "German"), ["https://en.wiktionary.org/wiki/bath#German", False])
+        self.assertEqual(ws.languages_on_page(self.url), ["English", "Welsh"])
+        self.assertEqual(ws.get_wiki_pronunciation(self.url, "Welsh"), "IPA: /baːθ/")
+        self.assertEqual(ws.get_wiki_url("sjksjweqwqe", "English"), None)
+
+
+class TestSections(unittest.TestCase):
+    def test_index_sections(self):
+        soup = ws.BeautifulSoup(read_test_page("bath.html"), "lxml")
+        sections = ws.index_sections(soup)
+        self.assertEqual(list(sections), ["English", "Welsh"])
+        self.assertEqual([s.text for s in sections["English"].find_all("span", class_="mw-headline")],
+                         ["Etymology", "Pronunciation", "Noun", "Descendants"])
+        # The last section stops at the cache comment after the page content
+        self.assertTrue(str(sections["Welsh"]).rstrip().endswith("</ol>"))
+
+    def test_matches_legacy_slicing(self):
+        soup = ws.BeautifulSoup(benchmarks.synthetic_page(4), "lxml")
+        sections = ws.index_sections(soup)
+        names = list(sections)
+        self.assertEqual(names, ["Language 1", "Language 2", "Language 3", "Language 4"])
+        for name in names:
+            legacy = benchmarks.legacy_section_soup(soup, names, name)
+            for extractor in (ws._definition_from_section, ws._pronunciation_from_section, ws._etymology_from_section):
+                self.assertEqual(extractor(sections[name]), extractor(legacy))
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_synthetic_senses(self):
+        self.addCleanup(ws.set_backend, ws.get_backend())
+        ws.set_backend("bs4")
+        page = ws.WiktionaryPage("https://en.wiktionary.org/wiki/huge", html=benchmarks.synthetic_page(2, senses=10))
+        self.assertEqual(page.languages, ["Language 1", "Language 2"])
+        self.assertEqual(len(page.section_soup("Language 2").find_all("ol")[0].find_all("li", recursive=False)), 10)
+
+    def test_run_suite(self):
+        old_transport = ws._transport
+        results = benchmarks.run_suite(benchmarks.corpus()[:2], repeat=2)
+        self.assertEqual(len(results), 2 * (len(benchmarks.SUITE) + 1))
+        for result in results.values():
+            self.assertGreater(result["calls_per_second"], 0)
+            self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+            self.assertGreater(result["peak_kb"], 0)
+        # The suite puts the transport it replaced back
+        self.assertIs(ws._transport, old_transport)
+
+    def test_compare_to_baseline(self):
+        baseline = {"a/small": {"p50_ms": 10.0}, "b/small": {"p50_ms": 10.0}, "c/small": {"p50_ms": 0.1}}
+        results = {"a/small": {"p50_ms": 11.0}, "b/small": {"p50_ms": 20.0}, "c/small": {"p50_ms": 0.3},
+                   "d/small": {"p50_ms": 99.0}}
+        # a is within the tolerance, c is below the noise floor and d has no baseline
+        self.assertEqual(benchmarks.compare_to_baseline(results, baseline), [("b/small", 10.0, 20.0)])
+
+    def test_baseline(self):
+        with open(benchmarks.BASELINE) as f:
+            baseline = json.load(f)
+        # The committed baseline covers every benchmark of the built in corpus
+        functions = list(benchmarks.SUITE) + ["remove_inner_tags"]
+        self.assertEqual(set(baseline), {function + "/" + page[0] for page in benchmarks.corpus()
+                                         for function in functions})
+
+        # The gate passes against it, with a tolerance wide enough for a slower machine...
+        command = [sys.executable, "benchmarks.py", "suite", "--pages", "small", "reconstruction", "--repeat", "3",
+                   "--functions", "get_wiki_definition", "languages_on_page", "--backend", "bs4"]
+        run = subprocess.run(command + ["--baseline", "--tolerance", "9"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(benchmarks.__file__)))
+        self.assertEqual(run.returncode, 0, run.stdout + run.stderr)
+
+        # ...and fails against a baseline the functions are far slower than
+        fast = {key: dict(result, p50_ms=result["p50_ms"] / 1000) for key, result in baseline.items()}
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(fast, f)
+        self.addCleanup(os.remove, f.name)
+        run = subprocess.run(command + ["--baseline", f.name], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(benchmarks.__file__)))
+        self.assertEqual(run.returncode, 1)
+        self.assertIn("REGRESSION get_wiki_definition/small", run.stdout)
+
+
+class TestLanguages(unittest.TestCase):
+    def setUp(self):
+        self.fake = transport.FakeTransport({"https://en.wiktionary.org/wiki/bath": read_test_page("bath.html")})
+        self.old_transport = ws.set_transport(self.fake)
+
+    def tearDown(self):
+        ws.set_transport(self.old_transport)
+
+    def test_resolve(self):
+        self.assertEqual(languages.resolve("old english"), ("ang", "Old English", False))
+        self.assertEqual(languages.resolve("Anglo-Saxon").name, "Old English")
+        self.assertEqual(languages.resolve("proto indo_european"), languages.resolve("PIE"))
+        self.assertTrue(languages.resolve("ine-pro").reconstructed)
+        self.assertIsNone(languages.resolve("Klingon"))
+        self.assertEqual(languages.canonical_name("Klingon"), "Klingon")
+
+    def test_entry_url(self):
+        self.assertEqual(ws.wiki_url("heofon", "old english"), "https://en.wiktionary.org/wiki/heofon#Old_English")
+        self.assertEqual(ws.wiki_url("bʰeh₁-", "PIE"),
+                         "https://en.wiktionary.org/wiki/Reconstruction:Proto-Indo-European/bʰeh₁-")
+        self.assertEqual(ws.wiki_url("*batto-", "Welsh"), "https://en.wiktionary.org/wiki/Reconstruction:Welsh/batto-")
+        # Languages that aren't in the table keep the old rules
+        self.assertEqual(ws.wiki_url("x", "Proto-Something"), "https://en.wiktionary.org/wiki/Reconstruction:"
+                                                                "Proto-Something/x")
+
+    def test_lookup_canonical_language(self):
+        result = ws.lookup("bath", "cy")
+        self.assertEqual((result["language"], result["pronunciation"]), ("Welsh", "IPA: /baːθ/"))
+        self.assertEqual(ws.get_wiki_url("bath", "welsh"), ["https://en.wiktionary.org/wiki/bath#Welsh", True])
+        url = "https://en.wiktionary.org/wiki/bath#Welsh"
+        self.assertEqual(ws.get_wiki_pronunciation(url, "cy"), "IPA: /baːθ/")
+        self.assertEqual(ws.get_wiki_etymology(url, "welsh"), ws.get_wiki_etymology(url, "Welsh"))
+        self.assertEqual(ws.get_wiki_definition(url, "cy"), result["definition"])
+        self.assertIsNotNone(ws.return_section_soup(url, "cy"))
+
+    def test_impossible_pairs(self):
+        for word, language in [("", "English"), ("*", "Proto-Germanic"), ("a|b", "English"), ("x" * 256, "English"),
+                               ("bath", "English1"), ("bath", "")]:
+            self.assertFalse(languages.is_possible(word, language))
+            self.assertFalse(ws.lookup(word, language)["exists"])
+        self.assertIsNone(ws.get_wiki_url("[bath]", "English"))
+        self.assertEqual(self.fake.requests, [])
+        self.assertTrue(languages.is_possible("bath", "Tok Pisin"))
+
+
+class TestPruning(unittest.TestCase):
+    html = ('<li>A tub <span class="cited-source gloss">(Smith)</span>of water.<dl><dd>An example.</dd></dl>'
+            '<div class="citation-whole"><div>nested</div> quote</div></li>')
+
+    def test_pruned_text(self):
+        li = ws.BeautifulSoup(self.html, "lxml").li
+        self.assertEqual(ws.pruned_text(li, ws.DEFINITION_PRUNE), "A tub of water.")
+        self.assertEqual(ws.pruned_text(li, [("dl", {})]), "A tub (Smith)of water.nested quote")
+        # The tree isn't modified
+        self.assertEqual(li.get_text(), "A tub (Smith)of water.An example.nested quote")
+
+    def test_remove_inner_tags(self):
+        li = ws.BeautifulSoup(self.html, "lxml").li
+        result = ws.remove_inner_tags("<div class=\"citation-whole\">", "</div>", li)
+        self.assertEqual(result.text, "A tub (Smith)of water.An example.")
+
+
+class TestNormalize(unittest.TestCase):
+    def test_first_sentence(self):
+        self.assertEqual(normalize.first_sentence("A tub. It holds water."), "A tub.")
+        self.assertEqual(normalize.first_sentence("coin, money"), "coin, money")
+        self.assertEqual(ws.remove_everything_after_period(""), "")
+
+    def test_pronunciation(self):
+        texts = ["enPR: bäth, IPA: /bɑːθ/ (key)", "enPR: bäth", "Audio (UK)", "Rhymes: -ɑːθ\nHomophones: Bath",
+                 "IPA: /bæθ/ ", "Syllabification: bath", "IPA: /bæθ/"]
+        self.assertEqual(normalize.normalize_pronunciation(texts), "enPR: bäth, IPA: /bɑːθ/ \nIPA: /bæθ/")
+
+    def test_definition(self):
+        entry = ("bath (plural baths) ", ["A tub.\nIt holds water.", "The act of bathing", "A tub.\nAgain."])
+        self.assertEqual(normalize.normalize_definition(*entry),
+                         "bath (plural baths)\n    1. A tub.\n    2. The act of bathing\n    3. A tub.")
+        self.assertEqual(normalize.normalize_definitions([entry, ("bath m", [])]),
+                         [normalize.normalize_definition(*entry), "bath m\n"])
+        self.assertEqual(normalize.normalize_pronunciations([["IPA: /baːθ/"], []]), ["IPA: /baːθ/", ""])
+
+
+class FakeAsyncClient:
+    """
+    Stands in for an httpx.AsyncClient, answering with a list of responses in order
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    async def get(self, url, headers=None):
+        self.urls.append(url)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def fake_http_response(status, text="", headers=None):
+    return types.SimpleNamespace(status_code=status, text=text, headers=headers or {})
+
+
+class TestTransport(unittest.TestCase):
+    def test_retry_delay(self):
+        self.assertEqual(transport.retry_delay(1, 0.5, retry_after="3"), 3)
+        for attempt in range(1, 6):
+            self.assertTrue(0 <= transport.retry_delay(attempt, 0.5, max_backoff=4) <= min(4, 0.5 * 2 ** (attempt - 1)))
+
+    def test_pooled_retries(self):
+        pooled = transport.PooledTransport(backoff=0)
+        responses = [fake_http_response(503), fake_http_response(429), fake_http_response(200, "ok")]
+        pooled.session.get = lambda url, headers, timeout: responses.pop(0)
+        self.assertEqual(pooled.get("https://en.wiktionary.org/wiki/bath"), (200, "ok", {}))
+        self.assertEqual(responses, [])
+
+        pooled.retries = 1
+        responses = [fake_http_response(503), fake_http_response(503)]
+        self.assertEqual(pooled.get("https://en.wiktionary.org/wiki/bath").status, 503)
+
+    def test_pooled_stream(self):
+        pooled = transport.PooledTransport(backoff=0)
+        closed = []
+        response = fake_http_response(200)
+        response.encoding = None
+        response.iter_content = lambda chunk_size, decode_unicode: iter(["<html>", "bath", "</html>"])
+        response.close = lambda: closed.append(True)
+        pooled.session.get = lambda url, headers, timeout, stream: response
+        streamed = pooled.stream("https://en.wiktionary.org/wiki/bath")
+        self.assertEqual(next(streamed.chunks), "<html>")
+        self.assertEqual(response.encoding, "utf-8")
+        # Closing the chunks part way through closes the response
+        streamed.chunks.close()
+        self.assertEqual(closed, [True])
+
+    def test_async_transport(self):
+        client = FakeAsyncClient([OSError("reset"), fake_http_response(500),
+                                  fake_http_response(200, read_test_page("bath.html"))])
+        async_transport = transport.AsyncTransport(backoff=0, client=client)
+        result = asyncio.run(ws.lookup_async("bath", "Welsh", async_transport))
+        self.assertEqual(result["pronunciation"], "IPA: /baːθ/")
+        self.assertEqual(client.urls, ["https://en.wiktionary.org/wiki/bath#Welsh"] * 3)
+
+    def test_directory_transport(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            live = transport.FakeTransport({"https://en.wiktionary.org/wiki/bath": "<html>bath</html>"})
+            recorder = transport.DirectoryTransport(tmp, record_from=live)
+            self.assertEqual(recorder.get("https://en.wiktionary.org/wiki/bath#English").text, "<html>bath</html>")
+            self.assertEqual(recorder.get("https://en.wiktionary.org/wiki/qwerty").status, 404)
+
+            replay = transport.DirectoryTransport(tmp)
+            self.assertEqual(replay.get("https://en.wiktionary.org/wiki/bath").text, "<html>bath</html>")
+            self.assertEqual(replay.get("https://en.wiktionary.org/wiki/qwerty").status, 404)
+            self.assertEqual(len(live.requests), 2)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestBackends(unittest.TestCase):
+    def setUp(self):
+        self.old_backend = ws.get_backend()
+
+    def tearDown(self):
+        ws.set_backend(self.old_backend)
+
+    def test_walks_stay_in_section(self):
+        # English has headings but no paragraph or list under them, Welsh's must not be read in their place
+        html = ('<html><body><h2><span class="mw-headline">English</span></h2>'
+                '<h3><span class="mw-headline">Etymology</span></h3><div>Unknown.</div>'
+                '<h3><span class="mw-headline">Pronunciation</span></h3><table><tr><td>/x/</td></tr></table>'
+                '<h3><span class="mw-headline">Noun</span></h3><p><b>word</b></p>'
+                '<h2><span class="mw-headline">Welsh</span></h2>'
+                '<h3><span class="mw-headline">Etymology</span></h3><p>Welsh etymology.</p>'
+                '<h3><span class="mw-headline">Pronunciation</span></h3><ul><li>IPA: /welsh/</li></ul>'
+                '<h3><span class="mw-headline">Noun</span></h3><p><b>word</b></p><ol><li>A Welsh word.</li></ol>'
+                '<!-- NewPP limit report --></body></html>')
+        for backend in ("bs4", "lxml"):
+            ws.set_backend(backend)
+            page = ws.WiktionaryPage("https://en.wiktionary.org/wiki/word", html=html)
+            self.assertEqual(page.etymology("English"), "Not found.")
+            self.assertEqual(page.pronunciation("English"), "Not found.")
+            self.assertEqual(page.definition("English"), "Not found.")
+            self.assertEqual(page.pronunciation("Welsh"), "IPA: /welsh/")
+            self.assertEqual(page.etymology("Welsh"), "Welsh etymology.")
+
+    def test_same_output(self):
+        pages = [("https://en.wiktionary.org/wiki/bath", read_test_page("bath.html")),
+                 ("https://en.wiktionary.org/wiki/Reconstruction:Proto-Germanic/baþą",
+                  read_test_page("proto_germanic_batha.html")),
+                 ("https://en.wiktionary.org/wiki/many", benchmarks.synthetic_page(4))]
+        for url, html in pages:
+            ws.set_backend("bs4")
+            soup_page = ws.WiktionaryPage(url, html=html)
+            ws.set_backend("lxml")
+            lxml_page = ws.WiktionaryPage(url, html=html)
+            self.assertEqual(lxml_page.backend, "lxml")
+            self.assertEqual(lxml_page.languages, soup_page.languages)
+            for language in soup_page.languages + ["Latin"]:
+                for extractor in ("definition", "pronunciation", "etymology", "etymology_links", "descendant_links"):
+                    self.assertEqual(getattr(lxml_page, extractor)(language), getattr(soup_page, extractor)(language),
+                                     url + " " + language + " " + extractor)
+                if language in soup_page.sections:
+                    self.assertEqual(lxml_page.section_soup(language).get_text(),
+                                     soup_page.section_soup(language).get_text())
+
+    def test_lookup(self):
+        old_transport = ws.set_transport(transport.FakeTransport({
+            "https://en.wiktionary.org/wiki/bath": read_test_page("bath.html"),
+        }))
+        self.addCleanup(ws.set_transport, old_transport)
+        ws.set_backend("lxml")
+        self.assertEqual(ws.lookup("bath", "Welsh")["pronunciation"], "IPA: /baːθ/")
+        self.assertEqual(len(ws.return_section_soup("https://en.wiktionary.org/wiki/bath", "Welsh").find_all("ol")), 1)
+
+    def test_set_backend(self):
+        with self.assertRaises(ValueError):
+            ws.set_backend("html5lib")
+
+    def test_lazy_imports(self):
+        code = ("import sys, main; print(' '.join(name for name in ('bs4', 'lxml', 'requests', 'asyncio') "
+                "if name in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.strip(), "")
+        # Nor does importing the webscraper on its own load the cache's database or the profiling, logging and
+        # thread pool modules
+        code = ("import sys, webscraper; print(' '.join(name for name in ('sqlite3', 'cProfile', 'logging', "
+                "'concurrent.futures') if name in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.strip(), "")
+        # Names that used to be imported from Beautiful Soup still work
+        from bs4 import BeautifulSoup
+        self.assertIs(ws.BeautifulSoup, BeautifulSoup)
+
+
+class TestStreaming(unittest.TestCase):
+    url = "https://en.wiktionary.org/wiki/many"
+
+    def setUp(self):
+        self.html = benchmarks.synthetic_page(20)
+        self.full = ws.WiktionaryPage(self.url, html=self.html)
+        self.old_transport = ws.set_transport(transport.FakeTransport({self.url: self.html}))
+
+    def tearDown(self):
+        ws.set_transport(self.old_transport)
+        ws.set_streaming(False)
+        ws.set_cache(None)
+
+    def test_read_section(self):
+        chunks = [self.html[i:i + 500] for i in range(0, len(self.html), 500)]
+        for language in ["Language 1", "Language 11", "Language 20", "Language 21"]:
+            read = []
+            html, complete, tree = ws.read_section((read.append(chunk) or chunk for chunk in chunks), language)
+            for page in (ws.WiktionaryPage(self.url, html=html), ws.WiktionaryPage(self.url, html, tree=tree)):
+                for extractor in ("definition", "pronunciation", "etymology", "descendant_links"):
+                    self.assertEqual(getattr(page, extractor)(language), getattr(self.full, extractor)(language))
+            # Only a language that isn't on the page needs the whole page
+            self.assertEqual(complete, language == "Language 21")
+            self.assertEqual(len(read) < len(chunks), language in ("Language 1", "Language 11"))
+
+    def test_streaming_functions(self):
+        ws.set_streaming(True)
+        self.assertEqual(ws.get_wiki_definition(self.url, "Language 2"), self.full.definition("Language 2"))
+        # Streamed pages keep the tree the streaming parser built, so they use the lxml backend
+        self.addCleanup(ws.set_backend, ws.get_backend())
+        ws.set_backend("lxml")
+        self.assertEqual(str(ws.return_section_soup(self.url, "Language 2")),
+                         str(ws.WiktionaryPage(self.url, html=self.html).section_soup("Language 2")))
+        page = ws.stream_page(self.url, "Language 2")
+        self.assertEqual(page.backend, "lxml")
+        self.assertFalse(page.complete)
+        self.assertEqual(page.languages, ["Language 1", "Language 2"])
+
+    def test_h2_text_before_section(self):
+        # "<h2" in a script isn't a heading, and mustn't throw off where the section ends
+        html = self.html.replace("</title>", '</title><script>var s = "<h2>";</script><!-- <h2 -->', 1)
+        self.assertNotEqual(html, self.html)
+        ws.set_transport(transport.FakeTransport({self.url: html}))
+        ws.set_streaming(True)
+        for language in ("Language 1", "Language 2", "Language 20"):
+            self.assertEqual(ws.get_wiki_definition(self.url, language), self.full.definition(language))
+        self.assertFalse(ws.stream_page(self.url, "Language 2").complete)
+
+    def test_streaming_cache(self):
+        c = cache.Cache(":memory:")
+        ws.set_cache(c)
+        # Partial pages aren't cached, pages read to the end are
+        self.assertFalse(ws.stream_page(self.url, "Language 2").complete)
+        self.assertIsNone(c.get_page(self.url))
+        self.assertTrue(ws.stream_page(self.url, "Klingon").complete)
+        self.assertEqual(c.get_page(self.url).html, self.html)
+        self.assertEqual(ws.stream_page(self.url, "Language 2").languages, self.full.languages)
+
+
+class TestCache(unittest.TestCase):
+    url = "https://en.wiktionary.org/wiki/bath"
+
+    def setUp(self):
+        self.html = read_test_page("bath.html")
+        self.fake = transport.FakeTransport({self.url: transport.Response(200, self.html, {"ETag": "\"v1\""})})
+        self.old_transport = ws.set_transport(self.fake)
+        ws.reset_page_stats()
+
+    def tearDown(self):
+        ws.set_transport(self.old_transport)
+        ws.set_cache(None)
+
+    def test_normalize_url(self):
+        self.assertEqual(cache.normalize_url("https://en.wiktionary.org/wiki/b%C3%A6%C3%BE#Old_English"),
+                         cache.normalize_url("HTTPS://en.wiktionary.org/wiki/bæþ"))
+
+    def test_page_hit(self):
+        ws.set_cache(cache.Cache(":memory:"))
+        self.assertEqual(ws.fetch(self.url), (200, self.html))
+        self.assertEqual(ws.fetch(self.url + "#Welsh"), (200, self.html))
+        self.assertEqual(ws.page_stats["fetches"], 1)
+
+    def test_result_hit_skips_parsing(self):
+        c = cache.Cache(":memory:")
+        ws.set_cache(c)
+        first = ws.lookup("bath", "Welsh")
+        self.assertEqual(first["pronunciation"], "IPA: /baːθ/")
+        self.assertEqual(ws.lookup("bath", "Welsh"), first)
+        self.assertEqual(ws.page_stats, {"fetches": 1, "parses": 1})
+        self.assertEqual((c.stats["result_hits"], c.stats["result_misses"]), (1, 1))
+
+    def test_revalidation(self):
+        c = cache.Cache(":memory:", ttl=0)
+        ws.set_cache(c)
+        ws.fetch(self.url)
+        self.fake.add(self.url, transport.Response(304, "", {}))
+        self.assertEqual(ws.fetch(self.url), (200, self.html))
+        self.assertEqual(self.fake.requests[-1][1], {"If-None-Match": "\"v1\""})
+        self.assertEqual(c.stats["revalidated"], 1)
+
+    def test_lru_eviction(self):
+        c = cache.Cache(":memory:")
+        c.put_page("https://en.wiktionary.org/wiki/a", 200, self.html)
+        c.max_bytes = c.size() * 2
+        c.put_page("https://en.wiktionary.org/wiki/b", 200, self.html)
+        c.get_page("https://en.wiktionary.org/wiki/a")
+        c.put_page("https://en.wiktionary.org/wiki/c", 200, self.html)
+        self.assertEqual(c.stats["evictions"], 1)
+        self.assertIsNone(c.get_page("https://en.wiktionary.org/wiki/b"))
+        self.assertIsNotNone(c.get_page("https://en.wiktionary.org/wiki/a"))
+
+    def test_offline(self):
+        c = cache.Cache(":memory:", ttl=0, offline=True)
+        ws.set_cache(c)
+        with self.assertRaises(cache.OfflineMiss):
+            ws.fetch(self.url)
+        c.put_page(self.url, 200, self.html)
+        self.assertEqual(ws.fetch(self.url), (200, self.html))
+        self.assertEqual(ws.page_stats["fetches"], 0)
+
+    def test_negative_cache(self):
+        # With ttl=0 every page cache hit would be revalidated, so requests only stop thanks to the negative cache
+        c = cache.Cache(":memory:", ttl=0)
+        ws.set_cache(c)
+        self.assertEqual(ws.lookup("bath", "Latin")["definition"], "Not found.")
+        self.assertEqual(ws.get_wiki_url("bath", "Latin"), [self.url + "#Latin", False])
+        self.assertEqual(ws.get_wiki_definition(self.url, "Latin"), "Not found.")
+        self.assertIsNone(ws.return_section_soup(self.url, "Latin"))
+        self.assertIsNone(ws.get_wiki_url("nosuchword", "English"))
+        self.assertFalse(ws.lookup("nosuchword", "French")["exists"])
+        self.assertEqual(len(self.fake.requests), 2)
+        self.assertEqual(c.stats["negative_hits"], 4)
+        # Languages that are on the page are still looked up
+        self.assertEqual(ws.lookup("bath", "Welsh")["pronunciation"], "IPA: /baːθ/")
+
+    def test_negative_ttl(self):
+        c = cache.Cache(":memory:", negative_ttl=0)
+        c.put_known_page(self.url, True, ["English"])
+        self.assertIsNone(c.get_known_page(self.url))
+        c.negative_ttl = 60
+        self.assertEqual(c.get_known_page(self.url + "#Welsh"), (True, ["English"]))
+        self.assertIsNone(c.get_known_page("https://en.wiktionary.org/wiki/other"))
+        self.assertEqual(c.stats["filter_skips"], 1)
+
+    def test_negative_ttl_covers_misses(self):
+        c = cache.Cache(":memory:", negative_ttl=60)
+        ws.set_cache(c)
+        missing = "https://en.wiktionary.org/wiki/newword"
+        self.assertFalse(ws.lookup("newword", "English")["exists"])
+        self.assertEqual(ws.lookup("bath", "Latin")["definition"], "Not found.")
+        requests = len(self.fake.requests)
+        # Once the misses expire, the 404 page and the results that found nothing are asked for again
+        c.negative_ttl = 0
+        self.fake.add(missing, read_test_page("bath.html"))
+        self.assertTrue(ws.lookup("newword", "English")["exists"])
+        self.assertEqual(ws.get_wiki_url("newword", "English"), [missing + "#English", True])
+        self.assertEqual(ws.lookup("bath", "Latin")["definition"], "Not found.")
+        self.assertEqual(len(self.fake.requests), requests + 1)
+        self.assertEqual(c.stats["result_misses"], 4)
+        # Results that found their section keep the normal ttl
+        self.assertTrue(ws.lookup("newword", "English")["exists"])
+        self.assertEqual(c.stats["result_hits"], 1)
+
+    def test_bloom_filter(self):
+        bloom = cache.BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add("word%d" % i)
+        self.assertTrue(all("word%d" % i in bloom for i in range(1000)))
+        false_positives = sum("other%d" % i in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+        copy = cache.BloomFilter.from_bytes(bloom.to_bytes())
+        self.assertEqual((copy.size, copy.hashes, copy.count, copy.bits), (bloom.size, bloom.hashes, 1000, bloom.bits))
+
+    def test_filter_persists(self):
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite")
+        c = cache.Cache(path)
+        c.put_known_page(self.url, False, [])
+        c.close()
+        c = cache.Cache(path)
+        self.assertEqual(c.get_known_page(self.url), (False, []))
+        # A filter that wasn't saved after the last change is rebuilt from the table
+        c.put_known_page("https://en.wiktionary.org/wiki/other", True, ["English"])
+        c._db.commit()
+        reopened = cache.Cache(path)
+        self.assertEqual(reopened.get_known_page("https://en.wiktionary.org/wiki/other"), (True, ["English"]))
+        reopened.close()
+        c.close()
+
+    def test_filter_kept_after_false_positive(self):
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite")
+        c = cache.Cache(path, filter_capacity=1)
+        c.put_known_page(self.url, False, [])
+        # Add a url the filter wrongly says it has seen, which doesn't change the filter's count
+        other = next(url for url in ("https://en.wiktionary.org/wiki/w%d" % i for i in range(10000))
+                     if cache.normalize_url(url) in c._filter)
+        c.put_known_page(other, True, ["English"])
+        self.assertEqual(c._filter.count, 1)
+        c.close()
+        # The saved filter is still used rather than rebuilt
+        reopened = cache.Cache(path)
+        self.assertEqual(reopened._filter.count, 1)
+        self.assertEqual(reopened.get_known_page(other), (True, ["English"]))
+        reopened.close()
+
+
+    def test_known_pages_cap(self):
+        c = cache.Cache(":memory:", negative_ttl=60, max_known_pages=10)
+        urls = ["https://en.wiktionary.org/wiki/w%d" % i for i in range(11)]
+        for url in urls[:10]:
+            c.put_known_page(url, True, ["English"])
+        # One entry has expired and another is the oldest of the rest
+        c._db.execute("UPDATE known_pages SET stored = stored - 100 WHERE url = ?", (urls[3],))
+        c._db.execute("UPDATE known_pages SET stored = stored - 10 WHERE url = ?", (urls[0],))
+        c.put_known_page(urls[10], False, [])
+        self.assertEqual(c.stats["known_page_evictions"], 2)
+        self.assertEqual([url for url in urls if c.get_known_page(url) is None], [urls[0], urls[3]])
+        # Replacing an entry doesn't count as a new one
+        c.put_known_page(urls[10], True, ["English"])
+        self.assertEqual(c.stats["known_page_evictions"], 2)
+
+
+class TestLookupMany(unittest.TestCase):
+    def setUp(self):
+        self.old_transport = ws.set_transport(transport.FakeTransport({
+            "https://en.wiktionary.org/wiki/bath": read_test_page("bath.html"),
+            "https://en.wiktionary.org/wiki/broken": ConnectionError("connection reset"),
+        }))
+
+    def tearDown(self):
+        ws.set_transport(self.old_transport)
+        ws.set_rate_limit(None)
+
+    def test_lookup_many(self):
+        pairs = [("bath", "English"), ("bath", "Welsh"), ("sjksjweqwqe", "English"), ("broken", "English")] * 10
+        results = list(ws.lookup_many(iter(pairs), workers=3))
+        self.assertEqual(len(results), len(pairs))
+        by_pair = {(r["word"], r["language"]): r for r in results}
+        self.assertEqual(by_pair[("bath", "Welsh")]["pronunciation"], "IPA: /baːθ/")
+        self.assertIsNone(by_pair[("bath", "Welsh")]["error"])
+        self.assertFalse(by_pair[("sjksjweqwqe", "English")]["exists"])
+        self.assertEqual(by_pair[("broken", "English")]["error"], "ConnectionError: connection reset")
+        # Failed lookups have the same keys as the others
+        self.assertEqual(list(by_pair[("broken", "English")]), list(by_pair[("bath", "Welsh")]))
+        self.assertIsNone(by_pair[("broken", "English")]["definition"])
+
+    def test_ordered(self):
+        pairs = [("bath", "English"), ("broken", "English"), ("sjksjweqwqe", "English"), ("bath", "Welsh")] * 10
+        results = list(ws.lookup_many(iter(pairs), workers=3, ordered=True))
+        self.assertEqual([(r["word"], r["language"]) for r in results], pairs)
+        self.assertEqual(results[1]["error"], "ConnectionError: connection reset")
+
+    def test_rate_limit(self):
+        limiter = ratelimit.HostRateLimiter(20, burst=1)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire("https://en.wiktionary.org/wiki/bath")
+        # A different host has its own bucket so it doesn't wait
+        limiter.acquire("https://example.org/")
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+        self.assertEqual(len(limiter._buckets), 2)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.old_transport = ws.set_transport(transport.FakeTransport({
+            "https://en.wiktionary.org/wiki/bath": read_test_page("bath.html"),
+        }))
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ws.set_transport(self.old_transport)
+        shutil.rmtree(self.tmp)
+
+    def test_read_records(self):
+        csv_file = io.StringIO("word,language\nbath,English\n\n\"a, b\",Welsh\n")
+        self.assertEqual(list(main.read_records(csv_file, "csv")), [("bath", "English"), ("a, b", "Welsh")])
+        jsonl = io.StringIO('{"word": "bath", "language": "cy"}\n\n{"word": "bæþ", "language": "ang"}\n')
+        self.assertEqual(list(main.read_records(jsonl)), [("bath", "cy"), ("bæþ", "ang")])
+        with self.assertRaisesRegex(ValueError, "line 2"):
+            list(main.read_records(io.StringIO('{"word": "bath", "language": "cy"}\n{"word": "bath"}\n')))
+
+    def test_run_batch(self):
+        out = io.StringIO()
+        records = [("bath", "Welsh"), ("bath", "cy"), ("sjksjweqwqe", "English")]
+        self.assertEqual(main.run_batch(iter(records), out, workers=2), 3)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([r["word"] for r in results], ["bath", "bath", "sjksjweqwqe"])
+        self.assertEqual(results[1]["language"], "Welsh")
+        self.assertEqual(results[1]["pronunciation"], "IPA: /baːθ/")
+        self.assertFalse(results[2]["exists"])
+        self.assertIsNone(results[2]["error"])
+
+    def test_resume(self):
+        records = [("bath", language) for language in ["English", "Welsh", "Latin", "German", "French", "Dutch"]]
+        checkpoint = os.path.join(self.tmp, "checkpoint.json")
+        output = os.path.join(self.tmp, "results.jsonl")
+
+        def crashing():
+            yield from records[:5]
+            raise KeyboardInterrupt
+
+        with open(output, "w", encoding="utf-8") as out:
+            with self.assertRaises(KeyboardInterrupt):
+                main.run_batch(crashing(), out, workers=1, checkpoint=checkpoint, checkpoint_every=2)
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f)["done"], 2)
+
+        with open(output, "a", encoding="utf-8") as out:
+            self.assertEqual(main.run_batch(iter(records), out, workers=1, checkpoint=checkpoint), 4)
+        with open(output, encoding="utf-8") as f:
+            languages_written = [json.loads(line)["language"] for line in f]
+        self.assertEqual(languages_written, [language for _, language in records])
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_resume_needs_seekable_output(self):
+        checkpoint = os.path.join(self.tmp, "checkpoint.json")
+        main._save_checkpoint(checkpoint, 2, None)
+        out = io.StringIO()
+        out.seekable = lambda: False
+        with self.assertRaises(IOError):
+            main.run_batch(iter([("bath", "Welsh")] * 3), out, workers=1, checkpoint=checkpoint)
+        self.assertEqual(out.getvalue(), "")
+        run = subprocess.run([sys.executable, "main.py", "--batch", "-", "--checkpoint", checkpoint],
+                             cwd=os.path.dirname(os.path.abspath(__file__)), input="", capture_output=True, text=True)
+        self.assertEqual(run.returncode, 2)
+        self.assertIn("--checkpoint needs an --output file", run.stderr)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.old_transport = ws.set_transport(transport.FakeTransport({
+            "https://en.wiktionary.org/wiki/bath": read_test_page("bath.html"),
+        }))
+
+    def tearDown(self):
+        ws.set_transport(self.old_transport)
+        instrumentation.disable()
+
+    def test_disabled(self):
+        self.assertFalse(instrumentation.enabled())
+        with instrumentation.span("lookup") as span:
+            self.assertIsNone(span)
+        instrumentation.count("parses")
+
+    def test_lookup_spans(self):
+        recorder = instrumentation.enable()
+        ws.lookup("bath", "Welsh")
+        trace = recorder.traces[-1]
+        self.assertEqual(trace.attrs, {"word": "bath", "language": "Welsh"})
+        self.assertEqual([(depth, span.name) for depth, span in trace.walk()],
+                         [(0, "lookup"), (1, "fetch"), (2, "transport"), (1, "parse"), (1, "index_sections"),
+                          (1, "definition"), (1, "pronunciation"), (1, "etymology")])
+        self.assertGreaterEqual(trace.duration, sum(child.duration for child in trace.children))
+        self.assertEqual(recorder.counters["fetches"], 1)
+        self.assertEqual(recorder.counters["parses"], 1)
+        self.assertEqual(recorder.counters["bytes_fetched"], len(read_test_page("bath.html")))
+        self.assertGreater(recorder.counters["nodes"], 0)
+        self.assertIn("webscraper_parses_total 1\n", recorder.prometheus())
+        self.assertIn('webscraper_stage_calls_total{stage="lookup"} 1\n', recorder.prometheus())
+
+    def test_sinks(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics_path = os.path.join(directory, "webscraper.prom")
+        profile_path = os.path.join(directory, "lookup.pstats")
+        self.addCleanup(ws.set_backend, ws.get_backend())
+        ws.set_backend("bs4")
+        with self.assertLogs("webscraper") as logs:
+            instrumentation.enable([instrumentation.LogSink(), instrumentation.PrometheusSink(metrics_path),
+                                    instrumentation.ProfileSink(profile_path)])
+            ws.lookup("bath", "English")
+        self.assertIn("transport", logs.output[0])
+        with open(metrics_path) as f:
+            self.assertIn("webscraper_fetches_total 1", f.read())
+        stats = pstats.Stats(profile_path)
+        self.assertTrue(any(function[2] == "_definition_from_section" for function in stats.stats))
+
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dump = os.path.join(self.tmp, "dump.xml.bz2")
+        with open(os.path.join(TEST_PAGES, "dump.xml"), "rb") as f, bz2.open(self.dump, "wb") as out:
+            shutil.copyfileobj(f, out)
+        # Lookups against the store must not touch the network
+        self.fake = transport.FakeTransport()
+        self.old_transport = ws.set_transport(self.fake)
+
+    def tearDown(self):
+        self.assertEqual(self.fake.requests, [])
+        ws.set_transport(self.old_transport)
+        ws.set_store(None)
+        shutil.rmtree(self.tmp)
+
+    def test_read_dump(self):
+        pages = list(ingest.read_dump(self.dump))
+        self.assertEqual([(title, revision) for title, html, revision in pages],
+                         [("bath", "71234567"), ("Reconstruction:Proto-Germanic/baþą", "70000001")])
+        self.assertEqual(pages[0][1], read_test_page("bath.html"))
+
+    def test_ingest_and_lookup(self):
+        local_store = store.Store(os.path.join(self.tmp, "store.sqlite"))
+        self.assertEqual(ingest.ingest(self.dump, local_store, processes=2, batch_size=1), 2)
+        self.assertEqual(len(local_store), 2)
+
+        ws.set_store(local_store)
+        self.assertEqual(ws.get_wiki_url("bath", "Welsh"), ["https://en.wiktionary.org/wiki/bath#Welsh", True])
+        self.assertEqual(ws.get_wiki_url("bath", "German"), ["https://en.wiktionary.org/wiki/bath#German", False])
+        self.assertEqual(ws.get_wiki_url("sjksjweqwqe", "English"), None)
+        self.assertEqual(ws.get_wiki_url("baþą", "Proto-Germanic"),
+                         ["https://en.wiktionary.org/wiki/Reconstruction:Proto-Germanic/baþą", True])
+        self.assertEqual(ws.get_wiki_pronunciation("https://en.wiktionary.org/wiki/bath#Welsh", "Welsh"), "IPA: /baːθ/")
+        self.assertEqual(ws.get_wiki_etymology("https://en.wiktionary.org/wiki/Reconstruction:Proto-Germanic/"
+                                               "ba%C3%BE%C4%85", "Proto-Germanic"),
+                         "From Proto-Indo-European *bʰeh₁- (“to warm”).")
+        self.assertEqual(ws.lookup("bath", "English")["definition"].split("\n")[1],
+                         "    1. A tub or pool which is used for bathing.")
+        # The store keeps no html, so there are no sections to return, and no page is downloaded for them
+        self.assertIsNone(ws.return_section_soup("https://en.wiktionary.org/wiki/bath#Welsh", "Welsh"))
+
+    def test_resume_from_checkpoint(self):
+        local_store = store.Store(":memory:")
+        # Pretend an earlier run saved the first page before crashing
+        title, html, revision = next(ingest.read_dump(self.dump))
+        url, page_languages, entries, error = parse_farm.extract_page("https://en.wiktionary.org/wiki/" + title, html)
+        local_store.put_pages([(title, revision, page_languages, entries)],
+                              checkpoint=("ingest:" + os.path.abspath(self.dump), 1))
+        self.assertEqual(ingest.ingest(self.dump, local_store, processes=1), 1)
+        self.assertEqual(ingest.ingest(self.dump, local_store, processes=1), 0)
+        self.assertEqual(len(local_store), 2)
+
+
+    def test_failed_pages(self):
+        # lxml refuses strings that declare their encoding
+        self.addCleanup(ws.set_backend, ws.get_backend())
+        ws.set_backend("lxml")
+        dump = os.path.join(self.tmp, "dump.ndjson")
+        with open(dump, "w", encoding="utf-8") as f:
+            for name, html in [("bad", '<?xml version="1.0" encoding="utf-8"?><html></html>'),
+                               ("bath", read_test_page("bath.html"))]:
+                f.write(json.dumps({"name": name, "article_body": {"html": html}}) + "\n")
+        local_store = store.Store(":memory:")
+        failures = []
+        self.assertEqual(ingest.ingest(dump, local_store, processes=1, failures=failures), 1)
+        self.assertEqual([title for title, error in failures], ["bad"])
+        self.assertTrue(failures[0][1].startswith("ValueError"))
+        self.assertEqual([title for title, revision, etag in local_store.versions()], ["bath"])
+        # Failed pages count as done, so a resumed run doesn't try them again
+        self.assertEqual(ingest.ingest(dump, local_store, processes=1), 0)
+
+
+class TestParseFarm(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.pages = [("https://en.wiktionary.org/wiki/bath", read_test_page("bath.html"), None),
+                      ("https://en.wiktionary.org/wiki/Reconstruction:Proto-Germanic/baþą",
+                       read_test_page("proto_germanic_batha.html"), None),
+                      ("https://en.wiktionary.org/wiki/many", benchmarks.synthetic_page(5), ["Language 4", "Latin"]),
+                      ("https://en.wiktionary.org/wiki/broken", '<h2><span class="mw-headline">English</span></h2>'
+                       '<h3><span class="mw-headline">Noun</span></h3>', None),
+                      ("https://en.wiktionary.org/wiki/empty", "", None)]
+
+    def test_extract(self):
+        with parse_farm.ParseFarm(workers=2, chunk_size=2, directory=self.tmp) as farm:
+            results = list(farm.extract(iter(self.pages)))
+        self.assertEqual([result[0] for result in results], [url for url, html, languages in self.pages])
+        for (url, html, languages), result in zip(self.pages[:3], results):
+            self.assertEqual(result, parse_farm.extract_page(url, html, languages))
+            self.assertIsNone(result[3])
+        self.assertEqual(results[0][1], ["English", "Welsh"])
+        self.assertEqual(results[0][2][1][2], "IPA: /baːθ/")
+        self.assertEqual([entry[0] for entry in results[2][2]], ["Language 4"])
+        # A heading with nothing under it isn't an error
+        self.assertEqual(results[3][2][0][1], "Not found.")
+        self.assertIsNone(results[3][3])
+        self.assertEqual(results[4], ("https://en.wiktionary.org/wiki/empty", [], [], None))
+        # The chunk files are removed once their results are back
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_stop_early(self):
+        with parse_farm.ParseFarm(workers=1, chunk_size=1, backend="lxml", directory=self.tmp) as farm:
+            results = farm.extract(self.pages * 4)
+            self.assertEqual(next(results)[1], ["English", "Welsh"])
+            results.close()
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_read_directory(self):
+        saved = transport.DirectoryTransport(self.tmp, transport.FakeTransport({self.pages[0][0]: self.pages[0][1]}))
+        saved.get(self.pages[0][0])
+        self.assertEqual(list(parse_farm.read_directory(self.tmp, ["Welsh"])),
+                         [(self.pages[0][0], self.pages[0][1], ["Welsh"])])
+
+
+class TestRefresh(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store(":memory:")
+        ingest.ingest(os.path.join(TEST_PAGES, "dump.xml"), self.store, processes=1)
+        self.bath = read_test_page("bath.html")
+        self.fake = transport.FakeTransport()
+        old_transport = ws.set_transport(self.fake)
+        self.addCleanup(ws.set_transport, old_transport)
+
+    def test_only_changed_sections(self):
+        # Only the Welsh pronunciation changed in the new revision
+        self.fake.add("https://en.wiktionary.org/wiki/bath", self.bath.replace("/baːθ/", "/baθ/"))
+        old_hashes = self.store.section_hashes("bath")
+        revisions = refresh.StaticRevisions({"bath": "72000000", "Reconstruction:Proto-Germanic/baþą": "70000001"})
+        stats = refresh.refresh(self.store, revisions)
+        self.assertEqual(stats, {"checked": 2, "unchanged": 1, "changed": 1, "deleted": 0, "failed": 0,
+                                 "sections_extracted": 1, "sections_kept": 1})
+        # The unchanged page wasn't downloaded
+        self.assertEqual([url for url, headers in self.fake.requests], ["https://en.wiktionary.org/wiki/bath"])
+        self.assertEqual(self.store.page("https://en.wiktionary.org/wiki/bath").pronunciation("Welsh"), "IPA: /baθ/")
+        new_hashes = self.store.section_hashes("bath")
+        self.assertEqual(new_hashes["English"], old_hashes["English"])
+        self.assertNotEqual(new_hashes["Welsh"], old_hashes["Welsh"])
+        self.assertEqual(self.store.versions()[0], ("Reconstruction:Proto-Germanic/baþą", "70000001", None))
+        self.assertEqual(self.store.versions()[1], ("bath", "72000000", None))
+        # Nothing changed since
+        self.assertEqual(refresh.refresh(self.store, revisions)["unchanged"], 2)
+
+    def test_pages_from_dump(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        dump = os.path.join(tmp, "newer.ndjson")
+        with open(dump, "w", encoding="utf-8") as f:
+            for name, html, revision in [("bath", self.bath.replace("/baːθ/", "/baθ/"), 72000000),
+                                         ("Reconstruction:Proto-Germanic/baþą",
+                                          read_test_page("proto_germanic_batha.html"), 70000001)]:
+                f.write(json.dumps({"name": name, "version": {"identifier": revision},
+                                    "article_body": {"html": html}}) + "\n")
+        stats = refresh.refresh(self.store, refresh.StaticRevisions.from_dump(dump))
+        self.assertEqual((stats["changed"], stats["sections_extracted"], stats["deleted"]), (1, 1, 0))
+        # The changed page was read from the dump rather than downloaded, so it matches the stored revision
+        self.assertEqual(self.fake.requests, [])
+        self.assertEqual(self.store.versions()[1], ("bath", "72000000", None))
+        self.assertEqual(self.store.page("https://en.wiktionary.org/wiki/bath").pronunciation("Welsh"), "IPA: /baθ/")
+
+    def test_deleted_page(self):
+        stats = refresh.refresh(self.store, refresh.StaticRevisions({"bath": "71234567"}), batch_size=1)
+        self.assertEqual((stats["checked"], stats["deleted"]), (2, 1))
+        self.assertEqual([title for title, revision, etag in self.store.versions()], ["bath"])
+        self.assertFalse(self.store.page("https://en.wiktionary.org/wiki/Reconstruction:Proto-Germanic/baþą").exists)
+
+    def test_mediawiki_revisions(self):
+        revisions = refresh.MediaWikiRevisions()
+        titles = ["bath", "Reconstruction:Proto-Germanic/baþą", "gone_word"]
+        self.fake.add(revisions.query_url(titles), json.dumps({"query": {
+            "normalized": [{"from": "gone word", "to": "Gone word"}],
+            "pages": [{"title": "bath", "revisions": [{"revid": 72000000}]},
+                      {"title": "Reconstruction:Proto-Germanic/baþą", "revisions": [{"revid": 70000001}]},
+                      {"title": "Gone word", "missing": True}]}}))
+        self.assertEqual(revisions.revisions(titles), {"bath": "72000000", "Reconstruction:Proto-Germanic/baþą":
+                                                       "70000001", "gone_word": None})
+
+    def test_conditional_requests(self):
+        url = "https://en.wiktionary.org/wiki/bath"
+        self.fake.add(url, transport.Response(200, self.bath, {"ETag": '"v2"'}))
+        # The other page gets a 404, so it was deleted
+        stats = refresh.refresh(self.store)
+        self.assertEqual((stats["changed"], stats["deleted"]), (1, 1))
+        self.assertEqual(self.store.versions(), [("bath", None, '"v2"')])
+
+        self.fake.add(url, transport.Response(304, "", {}))
+        self.fake.requests.clear()
+        self.assertEqual(refresh.refresh(self.store)["unchanged"], 1)
+        self.assertIn((url, {"If-None-Match": '"v2"'}), self.fake.requests)
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.words = [
+            struct.Word("bath", "/bɑːθ/", "u1", "A tub of water.", "English", "From Old English bæþ."),
+            struct.Word("bath", "/baːθ/", "u2", "coin, money", "Welsh", "From Proto-Celtic *batto-."),
+            struct.Word("bathe", "/beɪð/", "u3", "To wash.", "English", "From Old English baþian."),
+            struct.Word("déjà vu", "/deʒa vy/", "u4", "A feeling.", "English", "From French."),
+        ]
+        self.index = search.SearchIndex(self.words)
+
+    def check_queries(self, index):
+        self.assertEqual(index.prefix("BAT"), [self.words[0], self.words[1], self.words[2]])
+        self.assertEqual(index.prefix("bat", language="Welsh"), [self.words[1]])
+        self.assertEqual(index.prefix("ba", limit=1), [self.words[0]])
+        self.assertEqual(index.prefix("ba", limit=1, language="English"), [self.words[0]])
+        self.assertEqual(index.prefix("ba", limit=2, language="Welsh"), [self.words[1]])
+        self.assertEqual(index.fuzzy("bsthe"), [(1, self.words[2]), (2, self.words[0]), (2, self.words[1])])
+        self.assertEqual(index.fuzzy("deja_vu", max_distance=0), [(0, self.words[3])])
+        self.assertEqual(index.search("old english"), [self.words[0], self.words[2]])
+        self.assertEqual(index.search("from", language="Welsh"), [self.words[1]])
+        self.assertEqual(index.search("klingon"), [])
+        self.assertEqual(index.suggest("bathh", "Welsh")[0], self.words[1])
+
+    def test_queries(self):
+        self.check_queries(self.index)
+
+    def test_update(self):
+        self.index.add(struct.Word("bath", "/bɑːθ/", "u1", "A building for bathing.", "English", ""))
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual([word.url for word in self.index.search("old english")], ["u3"])
+        self.assertEqual([word.url for word in self.index.search("building")], ["u1"])
+
+    def test_mapped_index(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, "words.idx")
+        self.index.save(path)
+        with search.MappedIndex(path) as mapped:
+            self.assertEqual(len(mapped), 4)
+            self.check_queries(mapped)
+        loaded = search.SearchIndex.load(path)
+        self.assertEqual(list(loaded), self.words)
+        self.check_queries(loaded)
+
+    def test_index_store(self):
+        local_store = store.Store(":memory:")
+        local_store.put_pages([("Reconstruction:Proto-Germanic/baþą", "1", ["Proto-Germanic"],
+                                [("Proto-Germanic", "*baþą n\n    1. bath", "Not found.", "From PIE.")])])
+        word = search.index_store(local_store).prefix("*ba")[0]
+        self.assertEqual((word.spelling, word.language, word.url),
+                         ("*baþą", "Proto-Germanic",
+                          "https://en.wiktionary.org/wiki/Reconstruction:Proto-Germanic/baþą#Proto-Germanic"))
+
+
+class TestEtymologyGraph(unittest.TestCase):
+    def setUp(self):
+        self.fake = transport.FakeTransport({
+            "https://en.wiktionary.org/wiki/bath": read_test_page("bath.html"),
+            "https://en.wiktionary.org/wiki/Reconstruction:Proto-Germanic/baþą":
+                read_test_page("proto_germanic_batha.html"),
+        })
+        self.old_transport = ws.set_transport(self.fake)
+
+    def tearDown(self):
+        ws.set_transport(self.old_transport)
+
+    def test_links(self):
+        page = ws.WiktionaryPage("https://en.wiktionary.org/wiki/bath")
+        self.assertEqual([link[:2] for link in page.etymology_links("English")],
+                         [("bath", "Middle English"), ("bæþ", "Old English"), ("*baþą", "Proto-Germanic")])
+        self.assertEqual([link[:2] for link in page.descendant_links("English")], [("bath", "Scots"), ("baudh", "Yola")])
+        self.assertEqual(ws.parse_wiki_link("/wiki/Appendix:English_pronunciation"), None)
+        for href in ("/wiki/bath#Welsh", "//en.wiktionary.org/wiki/bath#Welsh", "https://en.wiktionary.org/wiki/bath#Welsh"):
+            self.assertEqual(ws.parse_wiki_link(href), ("bath", "Welsh", "https://en.wiktionary.org/wiki/bath#Welsh"))
+        self.assertEqual(ws.parse_wiki_link("https://fr.wiktionary.org/wiki/bath"), None)
+
+    def test_crawl(self):
+        graph = etymology.crawl("bath", "English", max_depth=2, workers=4)
+        root = ("bath", "English")
+        self.assertEqual(graph.ancestors[root],
+                         [("bath", "Middle English"), ("bæþ", "Old English"), ("*baþą", "Proto-Germanic")])
+        self.assertEqual(graph.descendants[root], [("bath", "Scots"), ("baudh", "Yola")])
+        self.assertEqual(graph.ancestors[("*baþą", "Proto-Germanic")], [("*bʰeh₁-", "Proto-Indo-European")])
+        self.assertTrue(graph.nodes[("*baþą", "Proto-Germanic")]["found"])
+        self.assertFalse(graph.nodes[("bæþ", "Old English")]["found"])
+        # Red links are kept in the graph but never fetched
+        self.assertTrue(graph.nodes[("baudh", "Yola")]["red_link"])
+        self.assertNotIn("found", graph.nodes[("baudh", "Yola")])
+        # Nodes that share a page are only fetched once
+        fetched = [cache.normalize_url(url) for url, headers in self.fake.requests]
+        self.assertEqual(len(fetched), len(set(fetched)))
+        self.assertEqual(len(fetched), 4)
+
+    def test_page_links(self):
+        links = etymology.page_links("https://en.wiktionary.org/wiki/bath", descendants=False)
+        self.assertEqual(list(links), ["English", "Welsh"])
+        self.assertEqual([link[:2] for link in links["English"][0]][-1], ("*baþą", "Proto-Germanic"))
+        self.assertEqual(links["English"][1], [])
+        self.assertEqual(etymology.page_links("https://en.wiktionary.org/wiki/nosuchword"), {})
+
+    def test_export(self):
+        graph = etymology.crawl("bath", "English", max_depth=1)
+        data = json.loads(graph.to_json())
+        self.assertEqual(len(data["nodes"]), len(graph))
+        self.assertIn([0, 3], data["edges"])
+        graphml = ET.fromstring(graph.to_graphml())
+        ns = "{http://graphml.graphdrawing.org/xmlns}"
+        self.assertEqual(len(graphml.findall(ns + "graph/" + ns + "node")), len(graph))
+        self.assertEqual(len(graphml.findall(ns + "graph/" + ns + "edge")), len(graph.edges()))
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def slow_lookup(word, language):
+            self.calls.append((word, language))
+            time.sleep(0.2)
+            if word == "broken":
+                raise ValueError("bad page")
+            return {"word": word, "language": language}
+
+        self.service = server.LookupService(slow_lookup)
+        self.httpd = server.make_server("127.0.0.1", 0, self.service)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.client = server.Client("http://127.0.0.1:" + str(self.httpd.server_address[1]))
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_coalescing(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.client.lookup("bath", "English")))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [{"word": "bath", "language": "English"}] * 5)
+        self.assertEqual(self.calls, [("bath", "English")])
+
+        metrics = self.client.metrics()
+        self.assertEqual((metrics["requests"], metrics["coalesced"], metrics["errors"]), (5, 4, 0))
+        self.assertGreaterEqual(metrics["latency_seconds"]["p50"], 0.1)
+
+    def test_coalescing_spellings(self):
+        # An alias of the language and a differently written word still read the same page
+        lookups = [("déjà vu", "English"), ("de\u0301ja\u0300_vu", "en"), (" déjà vu ", "english")]
+        threads = [threading.Thread(target=self.service.lookup, args=lookup) for lookup in lookups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, [("déjà vu", "English")])
+        self.assertEqual(self.service.metrics()["coalesced"], 2)
+
+    def test_errors(self):
+        with self.assertRaises(server.ServiceError) as raised:
+            self.client.lookup("broken", "English")
+        self.assertEqual(str(raised.exception), "ValueError: bad page")
+        self.assertEqual(self.client.metrics()["errors"], 1)
+        self.assertFalse(server.Client("http://127.0.0.1:1").available())
+
+    def test_serve_saves_cache(self):
+        import signal
+        import socket
+        import sqlite3
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        path = os.path.join(tempfile.mkdtemp(), "cache.sqlite")
+        process = subprocess.Popen([sys.executable, "main.py", "--serve", "--port", str(port), "--cache", path],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True)
+        self.assertIn("listening", process.stdout.readline())
+        process.send_signal(signal.SIGTERM)
+        self.assertEqual(process.wait(timeout=10), 0)
+        process.stdout.close()
+        # The cache was closed, which saved the negative cache's bloom filter
+        db = sqlite3.connect(path)
+        self.addCleanup(db.close)
+        self.assertIsNotNone(db.execute("SELECT value FROM meta WHERE key = 'known_pages_filter'").fetchone())
+
+    def test_local_options(self):
+        args = types.SimpleNamespace(cache=None, offline=False, store=None, negative_ttl=None, backend=None,
+                                     timings=False, prometheus=None, profile=None)
+        self.assertEqual(main.local_options(args), [])
+        args.offline, args.backend, args.timings = True, "lxml", True
+        self.assertEqual(main.local_options(args), ["--offline", "--backend", "--timings"])
+        # Asking for the service and for options it wouldn't follow is an error
+        run = subprocess.run([sys.executable, "main.py", "--server", "http://127.0.0.1:1", "--store", "x.sqlite"],
+                             cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        self.assertEqual(run.returncode, 2)
+        self.assertIn("doesn't use --store", run.stderr)
+
+
 if __name__ == '__main__':
     unittest.main()
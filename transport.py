@@ -0,0 +1,292 @@
+# Transports that webscraper.fetch downloads pages with, see webscraper.set_transport
+#
+# requests and asyncio are imported by the transports that use them when they're first used, since importing them
+# takes longer than most lookups that are answered from a cache.
+import os
+import random
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import quote
+import cache
+
+
+# What every transport returns from get. headers is a mapping of the response headers, case-insensitive when
+# it comes from the network.
+Response = namedtuple("Response", ["status", "text", "headers"])
+
+# What stream returns: chunks is an iterator of the response's text in pieces. Closing it (or reading it to the
+# end) releases the connection, so a reader can stop downloading part way through a page.
+StreamedResponse = namedtuple("StreamedResponse", ["status", "chunks", "headers"])
+
+# Statuses worth retrying: rate limiting and server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def retry_delay(attempt, backoff, max_backoff=30, retry_after=None):
+    """
+    Returns how long to wait before retrying a request. The delay grows exponentially with full jitter, so
+    clients that failed together don't retry together. A Retry-After header given in seconds takes precedence.
+    :param attempt: Number of attempts already made, starting at 1
+    :param backoff: Base delay in seconds
+    :param max_backoff: Longest delay in seconds
+    :param retry_after: Value of the response's Retry-After header, if it had one
+    :return: Delay in seconds
+    """
+    if retry_after is not None and str(retry_after).isdigit():
+        return min(max_backoff, int(retry_after))
+    return random.uniform(0, min(max_backoff, backoff * 2 ** (attempt - 1)))
+
+
+class Transport:
+    """
+    Interface of the synchronous transports. get must be safe to call from several threads at once.
+    """
+    def get(self, url, headers=None):
+        """
+        Sends a GET request
+        :param url: The url to download
+        :param headers: Extra request headers, e.g. for conditional requests
+        :return: A Response
+        """
+        raise NotImplementedError
+
+    def stream(self, url, headers=None, chunk_size=65536):
+        """
+        Sends a GET request whose response can be read a piece at a time. Transports that can't stream download
+        the whole response and split it up.
+        :param url: The url to download
+        :param headers: Extra request headers, e.g. for conditional requests
+        :param chunk_size: Size of the pieces the response is read in
+        :return: A StreamedResponse
+        """
+        response = self.get(url, headers)
+        chunks = (response.text[i:i + chunk_size] for i in range(0, len(response.text), chunk_size))
+        return StreamedResponse(response.status, chunks, response.headers)
+
+    def close(self):
+        pass
+
+
+def _iter_text(response, chunk_size):
+    # Decoded pieces of a streamed requests response, which is closed once the reader is done with them
+    try:
+        yield from response.iter_content(chunk_size, decode_unicode=True)
+    finally:
+        response.close()
+
+
+class PooledTransport(Transport):
+    """
+    Sends requests through one requests.Session so connections are kept alive and reused. Requests that time out,
+    fail to connect or get a 429/5xx answer are retried with jittered exponential backoff.
+    """
+    def __init__(self, timeout=(5, 30), retries=3, backoff=0.5, pool_size=32):
+        """
+        :param timeout: Seconds to wait for a connection and for the response, as accepted by requests
+        :param retries: Number of times a failed request is retried
+        :param backoff: Base delay between retries in seconds
+        :param pool_size: Connections kept open to each host
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        The requests.Session the requests are sent through, which is made when it's first needed
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def get(self, url, headers=None):
+        import requests
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self.session.get(url, headers=headers or {}, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt > self.retries:
+                    raise
+                time.sleep(retry_delay(attempt, self.backoff))
+                continue
+            if response.status_code in RETRY_STATUSES and attempt <= self.retries:
+                time.sleep(retry_delay(attempt, self.backoff, retry_after=response.headers.get("Retry-After")))
+                continue
+            return Response(response.status_code, response.text, response.headers)
+
+    def stream(self, url, headers=None, chunk_size=65536):
+        import requests
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self.session.get(url, headers=headers or {}, timeout=self.timeout, stream=True)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt > self.retries:
+                    raise
+                time.sleep(retry_delay(attempt, self.backoff))
+                continue
+            if response.status_code in RETRY_STATUSES and attempt <= self.retries:
+                response.close()
+                time.sleep(retry_delay(attempt, self.backoff, retry_after=response.headers.get("Retry-After")))
+                continue
+            # Without a charset in the headers iter_content would give bytes, Wiktionary pages are UTF-8
+            if response.encoding is None:
+                response.encoding = "utf-8"
+            return StreamedResponse(response.status_code, _iter_text(response, chunk_size), response.headers)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+class AsyncTransport:
+    """
+    asyncio transport built on httpx, which is an optional dependency. HTTP/2 is used when the h2 package is
+    installed, otherwise HTTP/1.1 connections are kept alive. Retries the same way as PooledTransport.
+    """
+    def __init__(self, timeout=30, retries=3, backoff=0.5, max_connections=32, client=None):
+        """
+        :param timeout: Seconds to wait for a response
+        :param retries: Number of times a failed request is retried
+        :param backoff: Base delay between retries in seconds
+        :param max_connections: Most connections open at once
+        :param client: An httpx.AsyncClient (or an object with the same async get) to use instead of a new one
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        import asyncio
+        # Errors that mean the request didn't get through and can be retried
+        self.retry_errors = (OSError, asyncio.TimeoutError)
+        try:
+            import httpx
+            self.retry_errors += (httpx.TransportError,)
+        except ImportError:
+            httpx = None
+
+        if client is None:
+            if httpx is None:
+                raise ImportError("AsyncTransport needs httpx, install it with: pip install httpx[http2]")
+            try:
+                import h2  # noqa: F401
+                http2 = True
+            except ImportError:
+                http2 = False
+            client = httpx.AsyncClient(http2=http2, timeout=timeout, follow_redirects=True,
+                                       limits=httpx.Limits(max_connections=max_connections))
+        self.client = client
+
+    async def get(self, url, headers=None):
+        """
+        Sends a GET request
+        :param url: The url to download
+        :param headers: Extra request headers, e.g. for conditional requests
+        :return: A Response
+        """
+        import asyncio
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await self.client.get(url, headers=headers or {})
+            except self.retry_errors:
+                if attempt > self.retries:
+                    raise
+                await asyncio.sleep(retry_delay(attempt, self.backoff))
+                continue
+            if response.status_code in RETRY_STATUSES and attempt <= self.retries:
+                await asyncio.sleep(retry_delay(attempt, self.backoff, retry_after=response.headers.get("Retry-After")))
+                continue
+            return Response(response.status_code, response.text, response.headers)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class FakeTransport(Transport):
+    """
+    Serves pages from memory so tests and benchmarks don't need the network. Urls are matched after
+    cache.normalize_url, so fragments and percent escapes don't matter.
+    """
+    def __init__(self, pages=None):
+        """
+        :param pages: A dictionary of urls to html strings, Response tuples, or exceptions to raise.
+                      Any other url gets a 404.
+        """
+        self.pages = {}
+        # Every (url, headers) requested, in order
+        self.requests = []
+        for url, page in (pages or {}).items():
+            self.add(url, page)
+
+    def add(self, url, page):
+        """
+        Serves a page at url, see __init__
+        """
+        self.pages[cache.normalize_url(url)] = page
+
+    def get(self, url, headers=None):
+        self.requests.append((url, headers or {}))
+        page = self.pages.get(cache.normalize_url(url))
+        if page is None:
+            return Response(404, "", {})
+        if isinstance(page, Exception):
+            raise page
+        if isinstance(page, Response):
+            return page
+        return Response(200, page, {})
+
+
+class DirectoryTransport(Transport):
+    """
+    Serves pages saved in a directory, one file per url. If a transport to record from is given, pages that
+    haven't been saved yet are downloaded with it and saved, so a test run against the live site can be
+    replayed offline afterwards.
+    """
+    def __init__(self, path, record_from=None):
+        """
+        :param path: Directory the pages are saved in
+        :param record_from: Transport used for pages that aren't saved, None to answer them with a 404
+        """
+        self.path = path
+        self.record_from = record_from
+
+    def page_path(self, url):
+        """
+        :return: The file a url's page is saved in. Pages that don't exist are saved with a .missing extension.
+        """
+        return os.path.join(self.path, quote(cache.normalize_url(url).split("://", 1)[-1], safe="") + ".html")
+
+    def get(self, url, headers=None):
+        path = self.page_path(url)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return Response(200, f.read(), {})
+        if os.path.exists(path[:-len(".html")] + ".missing") or self.record_from is None:
+            return Response(404, "", {})
+
+        response = self.record_from.get(url)
+        if response.status < 400:
+            os.makedirs(self.path, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(response.text)
+        elif response.status < 500:
+            os.makedirs(self.path, exist_ok=True)
+            open(path[:-len(".html")] + ".missing", "w").close()
+        return response
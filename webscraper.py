@@ -1,47 +1,759 @@
-import httplib2
-from bs4 import BeautifulSoup, Comment
-import requests
-import io
+# Beautiful Soup, lxml, requests, asyncio and concurrent.futures are only imported by the functions that use them
+# (as are sqlite3 by cache.Cache and cProfile and logging by their instrumentation sinks), so short-lived processes
+# that never parse or download a page don't pay for importing them
+import contextvars
+import hashlib
+import os
+import re
+import threading
+from urllib.parse import urlsplit, unquote, parse_qs, urljoin
+from collections import deque
+import cache as page_cache
+import instrumentation
+import languages
+import normalize
+import ratelimit
+import transport
+
+
+# Number of page downloads and full page parses performed, used to check that a lookup only fetches and
+# parses its Wiktionary page once
+page_stats = {"fetches": 0, "parses": 0}
+_stats_lock = threading.Lock()
+
+# Names this module used to import from Beautiful Soup, still available as webscraper.BeautifulSoup and so on
+_BS4_NAMES = ("BeautifulSoup", "Comment", "NavigableString", "CData", "Tag")
+
+
+def __getattr__(name):
+    # Imports Beautiful Soup when one of its names is first used through this module
+    if name in _BS4_NAMES:
+        import bs4
+        return getattr(bs4, name)
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
+
+
+# Every download goes through this transport, whose pooled session keeps connections to Wiktionary alive
+_transport = transport.PooledTransport()
+
+# Optional ratelimit.HostRateLimiter that every download waits on
+_rate_limiter = None
+
+
+def reset_page_stats():
+    """
+    Sets the fetch and parse counters in page_stats back to zero
+    """
+    with _stats_lock:
+        for key in page_stats:
+            page_stats[key] = 0
+
+
+def _count(key):
+    with _stats_lock:
+        page_stats[key] += 1
+    instrumentation.count(key)
+
+
+def set_transport(new_transport):
+    """
+    Replaces the transport pages are downloaded with, e.g. with a transport.FakeTransport in tests
+    :param new_transport: A transport.Transport
+    :return: The transport that was being used
+    """
+    global _transport
+    old_transport = _transport
+    _transport = new_transport
+    return old_transport
+
+
+def set_rate_limit(requests_per_second, burst=1):
+    """
+    Limits how fast pages are downloaded from each host
+    :param requests_per_second: Requests allowed per second to a host, None to remove the limit
+    :param burst: Number of requests a host can receive at once after being idle
+    """
+    global _rate_limiter
+    if requests_per_second is None:
+        _rate_limiter = None
+    else:
+        _rate_limiter = ratelimit.HostRateLimiter(requests_per_second, burst)
+
+
+def wiki_url(word, language):
+    """
+    Builds the Wiktionary url of a word in a language without checking that it exists, see languages.entry_url
+    :param word: The word to look up
+    :param language: Name of a language
+    :return: url (string) that links to the word in that language on wiktionary
+    """
+    return languages.entry_url(word, language)
+
+
+# Optional cache.Cache that pages and lookup results are read from before going to Wiktionary
+_cache = None
+
+
+def set_cache(cache):
+    """
+    Sets the cache used by fetch and lookup
+    :param cache: A cache.Cache, or None to always go to Wiktionary
+    """
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    """
+    :return: The cache.Cache set with set_cache, None if there isn't one
+    """
+    return _cache
+
+
+def _before_fetch(url):
+    # Returns (cached page, request headers, answer) where answer is set if the cache can answer on its own
+    cached = None
+    headers = {}
+    if _cache is not None:
+        cached = _cache.get_page(url)
+        if cached is not None and (cached.fresh or _cache.offline):
+            instrumentation.count("cache_hits")
+            return cached, headers, (cached.status, cached.html)
+        instrumentation.count("cache_misses")
+        if _cache.offline:
+            raise page_cache.OfflineMiss(url)
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+    return cached, headers, None
+
+
+def _after_fetch(url, cached, response):
+    # Updates the cache with a transport.Response and returns (status, html)
+    instrumentation.count("bytes_fetched", len(response.text))
+    if response.status == 304 and cached is not None:
+        _cache.revalidated(url)
+        return cached.status, cached.html
+
+    # Server errors are temporary so they aren't worth keeping
+    if _cache is not None and response.status < 500:
+        _cache.put_page(url, response.status, response.text, response.headers.get("ETag"),
+                        response.headers.get("Last-Modified"))
+    return response.status, response.text
+
+
+def fetch(url):
+    """
+    Downloads a Wiktionary page, going through the cache if one is set. Stale cached pages are revalidated
+    with a conditional request.
+    :param url: A Wiktionary url
+    :return: A tuple (status, html) of the response's HTTP status code and its text
+    """
+    with instrumentation.span("fetch"):
+        cached, headers, answer = _before_fetch(url)
+        if answer is not None:
+            return answer
+        return _after_fetch(url, cached, download(url, headers))
+
+
+def download(url, headers=None):
+    """
+    Sends a request for a page straight to the transport, without the cache but waiting on the rate limiter,
+    e.g. for conditional requests whose validators don't come from the cache
+    :param url: A Wiktionary url
+    :param headers: Extra request headers
+    :return: A transport.Response
+    """
+    if _rate_limiter is not None:
+        with instrumentation.span("rate_limit"):
+            _rate_limiter.acquire(url)
+    _count("fetches")
+    with instrumentation.span("transport"):
+        return _transport.get(url, headers)
+
+
+async def fetch_async(url, async_transport):
+    """
+    Downloads a Wiktionary page like fetch, with an asyncio transport
+    :param url: A Wiktionary url
+    :param async_transport: A transport.AsyncTransport
+    :return: A tuple (status, html) of the response's HTTP status code and its text
+    """
+    with instrumentation.span("fetch"):
+        cached, headers, answer = _before_fetch(url)
+        if answer is not None:
+            return answer
+
+        if _rate_limiter is not None:
+            with instrumentation.span("rate_limit"):
+                import asyncio
+                # The limiter sleeps, so it waits on a thread instead of blocking the event loop
+                await asyncio.get_running_loop().run_in_executor(None, _rate_limiter.acquire, url)
+        _count("fetches")
+        with instrumentation.span("transport"):
+            response = await async_transport.get(url, headers)
+        return _after_fetch(url, cached, response)
+
+
+class Section:
+    """
+    A view of one language's section on a parsed page. It covers the siblings between the language's h2 heading
+    and the next language's heading without copying or re-parsing them.
+    """
+    def __init__(self, language, heading, end=None):
+        """
+        :param language: Name of the section's language
+        :param heading: The section's h2 tag
+        :param end: The first sibling after the section, None if the section runs to the end of its parent
+        """
+        self.language = language
+        self.heading = heading
+        self.end = end
+
+    def nodes(self):
+        """
+        :return: A generator of the section's top level nodes, in order
+        """
+        from bs4 import Comment
+        node = self.heading.next_sibling
+        traversed = 0
+        try:
+            while node is not None and node is not self.end:
+                # Every wiktionary page follows its last language section with a cache usage comment
+                if self.end is None and isinstance(node, Comment):
+                    return
+                traversed += 1
+                yield node
+                node = node.next_sibling
+        finally:
+            instrumentation.count("nodes", traversed)
+
+    def find_all(self, name, class_=None):
+        """
+        Finds the tags in the section with the given name (and class), like Beautiful Soup's find_all
+        :param name: Tag name
+        :param class_: A class the tags must have, or None
+        :return: A list of the matching tags in document order
+        """
+        from bs4 import Tag
+        found = []
+        for node in self.nodes():
+            if isinstance(node, Tag):
+                if node.name == name and (class_ is None or class_ in node.get("class", [])):
+                    found.append(node)
+                found.extend(node.find_all(name, class_=class_))
+        return found
+
+    def get_text(self):
+        from bs4 import Comment, Tag
+        return "".join(node.get_text() if isinstance(node, Tag) else str(node) for node in self.nodes()
+                       if not isinstance(node, Comment))
+
+    def __str__(self):
+        return "".join(str(node) for node in self.nodes())
+
+
+def index_sections(soup):
+    """
+    Finds every language section of a parsed Wiktionary page in one pass over its headings
+    :param soup: Beautiful Soup format html of a whole page
+    :return: A dictionary of language names to Section views, in the order they appear on the page
+    """
+    headings = []
+    for headline in soup.find_all("span", class_="mw-headline"):
+        if headline.parent.name == "h2":
+            headings.append((headline.text, headline.parent))
+
+    sections = {}
+    for i, (language, heading) in enumerate(headings):
+        end = None
+        if i + 1 < len(headings):
+            # The next heading might be nested inside one of this heading's siblings
+            end = headings[i + 1][1]
+            while end is not None and end.parent is not heading.parent:
+                end = end.parent
+        if language not in sections:
+            sections[language] = Section(language, heading, end)
+    return sections
+
+
+# Library pages are parsed with, see set_backend
+_backend = os.environ.get("WEBSCRAPER_BACKEND", "bs4")
+
+
+def set_backend(name):
+    """
+    Chooses how pages are parsed. "bs4" parses them into Beautiful Soup trees, "lxml" into lxml trees that are
+    searched with XPath (see lxml_backend.py), which is faster and gives the same results. Pages that were already
+    parsed keep their backend. The WEBSCRAPER_BACKEND environment variable sets the backend new processes start with.
+    :param name: "bs4" or "lxml"
+    """
+    global _backend
+    if name not in ("bs4", "lxml"):
+        raise ValueError("Unknown backend " + repr(name) + ", expected 'bs4' or 'lxml'")
+    _backend = name
+
+
+def get_backend():
+    """
+    :return: Name of the backend new pages are parsed with, see set_backend
+    """
+    return _backend
+
+
+class WiktionaryPage:
+    """
+    A Wiktionary page that is downloaded and parsed once. The language sections are indexed when the page
+    is parsed so every extractor can share the same soup.
+    """
+    def __init__(self, url, html=None, status=200, tree=None):
+        """
+        :param url: A Wiktionary url
+        :param html: The page's html, if it has already been downloaded. The page is fetched otherwise.
+        :param status: HTTP status code of the response the html came from
+        :param tree: The html already parsed by lxml, e.g. by read_section. The page then uses the lxml backend
+                     whatever set_backend chose, rather than parsing the html again.
+        """
+        self.url = url
+        if html is None:
+            status, html = fetch(url)
+        # Wiktionary answers with an error status for pages that don't exist
+        self.exists = status < 400
+        # False for pages read by stream_page that stop after a section, see there
+        self.complete = True
+        # The parsed page, a Beautiful Soup tree or an lxml element depending on the backend (see set_backend)
+        self.backend = _backend if tree is None else "lxml"
+        self.soup = tree
+        self.sections = {}
+
+        if self.exists:
+            if tree is None:
+                with instrumentation.span("parse", bytes=len(html)):
+                    if self.backend == "lxml":
+                        import lxml_backend
+                        self.soup = lxml_backend.parse(html)
+                    else:
+                        from bs4 import BeautifulSoup
+                        self.soup = BeautifulSoup(html, "lxml")
+            _count("parses")
+            with instrumentation.span("index_sections"):
+                if self.backend == "lxml":
+                    import lxml_backend
+                    self.sections = lxml_backend.index_sections(self.soup)
+                else:
+                    self.sections = index_sections(self.soup)
+        self.languages = list(self.sections)
+
+    @classmethod
+    def known(cls, url, exists, page_languages):
+        """
+        Makes a page from what the cache's negative cache knows about it (see cache.Cache.get_known_page) without
+        downloading it. It has no sections, so it can only answer for languages that aren't on it.
+        :param url: A Wiktionary url
+        :param exists: Whether the page exists
+        :param page_languages: Names of the page's language sections
+        :return: A WiktionaryPage whose complete attribute is False
+        """
+        page = cls(url, "", 404)
+        page.exists = exists
+        page.languages = list(page_languages)
+        page.complete = False
+        return page
+
+    def section_hash(self, language):
+        """
+        Hashes a language's section, so a later version of the page can be checked for changes to it without
+        running the extractors. The hash depends on the backend the page was parsed with.
+        :param language: Name of a language
+        :return: A hex string that changes whenever the section's html does, None if the section doesn't exist
+        """
+        section = self.section_soup(language)
+        if section is None:
+            return None
+        return hashlib.blake2b(str(section).encode("utf-8"), digest_size=16).hexdigest()
+
+    def section_soup(self, language):
+        """
+        Returns a language's section of the page, see return_section_soup
+        :param language: Name of a language
+        :return: A Section view of the language's section (an lxml_backend.Section with the lxml backend), None if
+                 the section doesn't exist
+        """
+        return self.sections.get(language)
+
+    def definition(self, language, prune=None):
+        """
+        :param prune: Rules for the nodes left out of each definition, DEFINITION_PRUNE if None
+        :return: Definition entry of the language's section, "Not found." if there isn't one
+        """
+        with instrumentation.span("definition"):
+            if self.backend == "lxml":
+                import lxml_backend
+                return lxml_backend.definition_from_section(self.section_soup(language), prune)
+            return _definition_from_section(self.section_soup(language), prune)
+
+    def pronunciation(self, language):
+        """
+        :return: Pronunciation of the language's section, "Not found." if there isn't one
+        """
+        with instrumentation.span("pronunciation"):
+            if self.backend == "lxml":
+                import lxml_backend
+                return lxml_backend.pronunciation_from_section(self.section_soup(language))
+            return _pronunciation_from_section(self.section_soup(language))
+
+    def etymology(self, language):
+        """
+        :return: Etymology of the language's section, "Not found." if there isn't one
+        """
+        with instrumentation.span("etymology"):
+            if self.backend == "lxml":
+                import lxml_backend
+                return lxml_backend.etymology_from_section(self.section_soup(language))
+            return _etymology_from_section(self.section_soup(language))
+
+    def etymology_links(self, language):
+        """
+        :return: The (word, language, url) tuples the language section's etymology mentions
+        """
+        if self.backend == "lxml":
+            import lxml_backend
+            return lxml_backend.etymology_links_from_section(self.section_soup(language))
+        return _etymology_links_from_section(self.section_soup(language))
+
+    def descendant_links(self, language):
+        """
+        :return: The (word, language, url) tuples of the language section's direct descendants
+        """
+        if self.backend == "lxml":
+            import lxml_backend
+            return lxml_backend.descendant_links_from_section(self.section_soup(language))
+        return _descendant_links_from_section(self.section_soup(language))
+
+
+def read_section(chunks, language):
+    """
+    Reads a page's html from an iterable of pieces until the language's section is over. The pieces are fed to an
+    incremental lxml parser that finds the language's h2 heading; reading stops after the next h2 heading or at the
+    cache comment that follows the last section, and the rest of the page is never read.
+    :param chunks: An iterable of pieces of a page's html
+    :param language: Name of a language
+    :return: A tuple (html, complete, tree) where html is the page up to the end of the language's section (and
+             whatever followed it in the last piece read), complete is False if reading stopped before the end of
+             the page, and tree is html parsed by lxml (None if there was no html), which WiktionaryPage can use
+             instead of parsing html again
+    """
+    from lxml import etree
+    parser = etree.HTMLPullParser(events=("end", "comment"))
+    pieces = []
+    h2_count = 0
+    # Number of the language's h2 among the page's h2 headings, once it has been read
+    found = None
+    complete = True
+    for chunk in chunks:
+        pieces.append(chunk)
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == "comment":
+                if found is not None and (element.text or "").strip().startswith("NewPP"):
+                    complete = False
+            elif element.tag == "h2":
+                h2_count += 1
+                # The next heading ends the section, see index_sections
+                if found is not None:
+                    complete = False
+                elif any(child.tag == "span" and "mw-headline" in (child.get("class") or "").split()
+                         and "".join(child.itertext()) == language for child in element):
+                    found = h2_count
+        if not complete:
+            break
+    try:
+        tree = parser.close()
+    except etree.XMLSyntaxError:
+        tree = None
+    return "".join(pieces), complete, tree
+
+
+def stream_page(url, language, chunk_size=16384):
+    """
+    Downloads and parses a Wiktionary page only up to the end of a language's section, see read_section. Pages
+    that are read to the end (e.g. because the language isn't on them) are cached like fetch does; partial pages
+    aren't, and a page the cache can answer for is used whole.
+    :param url: A Wiktionary url
+    :param language: Name of the language whose section is needed
+    :param chunk_size: Size of the pieces the response is read in
+    :return: A WiktionaryPage. If it's partial its complete attribute is False and its languages only go up to
+             the requested language.
+    """
+    with instrumentation.span("fetch", streamed=True):
+        cached, headers, answer = _before_fetch(url)
+        if answer is not None:
+            status, html = answer
+            complete = True
+            tree = None
+        else:
+            if _rate_limiter is not None:
+                with instrumentation.span("rate_limit"):
+                    _rate_limiter.acquire(url)
+            _count("fetches")
+            with instrumentation.span("transport"):
+                response = _transport.stream(url, headers, chunk_size)
+                try:
+                    html, complete, tree = read_section(response.chunks, language)
+                finally:
+                    if hasattr(response.chunks, "close"):
+                        response.chunks.close()
+            if complete:
+                status, html = _after_fetch(url, cached, transport.Response(response.status, html, response.headers))
+                if response.status == 304:
+                    # The cached page is used instead of what was read
+                    tree = None
+            else:
+                status = response.status
+                instrumentation.count("bytes_fetched", len(html))
+
+    # The tree read_section built is used rather than parsing the html again
+    page = WiktionaryPage(url, html, status, tree)
+    if not complete:
+        # Drop the heading read after the language's section
+        page.languages = page.languages[:page.languages.index(language) + 1]
+        page.sections = {name: page.sections[name] for name in page.languages}
+        page.complete = False
+    _remember_page(page)
+    return page
+
+
+# Whether the single-language functions stream pages, see set_streaming
+_streaming = False
+
+
+def set_streaming(enabled):
+    """
+    Makes return_section_soup, get_wiki_definition, get_wiki_pronunciation and get_wiki_etymology read pages with
+    stream_page, so they stop downloading and parsing once the requested language's section is over. Streamed pages
+    use the lxml backend, whose tree the streaming parser builds as it reads. lookup,
+    get_wiki_url and languages_on_page list every language on a page so they always read all of it.
+    :param enabled: True to stream, False to read whole pages
+    """
+    global _streaming
+    _streaming = enabled
+
+
+def _section_page(url, language):
+    # The page a single-language function reads language's section from
+    page = _known_missing(url, language)
+    if page is not None:
+        return page
+    if _streaming and _store is None:
+        return stream_page(url, language)
+    return get_page(url)
+
+
+# Optional store.Store of ingested pages that is used instead of Wiktionary, see ingest.py
+_store = None
+
+
+def set_store(local_store):
+    """
+    Makes get_wiki_url, lookup and the get_wiki_* functions answer from a local store instead of the network
+    :param local_store: A store.Store, or None to go back to Wiktionary
+    """
+    global _store
+    _store = local_store
+
+
+def get_page(url):
+    """
+    Returns the page a Wiktionary url points to, read from the local store if one is set (see set_store) and
+    downloaded otherwise
+    :param url: A Wiktionary url
+    :return: A WiktionaryPage, or a store.StoredPage when a store is set
+    """
+    if _store is not None:
+        return _store.page(url)
+    page = WiktionaryPage(url)
+    _remember_page(page)
+    return page
+
+
+def _remember_page(page):
+    # Records whether a downloaded page exists and its languages in the cache's negative cache
+    if _cache is not None and page.complete:
+        _cache.put_known_page(page.url, page.exists, page.languages)
+
+
+def _known_missing(url, language):
+    # A page without the language's section if the negative cache knows it doesn't have one, None otherwise
+    if _cache is None or _store is not None:
+        return None
+    known = _cache.get_known_page(url)
+    if known is None:
+        return None
+    exists, page_languages = known
+    if exists and language in page_languages:
+        return None
+    instrumentation.count("negative_hits")
+    return WiktionaryPage.known(url, exists, page_languages)
+
+
+def _entry_page(word, language):
+    # The page of a word in a language, answered without a request if no entry can exist for them or the
+    # negative cache knows there isn't one
+    url = wiki_url(word, language)
+    if not languages.is_possible(word, language):
+        return WiktionaryPage(url, "", 404)
+    return _known_missing(url, language) or get_page(url)
 
 
 def get_wiki_url(word, language):
     """
-    word and language are both string inputs
+    word and language are both string inputs. The language can also be an alias or code, see languages.resolve.
     :return: url (string) that links to the word in that language on wiktionary. If a page of that word
              exists then it returns a list [url, True/False] where the 2nd element is True if that word has
              a section in the input language. If a page with that word doesn't exist then it returns None.
     """
+    language = languages.canonical_name(language)
+    url = wiki_url(word, language)
 
-    # Replace spaces with underscores for words and languages that have them
-    language_url = language.replace(" ", "_")
-    word = word.replace(" ", "_")
+    # The page's existence and its language sections both come from the same download
+    page = _entry_page(word, language)
+    if not page.exists:
+        return None
 
-    # Wiktionary url formats differ on if the word is a reconstruction or not
-    # Reconstructed words start with '*' or belong to a 'Proto' language
-    if word[0] == "*":
-        url = "https://en.wiktionary.org/wiki/Reconstruction:" + language_url + "/" + word[1:]
-    elif language[0:6] == "Proto-":
-        url = "https://en.wiktionary.org/wiki/Reconstruction:" + language_url + "/" + word
+    # It's possible that a wiktionary page exists but there's no section for the input language
+    if language not in page.languages:
+        return [url, False]
     else:
-        url = "https://en.wiktionary.org/wiki/" + word + "#" + language_url
-
-    # Make sure the page exists
-    h = httplib2.Http()
-    resp = h.request(url, "HEAD")
-    page_exists = False
-    if int(resp[0]['status']) < 400:
-        page_exists = True
-
-    if page_exists:
-        # It's possible that a wiktionary page exists but there's no section for the input language
-        # So we should check the page first to make sure a section with that language exists
-        language_headers = languages_on_page(url)
-        if language not in language_headers:
-            return [url, False]
+        return [url, True]
+
+
+def lookup(word, language):
+    """
+    Looks up everything about a word in a language with a single page download. Results are kept in the
+    cache (see set_cache), so repeated lookups don't download or parse anything.
+    :param word: The word to look up
+    :param language: Name of a language, or an alias or code of one (see languages.resolve)
+    :return: A dictionary with the word, language (the name Wiktionary uses), url, whether the page exists, the
+             languages on the page and the definition, pronunciation and etymology of the word ("Not found." for
+             missing sections)
+    """
+    language = languages.canonical_name(language)
+    with instrumentation.span("lookup", word=word, language=language):
+        if _cache is not None:
+            result = _cache.get_result(word, language)
+            if result is not None:
+                instrumentation.count("result_cache_hits")
+                return result
+
+        return _lookup_result(word, language, _entry_page(word, language))
+
+
+async def lookup_async(word, language, async_transport):
+    """
+    Looks up a word like lookup, downloading the page with an asyncio transport. Parsing runs on a thread so
+    it doesn't hold up the event loop.
+    :param word: The word to look up
+    :param language: Name of a language
+    :param async_transport: A transport.AsyncTransport
+    :return: The same dictionary as lookup
+    """
+    language = languages.canonical_name(language)
+    with instrumentation.span("lookup", word=word, language=language):
+        if _cache is not None:
+            result = _cache.get_result(word, language)
+            if result is not None:
+                instrumentation.count("result_cache_hits")
+                return result
+
+        url = wiki_url(word, language)
+        if _store is not None or not languages.is_possible(word, language):
+            page = _entry_page(word, language)
         else:
-            return [url, True]
+            page = _known_missing(url, language)
+        if page is None:
+            import asyncio
+            status, html = await fetch_async(url, async_transport)
+            # The parse runs in a copy of this task's context so its spans nest under the lookup's
+            page = await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run,
+                                                                    WiktionaryPage, url, html, status)
+            _remember_page(page)
+        return _lookup_result(word, language, page)
 
-    return None
+
+def _lookup_result(word, language, page):
+    # Extracts a lookup result from a page and caches it
+    result = {
+        "word": word,
+        "language": language,
+        "url": page.url,
+        "exists": page.exists,
+        "languages": page.languages,
+        "definition": page.definition(language),
+        "pronunciation": page.pronunciation(language),
+        "etymology": page.etymology(language),
+    }
+
+    if _cache is not None:
+        _cache.put_result(word, language, result)
+    return result
+
+
+def lookup_many(pairs, workers=8, ordered=False):
+    """
+    Looks up many words at once on a pool of threads, see lookup. Use set_rate_limit to limit how fast
+    Wiktionary is requested.
+    :param pairs: An iterable of (word, language) tuples, which is read lazily
+    :param workers: Number of lookups run at the same time
+    :param ordered: If True the results come in the order of pairs. A slow lookup then holds back the ones after
+                    it, but never more than workers * 4 of them.
+    :return: A generator of result dictionaries in the order the lookups finish (or of pairs, see ordered). Each
+             has an "error" key that is None if the lookup succeeded and the exception's description if it failed,
+             in which case the keys other than word and language are None.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    pairs = iter(pairs)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if ordered:
+            # Lookups in the order they were submitted, the oldest is always the next result
+            window = deque()
+            for word, language in pairs:
+                window.append((executor.submit(lookup, word, language), word, language))
+                if len(window) >= workers * 4:
+                    yield _many_result(*window.popleft())
+            while window:
+                yield _many_result(*window.popleft())
+            return
+
+        pending = {}
+        # Only a few lookups are queued ahead of the workers so huge inputs aren't read into memory
+        for word, language in pairs:
+            pending[executor.submit(lookup, word, language)] = (word, language)
+            if len(pending) >= workers * 4:
+                break
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                word, language = pending.pop(future)
+                yield _many_result(future, word, language)
+
+                next_pair = next(pairs, None)
+                if next_pair is not None:
+                    pending[executor.submit(lookup, next_pair[0], next_pair[1])] = next_pair
+
+
+def _many_result(future, word, language):
+    # The result of one of lookup_many's lookups, with the exception's description if it failed. Failed lookups
+    # have the same keys as the others, with None for what wasn't found out.
+    try:
+        return dict(future.result(), error=None)
+    except Exception as e:
+        result = {"word": word, "language": language}
+        result.update(dict.fromkeys(["url", "exists", "languages", "definition", "pronunciation", "etymology"]))
+        result["error"] = type(e).__name__ + ": " + str(e)
+        return result
 
 
 def languages_on_page(url):
@@ -50,13 +762,7 @@ def languages_on_page(url):
     :param url: A Wiktionary url
     :return: A list of strings containing the names of languages that have sections on the Wiktionary page
     """
-    html_text = requests.get(url).text
-    soup = BeautifulSoup(html_text, "lxml")
-    language_headers = []
-    for section in soup.find_all("span", class_="mw-headline"):
-        if section.parent.name == "h2":
-            language_headers.append(section.text)
-    return language_headers
+    return get_page(url).languages
 
 
 def is_red_link(url):
@@ -71,14 +777,64 @@ def is_red_link(url):
         return False
 
 
+def is_plain_tag(node, name):
+    """
+    Checks if a node is a tag with the given name and no attributes, i.e. if its html starts with <name>.
+    Unlike comparing str(node) this doesn't serialize the node.
+    :param node: A Beautiful Soup node
+    :param name: Tag name
+    :return: True if node is written as <name>...</name>, False otherwise
+    """
+    from bs4 import Tag
+    return isinstance(node, Tag) and node.name == name and not node.attrs
+
+
+# Tags of the headings that start language sections and their subsections
+_HEADINGS = ("h1", "h2", "h3", "h4", "h5", "h6")
+
+
+def _next_plain(section, node, name):
+    """
+    Finds the first plain <name> tag among the siblings after a node, without going past the end of its section or
+    the next heading
+    :param section: The Section the node is in, or a copied section whose nodes end with their parent
+    :param node: A heading or other tag of the section
+    :param name: Tag name
+    :return: The tag, None if the node's subsection doesn't have one
+    """
+    from bs4 import Comment, Tag
+    end = getattr(section, "end", None)
+    last = end is None and isinstance(section, Section)
+    node = node.next_sibling
+    while node is not None and node is not end:
+        if is_plain_tag(node, name):
+            return node
+        if isinstance(node, Tag) and node.name in _HEADINGS:
+            return None
+        # The last section ends at the cache usage comment, see Section.nodes
+        if last and isinstance(node, Comment) and node.parent is section.heading.parent:
+            return None
+        node = node.next_sibling
+    return None
+
+
 def get_wiki_pronunciation(url, language):
     """
     Returns the pronunciation section of a given Wiktionary url and language
     :param url: A Wiktionary url
-    :param language: Name of a language
+    :param language: Name, alias or code of a language
     :return: Pronunciation of that language's section on the Wiktionary url if it exists, "Not found." otherwise
     """
-    soup = return_section_soup(url, language)
+    language = languages.canonical_name(language)
+    return _section_page(url, language).pronunciation(language)
+
+
+def _pronunciation_from_section(soup):
+    """
+    Extracts the pronunciation from a language's section
+    :param soup: A language section returned by return_section_soup
+    :return: Pronunciation of the section if it exists, "Not found." otherwise
+    """
     # If the language doesn't have a section on the Wiktionary page
     if soup is None:
         return "Not found."
@@ -94,51 +850,34 @@ def get_wiki_pronunciation(url, language):
         return "Not found."
 
     # Find the ul tag following the h3
-    pronunciation_ul_html = pronunciation_h3
-    while str(pronunciation_ul_html)[0:4] != "<ul>":
-        pronunciation_ul_html = pronunciation_ul_html.next_sibling
-
-    # Need to reformat the pronunciations so that the same ones arent repeated and there's one on each line
-    pronunciations_unformatted = ""
-    for li in pronunciation_ul_html.find_all("li"):
-        pronunciations_unformatted += li.text + "\n"
-
-    pronunciations_unformatted.rstrip()
-    pronunciations_unrepeated = []
-    for line in io.StringIO(pronunciations_unformatted):
-        if line.rstrip() not in pronunciations_unrepeated:
-            pronunciations_unrepeated.append(line.rstrip())
-
-    # Remove some other repeated IPAs and irrelevant information
-    pronunciations_formatted = []
-    for line in pronunciations_unrepeated:
-        if line[2:4] == "PR" and "IPA" not in line:
-            continue
-        elif line[0:5] == "Audio" and "IPA" not in line:
-            continue
-        elif line[0:6] == "Rhymes" and "IPA" not in line:
-            continue
-        elif line[0:9] == "Homophone" and "IPA" not in line:
-            continue
-        elif line[0:15] == "Syllabification" and "IPA" not in line:
-            continue
-        else:
-            pronunciations_formatted.append(line.replace("(key)", ""))
+    pronunciation_ul_html = _next_plain(soup, pronunciation_h3, "ul")
+    if pronunciation_ul_html is None:
+        return "Not found."
 
-    return "".join([x + "\n" for x in pronunciations_formatted]).rstrip()
+    # Reformat the pronunciations so that the same ones arent repeated and there's one on each line
+    return normalize.normalize_pronunciation([li.text for li in pronunciation_ul_html.find_all("li")])
 
 
 def get_wiki_etymology(url, language):
     """
     Returns the etymology section on the Wiktionary url under the given language section
     :param url: A Wiktionary url
-    :param language: Name of a language
+    :param language: Name, alias or code of a language
     :return: Etymology of that language's section on the Wiktionary url if it exists, "Not found." otherwise
     """
-    soup = return_section_soup(url, language)
+    language = languages.canonical_name(language)
+    return _section_page(url, language).etymology(language)
+
+
+def _etymology_paragraph(soup):
+    """
+    Finds the paragraph under a language section's (first) etymology heading
+    :param soup: A language section returned by return_section_soup
+    :return: The <p> tag, None if the section or its etymology doesn't exist
+    """
     # If the language doesn't have a section on the Wiktionary page
     if soup is None:
-        return "Not found."
+        return None
 
     etymology_h3 = None
     for section in soup.find_all("span", class_="mw-headline"):
@@ -148,24 +887,131 @@ def get_wiki_etymology(url, language):
 
     # If there's no etymology section
     if etymology_h3 is None:
-        return "Not found."
+        return None
 
     # Find the p tag following the etymology heading
-    etymology_p_html = etymology_h3
-    while str(etymology_p_html)[0:3] != "<p>":
-        etymology_p_html = etymology_p_html.next_sibling
+    return _next_plain(soup, etymology_h3, "p")
 
+
+def _etymology_from_section(soup):
+    """
+    Extracts the etymology from a language's section
+    :param soup: A language section returned by return_section_soup
+    :return: Etymology of the section if it exists, "Not found." otherwise
+    """
+    etymology_p_html = _etymology_paragraph(soup)
+    if etymology_p_html is None:
+        return "Not found."
     return etymology_p_html.get_text().rstrip()
 
 
+def parse_wiki_link(href, default_language=None):
+    """
+    Works out which word and language a link on a Wiktionary page points to
+    :param href: The link's href, e.g. "/wiki/b%C3%A6%C3%BE#Old_English" or
+                 "/wiki/Reconstruction:Proto-Germanic/ba%C3%BE%C4%85"
+    :param default_language: Language to use when the link doesn't name one
+    :return: A tuple (word, language, url). Reconstructed words start with '*', as get_wiki_url expects them.
+             None if the link doesn't point to a Wiktionary entry.
+    """
+    parts = urlsplit(href)
+    if parts.path.startswith("/wiki/"):
+        title = unquote(parts.path[len("/wiki/"):])
+    elif parts.path == "/w/index.php" and "title" in parse_qs(parts.query):
+        # Red links point to the edit page of the missing entry
+        title = parse_qs(parts.query)["title"][0]
+    else:
+        return None
+    if parts.netloc not in ("", "en.wiktionary.org"):
+        return None
+
+    language = unquote(parts.fragment).replace("_", " ") or default_language
+    if title.startswith("Reconstruction:") and "/" in title:
+        language, word = title[len("Reconstruction:"):].split("/", 1)
+        word = "*" + word
+        language = language.replace("_", " ")
+    elif ":" in title:
+        # Other namespaces (Appendix:, Wiktionary:, ...) aren't entries
+        return None
+    else:
+        word = title
+    # Links can also be absolute or protocol-relative
+    return word.replace("_", " "), language, urljoin("https://en.wiktionary.org/", href)
+
+
+def _mention_links(html, default_language=None):
+    # Words are mentioned inside a tag with a lang attribute, unlike the links to language names around them
+    links = []
+    for a in html.find_all("a", href=True):
+        if a.parent is not None and a.parent.get("lang") is not None:
+            link = parse_wiki_link(a["href"], default_language)
+            if link is not None:
+                links.append(link)
+    return links
+
+
+def _etymology_links_from_section(soup):
+    """
+    Finds the words a language section's etymology derives the word from
+    :param soup: A language section returned by return_section_soup
+    :return: A list of (word, language, url) tuples in the order they are mentioned, see parse_wiki_link
+    """
+    etymology_p_html = _etymology_paragraph(soup)
+    if etymology_p_html is None:
+        return []
+    return _mention_links(etymology_p_html)
+
+
+def _descendant_links_from_section(soup):
+    """
+    Finds the direct descendants listed under a language section's Descendants heading
+    :param soup: A language section returned by return_section_soup
+    :return: A list of (word, language, url) tuples, see parse_wiki_link
+    """
+    if soup is None:
+        return []
+    for section in soup.find_all("span", class_="mw-headline"):
+        if section.text == "Descendants":
+            descendants_ul = _next_plain(soup, section.parent, "ul")
+            if descendants_ul is None:
+                return []
+
+            from bs4 import Tag
+            links = []
+            for li in descendants_ul.find_all("li", recursive=False):
+                # Entries are written "Language: word", deeper descendants are in nested lists
+                language = li.get_text().split(":", 1)[0].strip()
+                for child in li.children:
+                    if isinstance(child, Tag) and child.name != "ul":
+                        child_links = _mention_links(child, language)
+                        if child_links:
+                            links.append(child_links[0])
+                            break
+            return links
+    return []
+
+
 def get_wiki_definition(url, language):
     """
     Returns the definition entry of the Wiktionary url under the given language section
     :param url: A Wiktionary url
-    :param language: Name of a language
+    :param language: Name, alias or code of a language
     :return: Definition entry of that language's section on the Wiktionary url if it exists, "Not found." otherwise
     """
-    soup = return_section_soup(url, language)
+    language = languages.canonical_name(language)
+    return _section_page(url, language).definition(language)
+
+
+def _definition_from_section(soup, prune=None):
+    """
+    Extracts the definition entry from a language's section
+    :param soup: A language section returned by return_section_soup
+    :param prune: Rules for the nodes left out of each definition, DEFINITION_PRUNE if None
+    :return: Definition entry of the section if it exists, "Not found." otherwise
+    """
+    if prune is None:
+        prune = DEFINITION_PRUNE
+
     # If the language doesn't have a section on the Wiktionary page
     if soup is None:
         return "Not found."
@@ -185,38 +1031,20 @@ def get_wiki_definition(url, language):
         return "Not found."
 
     # Get the <p> text following the definition header
-    definition_html = definition_tag
-    while str(definition_html)[0:3] != "<p>":
-        definition_html = definition_html.next_sibling
+    definition_html = _next_plain(soup, definition_tag, "p")
+    if definition_html is None:
+        return "Not found."
 
-    output_text = ""
-    output_text += definition_html.get_text().rstrip()
+    headword = definition_html.get_text()
 
     # Get the <ol> text following the <p> tag
-    while str(definition_html)[0:4] != "<ol>":
-        definition_html = definition_html.next_sibling
-
-    # Get the list entries
-    definitions_unformatted = ""
-    cur_num = 1
-    for li in definition_html.find_all("li"):
-        if li.parent.name == "ol":
-            # Don't include the sentence examples or quotations or citations
-            li_formatted = remove_inner_tags("<dl>", "</dl>", li)
-            li_formatted = remove_inner_tags("<dd>", "</dd>", li_formatted)
-            li_formatted = remove_inner_tags("<div class=\"citation-whole\">", "</div>", li_formatted)
-            li_formatted = remove_inner_tags("<span class=\"cited-source\">", "</span>", li_formatted)
-            li_formatted = remove_inner_tags("<ul style=\"display: block;\">", "</ul>", li_formatted)
-            definitions_unformatted += str(cur_num) + ". " + remove_everything_after_period(li_formatted.text.rstrip()) + "\n"
-            cur_num += 1
-
-    definitions_unformatted.rstrip()
-    definitions_unrepeated = []
-    for line in io.StringIO(definitions_unformatted):
-        if line.rstrip() not in definitions_unrepeated:
-            definitions_unrepeated.append(line.rstrip())
-
-    return output_text + "\n" + "".join(["    " + x + "\n" for x in definitions_unrepeated]).rstrip()
+    definition_html = _next_plain(soup, definition_html, "ol")
+    if definition_html is None:
+        return "Not found."
+
+    # Get the list entries, without the sentence examples or quotations or citations
+    texts = [pruned_text(li, prune) for li in definition_html.find_all("li") if li.parent.name == "ol"]
+    return normalize.normalize_definition(headword, texts)
 
 
 def between(cur, end):
@@ -228,120 +1056,93 @@ def between(cur, end):
         cur = cur.next_element
 
 
+# Nodes left out of the text of a definition: sentence examples, quotations and citations. Each rule is a tag
+# name and a dictionary of attributes the tag must have, where a "class" matches any one of the tag's classes.
+DEFINITION_PRUNE = [
+    ("dl", {}),
+    ("dd", {}),
+    ("div", {"class": "citation-whole"}),
+    ("span", {"class": "cited-source"}),
+    ("ul", {"style": "display: block;"}),
+]
+
+
+def matches_rule(tag, rule):
+    """
+    Checks a tag against a pruning rule (see DEFINITION_PRUNE)
+    :param tag: A Beautiful Soup tag
+    :param rule: A tuple (name, attributes)
+    :return: True if the tag has the rule's name and attributes, False otherwise
+    """
+    name, attrs = rule
+    if tag.name != name:
+        return False
+    for key, value in attrs.items():
+        if key == "class":
+            if value not in tag.get("class", []):
+                return False
+        elif tag.get(key) != value:
+            return False
+    return True
+
+
+def pruned_text(html, prune):
+    """
+    Returns the text of html without the contents of any tag matching one of the pruning rules. The tree is
+    walked once and isn't modified, so it can be used on a page that other extractors share.
+    :param html: A Beautiful Soup tag
+    :param prune: A list of (name, attributes) rules, see DEFINITION_PRUNE
+    :return: The text (string) left after pruning
+    """
+    from bs4 import CData, NavigableString, Tag
+    pieces = []
+    stack = [html]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Tag):
+            if node is not html and any(matches_rule(node, rule) for rule in prune):
+                continue
+            stack.extend(reversed(node.contents))
+        elif type(node) is NavigableString or type(node) is CData:
+            pieces.append(node)
+    return "".join(pieces)
+
+
 def remove_inner_tags(tag_open, tag_close, html):
     """
     Helper function to remove tags (<foo>...</foo>) and their content from inner text of html.
+    The definition extractor uses pruned_text instead, which doesn't need to copy or re-parse the html.
     :param tag_close: closing form of the tag to be removed (a string written as </a>)
     :param html: The html that needs to be modified
     :param tag_open: opening form of the tag to be removed (a string written as <a>)
     :return: html without the tag and its contents
     """
-    html_str = str(html).replace("\n", " ")
-    new_html = ""
-
-    # Loop over each letter in the string
-    tag_encountered = False
-    tag_deletion_length = 0
-    cur_index = 0
-    for letter in html_str:
-        # Used to not include the closing part of the tag
-        if tag_deletion_length != 0:
-            tag_deletion_length -= 1
-            cur_index += 1
-            continue
-
-        if letter == "<" and not tag_encountered:
-            cur_tag = ""
-            # Keep going until we figure out what the tag is
-            for i in html_str[cur_index:]:
-                if i != ">":
-                    cur_tag += i
-                elif i == ">":
-                    cur_tag += i
-                    break
-            if cur_tag == tag_open:
-                tag_encountered = True
-
-        if letter == "<" and tag_encountered:
-            # Need to check if its the closing tag
-            cur_tag = ""
-            for i in html_str[cur_index:]:
-                if i != ">":
-                    cur_tag += i
-                elif i == ">":
-                    cur_tag += i
-                    break
-            if cur_tag == tag_close:
-                # If its the closing tag then we count how many more letters we need to skip to not include it
-                tag_encountered = False
-                tag_deletion_length = len(tag_close) - 1
-                cur_index += 1
-                continue
-
-        # Add to the new_html string if we aren't at the tag yet or aren't deleting the rest of the tag
-        if not tag_encountered:
-            new_html += letter
-        cur_index += 1
+    from bs4 import BeautifulSoup
+    # Turn the opening tag into a pruning rule
+    tag = BeautifulSoup(tag_open + tag_close, "html.parser").find()
+    attrs = {key: " ".join(value) if isinstance(value, list) else value for key, value in tag.attrs.items()}
+    rule = (tag.name, attrs)
 
-    return BeautifulSoup(new_html, "lxml")
+    soup = BeautifulSoup(str(html).replace("\n", " "), "lxml")
+    # Collect the outermost matches first so nested matches aren't decomposed twice
+    for match in soup.find_all(lambda t: matches_rule(t, rule)):
+        if not match.decomposed:
+            match.decompose()
+    return soup
 
 
 def remove_everything_after_period(s):
-    new_s = ""
-    for i in s:
-        new_s += i
-        if i == ".":
-            return new_s
-    return new_s
+    return normalize.first_sentence(s)
 
 
 def return_section_soup(url, language):
     """
-    Given a Wiktionary url and a language, returns that language's section's html in Beautiful Soup format
+    Given a Wiktionary url and a language, returns that language's section of the page
     :param url: A Wiktionary url
-    :param language: Name of a language
-    :return: Beautiful Soup format html code of that language's section on the url if it exists, None
-             if that section doesn't exist on the page.
+    :param language: Name, alias or code of a language
+    :return: A Section view of that language's section on the url if it exists, which supports find_all like
+             Beautiful Soup html does. None if that section doesn't exist on the page, or if a store is set (see
+             set_store), which doesn't keep the pages' html.
     """
-    sections = languages_on_page(url)
-
-    html_text = requests.get(url).text
-    soup = BeautifulSoup(html_text, "lxml")
-
-    if language not in sections:
-        return None
-
-    # Needs to be handled differently if the input language is the last section on the page
-    if sections.index(language) == len(sections) - 1:
-        # Every wiktionary page follows its last language section with a cache usage comment
-        first_section = language
-        cache_comment = soup.find_all(text=lambda text:isinstance(text, Comment))[1]
-
-        # Find the h2 tag that has first_section in its child's span's id
-        for section in soup.find_all("span", class_="mw-headline"):
-            if section.parent.name == "h2" and section.text == first_section:
-                first_section_html = section.parent
-
-        new_html = ""
-        for line in between(first_section_html.next_sibling, cache_comment):
-            new_html += str(line)
-
-        return BeautifulSoup(new_html, "lxml")
-    else:
-        # Grab the current language's heading and the heading of the language section after it
-        first_section = language
-        next_section = sections[sections.index(language) + 1]
-
-        # Find the h2 tags that have first_section and next_section in their child's span's ids
-        for section in soup.find_all("span", class_="mw-headline"):
-            if section.parent.name == "h2" and section.text == first_section:
-                first_section_html = section.parent
-        for section in soup.find_all("span", class_="mw-headline"):
-            if section.parent.name == "h2" and section.text == next_section:
-                next_section_html = section.parent
-
-        new_html = ""
-        for line in between(first_section_html.next_sibling, next_section_html):
-            new_html += str(line)
-
-        return BeautifulSoup(new_html, "lxml")
+    language = languages.canonical_name(language)
+    return _section_page(url, language).section_soup(language)